@@ -0,0 +1,87 @@
+"""
+Count the operations of the theano graph of the interpolator and time the compilation and a call of the
+compiled function.
+
+The graph is counted twice: as it is built by theanograf.TheanoGraph_pro (before any optimization, i.e. the work
+that the graph construction requests) and after compilation. Scan inner graphs are counted recursively.
+
+Usage:
+    python bench_graph_ops.py [n_calls]
+"""
+from __future__ import print_function
+
+import collections
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import theano
+from theano.gof.graph import io_toposort
+from theano.scan_module.scan_op import Scan
+
+import gempy
+
+input_data_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'input_data')
+counted_ops = ('Solve', 'Dot', 'Dot22', 'Gemm', 'Gemv', 'Scan', 'Elemwise')
+
+
+def count_nodes(nodes, counter, compiled):
+    """
+    Count the type of the ops of a list of apply nodes going into the scan inner graphs
+    Args:
+        nodes (list): apply nodes
+        counter (collections.Counter): counter to update
+        compiled (bool): if True the inner graph of the compiled scan is used
+
+    Returns:
+        collections.Counter: counter
+    """
+    for node in nodes:
+        counter[type(node.op).__name__] += 1
+        if isinstance(node.op, Scan):
+            if compiled:
+                inner = node.op.fn.maker.fgraph.toposort()
+            else:
+                inner = io_toposort(node.op.inputs, node.op.outputs)
+            count_nodes(inner, counter, compiled)
+    return counter
+
+
+def fab_model(resolution=(20, 20, 20)):
+    geo_data = gempy.create_data([0, 2000, 0, 2000, -2000, 0], resolution=list(resolution),
+                                 path_f=os.path.join(input_data_path, "Fab_Foliations.csv"),
+                                 path_i=os.path.join(input_data_path, "Fab_Points.csv"))
+    gempy.set_data_series(geo_data, {"fault1": 'MainFault',
+                                     "series": ('Layer 1', 'Layer 2', 'Layer 3')},
+                          order_series=["fault1", "series"], verbose=0)
+    geo_data.n_faults = 1
+    return geo_data
+
+
+def summary(counter):
+    return dict([(op, counter[op]) for op in counted_ops] + [('total', sum(counter.values()))])
+
+
+if __name__ == '__main__':
+    n_calls = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+
+    geo_data = fab_model()
+    start = timeit.default_timer()
+    interp_data = gempy.InterpolatorInput(geo_data, dtype='float32', u_grade=[0, 0])
+    compilation_time = timeit.default_timer() - start
+    th_fn = interp_data.th_fn
+
+    # Build the graph again to count it before the optimizations
+    output = interp_data.interpolator.tg.whole_block_model(interp_data.data.n_faults)
+    built = count_nodes(io_toposort(th_fn.maker.fgraph.inputs, [output]), collections.Counter(), compiled=False)
+    compiled = count_nodes(th_fn.maker.fgraph.toposort(), collections.Counter(), compiled=True)
+
+    input_data = interp_data.get_input_data()
+    time_per_call = timeit.timeit(lambda: th_fn(*input_data), number=n_calls) / n_calls
+
+    print('Graph as built:   ', summary(built))
+    print('Compiled graph:   ', summary(compiled))
+    print('Compilation (s):  ', compilation_time)
+    print('Time per call (s):', time_per_call)
@@ -0,0 +1,92 @@
+"""
+Scaling of the parallel evaluation of the lithology series (see InterpolatorInput.compute_series_parallel) against the
+sequential scan of th_fn on synthetic models with several series (see synthetic.py).
+
+The threads only run in parallel while the ops of the graph release the GIL (BLAS and LAPACK calls in the C linker).
+The elementwise ops and the python implementations of the ops do not, so the speedup depends on the model, the linker
+and the BLAS of the machine and it is not guaranteed. Every case prints the best time of th_fn and of
+compute_series_parallel with every number of threads, and the speedup against th_fn.
+
+Usage:
+    python bench_parallel_series.py [--series 4] [--resolution 40] [--threads 1 2 4] [--repeat 3]
+                                    [--output results.json]
+"""
+from __future__ import print_function, division
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gempy
+from synthetic import synthetic_model
+
+
+def best_time(function, n_repeat):
+    """
+    Args:
+        function (callable): Function without arguments
+        n_repeat (int): Number of calls
+
+    Returns:
+        float: Time of the fastest call in seconds
+    """
+    return min(timeit.repeat(function, number=1, repeat=n_repeat))
+
+
+def run(n_series=4, resolution=40, threads=(1, 2, 4), n_interfaces=20, n_repeat=3):
+    """
+    Time th_fn and compute_series_parallel on a synthetic model
+
+    Args:
+        n_series (int): Number of lithology series
+        resolution (int): Resolution of the grid along every axis
+        threads (list): Numbers of threads of compute_series_parallel
+        n_interfaces (int): Interfaces per surface
+        n_repeat (int): Number of calls of every function. The best one is kept
+
+    Returns:
+        dict: 'sequential': time of th_fn, 'parallel': {n_threads: time}
+    """
+    geo_data = synthetic_model(n_interfaces=n_interfaces, resolution=(resolution,) * 3, n_series=n_series)
+    interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0] * n_series)
+    input_data = interp_data.get_input_data()
+
+    sol = interp_data.th_fn(*input_data)
+    results = {'sequential': best_time(lambda: interp_data.th_fn(*input_data), n_repeat), 'parallel': {}}
+    for n_threads in threads:
+        # The first call compiles the functions of the series and copies them for every thread
+        np.testing.assert_array_equal(interp_data.compute_series_parallel(n_threads=n_threads), sol)
+        results['parallel'][n_threads] = best_time(lambda: interp_data.compute_series_parallel(n_threads=n_threads),
+                                                   n_repeat)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scaling of the parallel evaluation of the lithology series')
+    parser.add_argument('--series', type=int, default=4, help='number of lithology series')
+    parser.add_argument('--resolution', type=int, default=40, help='resolution of the grid along every axis')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--repeat', type=int, default=3, help='calls of every function')
+    parser.add_argument('--output', help='json file of the results')
+    args = parser.parse_args(argv)
+
+    results = run(n_series=args.series, resolution=args.resolution, threads=args.threads, n_repeat=args.repeat)
+
+    print('th_fn (sequential scan)   %.4f s' % results['sequential'])
+    for n_threads, time in sorted(results['parallel'].items()):
+        print('%2d threads                %.4f s  speedup %.2f' % (n_threads, time, results['sequential'] / time))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(vars(args), **results), f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
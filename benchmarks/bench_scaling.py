@@ -0,0 +1,191 @@
+"""
+Scaling benchmark of the interpolator on synthetic models (see synthetic.py).
+
+Every case records the wall time and the peak memory of:
+    - setup: construction of InterpolatorInput without compiling (rescaling and shared parameters)
+    - compile: compilation of th_fn (or loading it from the cache of compiled functions)
+    - data_prep: InterpolatorInput.get_input_data
+    - compute_model: a call of gempy.compute_model
+    - compute_model/<stage>/<series>: the stages of compute_model per series: covariance, solve, evaluation and
+      segmentation (see InterpolatorInput.compute_model_instrumented)
+
+All the metrics but compile are the best of n_repeat runs.
+
+The results are written to a json file. Given a baseline (a json file written by a previous run) the cases are
+compared and the script exits with status 1 if the time or the memory of any metric regressed beyond the tolerance.
+
+Usage:
+    python bench_scaling.py [--suite quick|full] [--output results.json] [--baseline baseline.json]
+                            [--time-tolerance 0.25] [--memory-tolerance 0.1] [--repeat 3]
+"""
+from __future__ import print_function, division
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gempy
+from gempy.instrumentation import ModelReport
+from synthetic import synthetic_model
+
+# Every case of a suite changes one parameter of the base case
+base_case = dict(n_interfaces=10, n_foliations=2, resolution=(20, 20, 20), n_series=1, n_faults=0)
+suites = {
+    'quick': [dict(),
+              dict(n_interfaces=40),
+              dict(resolution=(40, 40, 40)),
+              dict(n_faults=1)],
+    'full': [dict()] +
+            [dict(n_interfaces=n) for n in (20, 50, 100, 200)] +
+            [dict(n_foliations=n) for n in (5, 20, 50)] +
+            [dict(resolution=(n, n, n)) for n in (10, 40, 60)] +
+            [dict(n_series=n) for n in (2, 3)] +
+            [dict(n_faults=n) for n in (1, 2)],
+}
+
+# Differences below these values are noise
+min_time = 5e-3
+min_memory = 1 << 20
+
+
+def case_name(params):
+    return 'i%d_f%d_r%s_s%d_F%d' % (params['n_interfaces'], params['n_foliations'],
+                                    'x'.join(str(r) for r in params['resolution']), params['n_series'],
+                                    params['n_faults'])
+
+
+def run_case(params, n_repeat=3, cache_dir=None):
+    """
+    Benchmark a synthetic model
+
+    Args:
+        params (dict): Parameters of synthetic.synthetic_model
+        n_repeat (int): Number of runs of every metric. The best one is kept
+        cache_dir (str): Directory of the cache of compiled functions
+
+    Returns:
+        dict: metric: {'time', 'peak_memory'}
+    """
+    geo_data = synthetic_model(**params)
+    u_grade = [0] * (params['n_series'] + params['n_faults'])
+
+    def best_of(stage, function, n):
+        # Run function n times and record the fastest call
+        calls = ModelReport()
+        for i in range(n):
+            with calls.record(stage):
+                result = function()
+        report.stages.append(min(calls.stages, key=lambda s: s['time']))
+        return result
+
+    report = ModelReport()
+    interp_data = best_of('setup', lambda: gempy.InterpolatorInput(geo_data, u_grade=u_grade, compile_theano=False,
+                                                                   cache_dir=cache_dir), n_repeat)
+    interp_data.th_fn = best_of('compile', lambda: interp_data.compile_th_fn(compute_all=interp_data.compute_all,
+                                                                             only_last=interp_data.only_last), 1)
+    best_of('data_prep', interp_data.get_input_data, n_repeat)
+    best_of('compute_model', lambda: gempy.compute_model(interp_data), n_repeat)
+
+    metrics = {}
+    for s in report.stages:
+        metrics[s['stage']] = {'time': s['time'], 'peak_memory': int(s['peak_memory'])}
+
+    # Stages of the model, best of n_repeat. The first call compiles the functions of the stages
+    gempy.compute_model(interp_data, instrumentation=True)
+    for i in range(n_repeat):
+        stages = gempy.compute_model(interp_data, instrumentation=True)[1]
+        for (stage, series), s in stages.to_dataframe().fillna('').groupby(['stage', 'series'], sort=False):
+            name = 'compute_model/' + (stage if not series else '%s/%s' % (stage, series))
+            best = metrics.get(name, {'time': np.inf, 'peak_memory': np.inf})
+            metrics[name] = {'time': min(best['time'], float(s['time'].sum())),
+                             'peak_memory': int(min(best['peak_memory'], s['peak_memory'].max()))}
+    return metrics
+
+
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.1):
+    """
+    Compare the metrics of the cases present in both results
+
+    Args:
+        results (dict): Output of a run
+        baseline (dict): Output of a previous run
+        time_tolerance (float): Maximum relative increase of the time
+        memory_tolerance (float): Maximum relative increase of the peak memory
+
+    Returns:
+        list: (case, metric, quantity, baseline value, new value) of every regression
+    """
+    regressions = []
+    for case, metrics in results['cases'].items():
+        if case not in baseline['cases']:
+            continue
+        for metric, values in metrics['metrics'].items():
+            old = baseline['cases'][case]['metrics'].get(metric)
+            if old is None:
+                continue
+            for quantity, tolerance, noise in (('time', time_tolerance, min_time),
+                                               ('peak_memory', memory_tolerance, min_memory)):
+                if values[quantity] > old[quantity] * (1 + tolerance) and values[quantity] - old[quantity] > noise:
+                    regressions.append((case, metric, quantity, old[quantity], values[quantity]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Scaling benchmark of the interpolator on synthetic models')
+    parser.add_argument('--suite', choices=sorted(suites), default='quick')
+    parser.add_argument('--output', default='benchmark_results.json', help='json file of the results')
+    parser.add_argument('--baseline', help='json file of a previous run to compare with')
+    parser.add_argument('--time-tolerance', type=float, default=0.25)
+    parser.add_argument('--memory-tolerance', type=float, default=0.1)
+    parser.add_argument('--repeat', type=int, default=3, help='runs of every metric')
+    args = parser.parse_args(argv)
+
+    # Import theano and build a graph before the first case so its setup does not include it
+    import theano
+    gempy.InterpolatorInput(synthetic_model(**base_case), u_grade=[0], compile_theano=False)
+
+    results = {'metadata': {'date': datetime.datetime.now().isoformat(),
+                            'suite': args.suite,
+                            'python': platform.python_version(),
+                            'numpy': np.__version__,
+                            'theano': theano.__version__,
+                            'machine': platform.platform(),
+                            'processor': platform.processor()},
+               'cases': {}}
+
+    # The cases with the same structure share the compiled function
+    cache_dir = tempfile.mkdtemp(prefix='gempy_benchmark_')
+    for case in suites[args.suite]:
+        params = dict(base_case, **case)
+        name = case_name(params)
+        metrics = run_case(params, n_repeat=args.repeat, cache_dir=cache_dir)
+        results['cases'][name] = {'params': dict(params, resolution=list(params['resolution'])), 'metrics': metrics}
+        print('%-28s compute_model %.4f s  peak memory %.1f MB' % (name, metrics['compute_model']['time'],
+                                                                  metrics['compute_model']['peak_memory'] / 2**20))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.time_tolerance, args.memory_tolerance)
+        for case, metric, quantity, old, new in regressions:
+            print('REGRESSION %s %s %s: %.4g -> %.4g (%+.0f%%)' % (case, metric, quantity, old, new,
+                                                                  100 * (new / old - 1)))
+        if regressions:
+            return 1
+        print('No regressions against %s' % args.baseline)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
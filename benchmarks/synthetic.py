@@ -0,0 +1,148 @@
+"""
+Generator of synthetic layered and faulted models for the benchmarks.
+
+Every lithology series is a stack of layers with the same undulating shape (so the series are unconformable between
+them) and every fault is a plane striking along y that displaces the layers of its hanging wall. The interfaces are
+sampled at random positions of every surface and the foliations are the normals of the surfaces at random positions,
+so the data is consistent and the models can be computed at any size.
+"""
+from __future__ import division
+
+import os
+import sys
+
+import numpy as np
+import pandas as pn
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import gempy
+
+
+def orientation(normals):
+    """
+    Dip and azimuth of unit normal vectors as used by gempy (see InputData.calculate_gradient)
+
+    Args:
+        normals (numpy.array): Unit normals. Shape (n, 3)
+
+    Returns:
+        numpy.array: dip in degrees
+
+        numpy.array: azimuth in degrees
+    """
+    dip = np.rad2deg(np.arccos(np.clip(normals[:, 2], -1, 1)))
+    azimuth = np.rad2deg(np.arctan2(normals[:, 0], normals[:, 1])) % 360
+    return dip, azimuth
+
+
+def synthetic_model(n_interfaces=10, n_foliations=2, resolution=(20, 20, 20), n_series=1, n_layers=2, n_faults=0,
+                    extent=(0, 2000, 0, 2000, -2000, 0), seed=0):
+    """
+    Create a synthetic model
+
+    Args:
+        n_interfaces (int): Number of interface points of every layer and fault. At least 2
+        n_foliations (int): Number of foliations of every series and fault. At least 1
+        resolution (list): [nx, ny, nz]
+        n_series (int): Number of lithology series
+        n_layers (int): Number of layers (formations) of every lithology series
+        n_faults (int): Number of faults
+        extent (list): [x_min, x_max, y_min, y_max, z_min, z_max]
+        seed (int): Seed of the random positions
+
+    Returns:
+        gempy.DataManagement.InputData: Model with the series set, faults first
+    """
+    assert n_interfaces >= 2, 'Every surface needs at least 2 interface points'
+    assert n_foliations >= 1, 'Every series needs at least 1 foliation'
+
+    rng = np.random.RandomState(seed)
+    x_min, x_max, y_min, y_max, z_min, z_max = extent
+    width, height = x_max - x_min, z_max - z_min
+
+    # Faults: planes dipping 70 degrees with the trace evenly spaced along x
+    fault_dip = np.deg2rad(70)
+    fault_x = x_min + width * (np.arange(n_faults) + 1) / (n_faults + 1)
+    fault_throw = 0.05 * height
+    z_mid = (z_min + z_max) / 2
+
+    def fault_plane_x(i, z):
+        return fault_x[i] + (z - z_mid) / np.tan(fault_dip)
+
+    def throw(x, z):
+        # Every fault lowers its hanging wall
+        displacement = np.zeros_like(x)
+        for i in range(n_faults):
+            displacement -= fault_throw * (x > fault_plane_x(i, z))
+        return displacement
+
+    # Layers: undulating surfaces with a different phase and amplitude for every series
+    def surface(series, layer, x, y):
+        depth = z_max - height * (series * n_layers + layer + 1) / (n_series * n_layers + 1)
+        amplitude = 0.05 * height * (1 + series)
+        phase = series * np.pi / 3
+        return depth + amplitude * np.sin(2 * np.pi * (x - x_min) / width + phase) * \
+            np.cos(np.pi * (y - y_min) / (y_max - y_min))
+
+    def surface_normal(series, x, y):
+        amplitude = 0.05 * height * (1 + series)
+        phase = series * np.pi / 3
+        dz_dx = amplitude * 2 * np.pi / width * np.cos(2 * np.pi * (x - x_min) / width + phase) * \
+            np.cos(np.pi * (y - y_min) / (y_max - y_min))
+        dz_dy = -amplitude * np.pi / (y_max - y_min) * np.sin(2 * np.pi * (x - x_min) / width + phase) * \
+            np.sin(np.pi * (y - y_min) / (y_max - y_min))
+        normals = np.stack((-dz_dx, -dz_dy, np.ones_like(x)), axis=1)
+        return normals / np.linalg.norm(normals, axis=1)[:, None]
+
+    def random_xy(n):
+        # Keep the points away from the borders of the extent
+        return (x_min + width * (0.05 + 0.9 * rng.rand(n)),
+                y_min + (y_max - y_min) * (0.05 + 0.9 * rng.rand(n)))
+
+    interfaces = []
+    foliations = []
+    series_distribution = {}
+    order_series = []
+
+    for i in range(n_faults):
+        name = 'fault_%d' % i
+        y = y_min + (y_max - y_min) * (0.05 + 0.9 * rng.rand(n_interfaces))
+        z = z_min + height * (0.05 + 0.9 * rng.rand(n_interfaces))
+        interfaces.append(pn.DataFrame({'X': fault_plane_x(i, z), 'Y': y, 'Z': z, 'formation': name}))
+
+        y = y_min + (y_max - y_min) * (0.05 + 0.9 * rng.rand(n_foliations))
+        z = z_min + height * (0.05 + 0.9 * rng.rand(n_foliations))
+        normal = np.array([np.sin(fault_dip), 0, np.cos(fault_dip)])
+        dip, azimuth = orientation(np.tile(normal, (n_foliations, 1)))
+        foliations.append(pn.DataFrame({'X': fault_plane_x(i, z), 'Y': y, 'Z': z, 'dip': dip, 'azimuth': azimuth,
+                                        'polarity': 1, 'formation': name}))
+
+        series_distribution[name] = name
+        order_series.append(name)
+
+    for s in range(n_series):
+        layers = ['layer_%d_%d' % (s, k) for k in range(n_layers)]
+        for k, name in enumerate(layers):
+            x, y = random_xy(n_interfaces)
+            z = surface(s, k, x, y)
+            interfaces.append(pn.DataFrame({'X': x, 'Y': y, 'Z': z + throw(x, z), 'formation': name}))
+
+        # The foliations of a series are spread over its layers
+        x, y = random_xy(n_foliations)
+        k = np.arange(n_foliations) % n_layers
+        z = surface(s, k, x, y)
+        dip, azimuth = orientation(surface_normal(s, x, y))
+        foliations.append(pn.DataFrame({'X': x, 'Y': y, 'Z': z + throw(x, z), 'dip': dip, 'azimuth': azimuth,
+                                        'polarity': 1, 'formation': [layers[j] for j in k]}))
+
+        series_distribution['series_%d' % s] = tuple(layers)
+        order_series.append('series_%d' % s)
+
+    geo_data = gempy.create_data(list(extent), resolution=list(resolution))
+    geo_data.set_interfaces(pn.concat(interfaces, ignore_index=True)[['X', 'Y', 'Z', 'formation']])
+    geo_data.set_foliations(pn.concat(foliations, ignore_index=True)[['X', 'Y', 'Z', 'dip', 'azimuth', 'polarity',
+                                                                      'formation']])
+    gempy.set_data_series(geo_data, series_distribution, order_series=order_series)
+    geo_data.n_faults = n_faults
+    return geo_data
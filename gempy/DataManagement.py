@@ -8,10 +8,14 @@ import sys
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
 import copy
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 import numpy as np
 import pandas as pn
-from gempy import theanograf
-import theano
+# theano and the graph are imported the first time an interpolator is created, so importing gempy to read or plot
+# data does not load them
 
 class InputData(object):
     """
@@ -554,19 +558,110 @@ class InputData(object):
             extent (list):  [x_min, x_max, y_min, y_max, z_min, z_max]
             resolution (list): [nx, ny, nz].
             grid_type(str): Type of grid. So far only regular 3D is implemented
+
+        A regular 3D grid is defined by its extent and resolution. The array with the coordinates of all the points is
+        only created the first time grid is accessed, points and axes generate the coordinates without it. Setting
+        grid to an array of points makes the grid irregular. The interpolator only avoids the array, and the upload of
+        the grid and its drift, with its regular_grid option (see InterpolatorInput.InterpolatorClass)
         """
 
         def __init__(self, extent, resolution, grid_type="regular_3D"):
             self._grid_ext = extent
             self._grid_res = resolution
 
+            # Points of an irregular grid. None for the regular 3D grid
+            self._grid = None
+            # (extent, resolution, points) of the last regular grid created by grid
+            self._regular_grid_cache = None
+
             if grid_type == "regular_3D":
-                self.grid = self.create_regular_grid_3d()
+                pass
             elif grid_type == "regular_2D":
                 self.grid = self.create_regular_grid_2d()
             else:
                 print("Wrong type")
 
+        def __setstate__(self, state):
+            # Grids pickled when the points of the regular grid were stored
+            if 'grid' in state:
+                state['_grid'] = state.pop('grid')
+            state.setdefault('_regular_grid_cache', None)
+            self.__dict__.update(state)
+
+        def __getstate__(self):
+            # The points of the regular grid are created again after unpickling
+            return dict(self.__dict__, _regular_grid_cache=None)
+
+        @property
+        def grid(self):
+            """
+            Returns:
+                numpy.ndarray: Coordinates of all the points. Shape (n, 3). For a regular grid the array is created
+                once and kept read only until the extent, the resolution or the grid change. Use points, axes and
+                n_points to avoid creating it
+            """
+            if self._grid is not None:
+                return self._grid
+
+            extent, resolution = tuple(np.ravel(self._grid_ext)), tuple(np.ravel(self._grid_res))
+            if self._regular_grid_cache is None or self._regular_grid_cache[:2] != (extent, resolution):
+                grid = self.create_regular_grid_3d()
+                grid.flags.writeable = False
+                self._regular_grid_cache = (extent, resolution, grid)
+            return self._regular_grid_cache[2]
+
+        @grid.setter
+        def grid(self, new_grid):
+            self._grid = new_grid
+            self._regular_grid_cache = None
+
+        @property
+        def regular(self):
+            """
+            Returns:
+                bool: If the grid is the regular 3D grid given by the extent and resolution
+            """
+            return self._grid is None
+
+        @property
+        def n_points(self):
+            """
+            Returns:
+                int: Number of points of the grid
+            """
+            if self._grid is None:
+                return int(np.prod(self._grid_res))
+            return self._grid.shape[0]
+
+        def axes(self):
+            """
+            Coordinates of the nodes of the regular grid along every axis
+
+            Returns:
+                list: numpy.ndarray with the x, y and z coordinates
+            """
+            return [np.linspace(self._grid_ext[2 * i], self._grid_ext[2 * i + 1], self._grid_res[i], dtype="float32")
+                    for i in range(3)]
+
+        def points(self, indices=slice(None)):
+            """
+            Coordinates of some points of the grid. For a regular grid only these points are generated
+
+            Args:
+                indices (slice or numpy.array): Points of the grid
+
+            Returns:
+                numpy.ndarray: Coordinates. Shape (n, 3)
+            """
+            if self._grid is not None:
+                return self._grid[indices]
+
+            if isinstance(indices, slice):
+                indices = np.arange(*indices.indices(self.n_points))
+            ix, iy, iz = np.unravel_index(indices, self._grid_res)
+            x, y, z = self.axes()
+            return np.stack((x[ix], y[iy], z[iz]), axis=1)
+
         def create_regular_grid_3d(self):
             """
             Method to create a 3D regular grid where is interpolated
@@ -575,11 +670,7 @@ class InputData(object):
                 numpy.ndarray: Unraveled 3D numpy array where every row correspond to the xyz coordinates of a regular grid
             """
 
-            g = np.meshgrid(
-                np.linspace(self._grid_ext[0], self._grid_ext[1], self._grid_res[0], dtype="float32"),
-                np.linspace(self._grid_ext[2], self._grid_ext[3], self._grid_res[1], dtype="float32"),
-                np.linspace(self._grid_ext[4], self._grid_ext[5], self._grid_res[2], dtype="float32"), indexing="ij"
-            )
+            g = np.meshgrid(*self.axes(), indexing="ij")
 
           #  self.grid = np.vstack(map(np.ravel, g)).T.astype("float32")
             return np.vstack(map(np.ravel, g)).T.astype("float32")
@@ -599,6 +690,8 @@ class InputData(object):
         """
 
         def __init__(self, _data_scaled, _grid_scaled=None, *args, **kwargs):
+            import theano
+            from gempy import theanograf
 
             # verbose is a list of strings. See theanograph
             verbose = kwargs.get('verbose', [0])
@@ -848,12 +941,15 @@ class InputData(object):
             # Asserting that the drift grade is in this range
            # assert (0 <= all(u_grade) <= 2)
 
+            # The coordinates of a regular grid are generated every time grid is accessed
+            grid = self._grid_scaled.grid
+
             # Creating the drift matrix. TODO find the official name of this matrix?
-            _universal_matrix = np.vstack((self._grid_scaled.grid.T,
-                                           (self._grid_scaled.grid ** 2).T,
-                                           self._grid_scaled.grid[:, 0] * self._grid_scaled.grid[:, 1],
-                                           self._grid_scaled.grid[:, 0] * self._grid_scaled.grid[:, 2],
-                                           self._grid_scaled.grid[:, 1] * self._grid_scaled.grid[:, 2]))
+            _universal_matrix = np.vstack((grid.T,
+                                           (grid ** 2).T,
+                                           grid[:, 0] * grid[:, 1],
+                                           grid[:, 0] * grid[:, 2],
+                                           grid[:, 1] * grid[:, 2]))
 
             # Setting shared variables
             # Range
@@ -874,12 +970,12 @@ class InputData(object):
                 # self.tg.c_resc.set_value(1)
 
             # Just grid. I add a small number to avoid problems with the origin point
-            self.tg.grid_val_T.set_value(np.cast[self.dtype](self._grid_scaled.grid + 10e-6))
+            self.tg.grid_val_T.set_value(np.cast[self.dtype](grid + 10e-6))
             # Universal grid
             self.tg.universal_grid_matrix_T.set_value(np.cast[self.dtype](_universal_matrix + 1e-10))
 
             # Initialization of the block model
-            self.tg.final_block.set_value(np.zeros((1, self._grid_scaled.grid.shape[0]), dtype='float32'))
+            self.tg.final_block.set_value(np.zeros((1, grid.shape[0]), dtype='float32'))
 
             # Initialization of the boolean array that represent the areas of the block model to be computed in the
             # following series
@@ -920,14 +1016,137 @@ class InputData(object):
                 print('Number of points per formation (rest)', self.tg.number_of_points_per_formation_T.get_value())
 
 
+class RescaledGrid(object):
+    """
+    Grid of an InputData in the rescaled coordinates of the interpolator (see InterpolatorInput.rescale_data). The
+    coordinates are not copied: the affine transform (x - centers) / rescaling_factor + 0.5001 is applied on demand to
+    the points that are needed, in chunks when the grid is passed to theano (see
+    InterpolatorInput.InterpolatorClass.grid_to_theano)
+
+    Args:
+        grid (InputData.GridClass): Grid in the real scale
+        centers (numpy.array): Center of the data in the real scale
+        rescaling_factor (float): Rescaling factor
+    """
+    def __init__(self, grid, centers, rescaling_factor):
+        self.real_grid = grid
+        self.centers = np.asarray(centers, dtype='float64')
+        self.rescaling_factor = rescaling_factor
+
+    @property
+    def _grid_ext(self):
+        # Extent and resolution of the grid in the real scale
+        return self.real_grid._grid_ext
+
+    @property
+    def _grid_res(self):
+        return self.real_grid._grid_res
+
+    @property
+    def n_points(self):
+        """
+        Returns:
+            int: Number of points of the grid
+        """
+        return self.real_grid.n_points
+
+    @property
+    def regular(self):
+        """
+        Returns:
+            bool: If the grid is the regular 3D grid given by the extent and resolution (see InputData.GridClass)
+        """
+        return getattr(self.real_grid, 'regular', False)
+
+    def axes(self):
+        """
+        Returns:
+            list: Rescaled coordinates of the nodes of the regular grid along x, y and z
+        """
+        # In float64 as the points (see rescale)
+        return [(axis.astype('float64') - self.centers[i]) / self.rescaling_factor + 0.5001
+                for i, axis in enumerate(self.real_grid.axes())]
+
+    def rescale(self, points):
+        """
+        Args:
+            points (numpy.array): Coordinates in the real scale. Shape (n, 3)
+
+        Returns:
+            numpy.array: Rescaled coordinates
+        """
+        return (points - self.centers) / self.rescaling_factor + 0.5001
+
+    def points(self, indices=slice(None)):
+        """
+        Rescaled coordinates of some points of the grid
+
+        Args:
+            indices (slice or numpy.array): Points of the grid
+
+        Returns:
+            numpy.array: Rescaled coordinates. Shape (n, 3)
+        """
+        return self.rescale(self.real_grid.points(indices))
+
+    @property
+    def grid(self):
+        """
+        Returns:
+            numpy.array: Rescaled coordinates of all the points. They are not kept, so the rescaled array is created
+            on every access. Use points for a part of the grid and n_points for its size
+        """
+        return self.points()
+
+
 class InterpolatorInput:
     def __init__(self, geo_data, compile_theano=True, compute_all=True, u_grade=None, rescaling_factor=None, **kwargs):
+        from gempy import function_cache
+
         # TODO add all options before compilation in here. Basically this is n_faults, n_layers, verbose, dtype, and \
         # only block or all
         assert isinstance(geo_data, InputData), 'You need to pass a InputData object'
         # Here we can change the dtype for stability and GPU vs CPU
         self.dtype = kwargs.get('dtype', 'float32')
+        # Return only the block after the last series instead of the block after every series
+        self.only_last = kwargs.get('only_last', False)
+        self.compute_all = compute_all
+
+        # Number of threads to compute the lithology series in parallel (see compute_series_parallel). True uses all
+        # the cores. False computes the series sequentially in th_fn
+        self.parallel_series = kwargs.get('parallel_series', False)
+
+        # Functions to compute the kriging weights and to evaluate the model at any point given the weights. They are
+        # compiled the first time they are needed
+        self.th_fn_weights = None
+        self.th_fn_evaluate = None
+
+        # Functions to compute the faults block and every lithology series on its own (see compute_series_parallel).
+        # One copy of the series function per thread since a theano function keeps its own storage
+        self.th_fn_faults = None
+        self.th_fn_series = []
+
+        # Function to compute N realizations of the input data in one call (see compute_ensemble)
+        self.th_fn_ensemble = None
 
+        # Functions of every stage of a series to instrument the computation (see compute_model_instrumented)
+        self.th_fn_stages = None
+
+        # Directory of the on disk cache of compiled functions (see function_cache). Default the environment
+        # variable GEMPY_CACHE_DIR. If neither is given the functions are always compiled
+        self.cache_dir = kwargs.get('cache_dir', function_cache.default_cache_dir())
+
+        # Cache of the dual kriging parameters and the hash of the input they were computed with
+        self._kriging_weights = None
+        self._kriging_weights_key = None
+
+        # Mask of the nodes of the grid evaluated by the last compute_model_adaptive
+        self.adaptive_evaluated = None
+
+        # Blocks of the faults and of every lithology series of the last compute_model_incremental by the key of
+        # their input (see series_keys), and which series that call computed
+        self._series_blocks = {}
+        self.series_recomputed = None
 
         #self.in_data = self.rescale_data(geo_data, rescaling_factor=rescaling_factor)
         # Set some parameters. TODO posibly this should go in kwargs
@@ -942,22 +1161,26 @@ class InterpolatorInput:
         self.data = self.rescale_data(geo_data, rescaling_factor=rescaling_factor)
 
         # Creating interpolator class with all the precompilation options
-        self.interpolator = self.set_interpolator(**kwargs)
+        self.interpolator = self.set_interpolator(compute_all=compute_all, **kwargs)
 
         if compile_theano:
-            self.th_fn = self.compile_th_fn(compute_all=compute_all)
+            self.th_fn = self.compile_th_fn(compute_all=compute_all, only_last=self.only_last)
 
     # DEP all options since it goes in set_interpolator
-    def compile_th_fn(self, compute_all=True, dtype=None, u_grade=None, **kwargs):
+    def compile_th_fn(self, compute_all=True, dtype=None, u_grade=None, only_last=False, **kwargs):
         """
 
         Args:
             geo_data:
+            only_last (bool): If True the function returns only the final block instead of the block after every
+                series and only the last state of the loops is kept in memory
             **kwargs:
 
         Returns:
 
         """
+        import theano
+        from gempy import function_cache
 
         # Choosing float precision for the computation
 
@@ -976,14 +1199,732 @@ class InterpolatorInput:
         # This prepares the user data to the theano function
         # input_data_P = data_interp.interpolator.data_prep(u_grade=u_grade)
 
+        # A function compiled before for the same graph structure is loaded from disk. The factorizations of a
+        # stateful solver have to stay in the Op of the interpolator so those functions are not cached
+        cached = not self.interpolator.tg.kriging_solver.stateful
+        if cached:
+            key = function_cache.cache_key(self.graph_structure(compute_all=compute_all, only_last=only_last))
+            th_fn = function_cache.load(self.interpolator.tg, key, cache_dir=self.cache_dir)
+            if th_fn is not None:
+                self.interpolator.tg.regular_grid_built |= self.interpolator.tg.regular_grid
+                return th_fn
+
         # then we compile we have to pass the number of formations that are faults!!
         th_fn = theano.function(input_data_T, self.interpolator.tg.whole_block_model(self.data.n_faults,
-                                                                                     compute_all=compute_all),
+                                                                                     compute_all=compute_all,
+                                                                                     only_last=only_last),
+                                mode=self.interpolator.tg.compile_mode(only_last=only_last),
+                                on_unused_input='ignore',
+                                allow_input_downcast=False,
+                                profile=False)
+        if cached:
+            function_cache.save(th_fn, self.interpolator.tg, key, cache_dir=self.cache_dir)
+        return th_fn
+
+    def graph_structure(self, compute_all=True, only_last=False):
+        """
+        Parameters that define the graph of th_fn, i.e. everything but the data. Two interpolators with the same
+        structure can share the compiled function (see function_cache)
+
+        Args:
+            compute_all (bool): see compile_th_fn
+            only_last (bool): see compile_th_fn
+
+        Returns:
+            dict: structure of the graph
+        """
+        tg = self.interpolator.tg
+        return {'n_faults': int(self.data.n_faults),
+                'n_series': int(self.data.interfaces['series'].nunique()),
+                'compute_all': bool(compute_all),
+                'only_last': bool(only_last),
+                'dtype': str(tg.dtype),
+                'verbose': [str(v) for v in tg.verbose],
+                'chunk_evaluation': bool(tg.chunk_evaluation),
+                'neighbour_evaluation': bool(tg.neighbour_evaluation),
+                'regular_grid': bool(tg.regular_grid),
+                'segmentation': tg.segmentation,
+                'kriging_solver': str(tg.kriging_solver)}
+
+    def compile_th_fn_weights(self):
+        """
+        Compile the theano function that computes the dual kriging parameters of all the series. The kriging systems
+        do not depend on the grid so the function is compiled with an empty grid
+
+        Returns:
+            theano.compile.function_module.Function: Compiled function
+        """
+        import theano
+        import theano.tensor as T
+
+        tg = self.interpolator.tg
+        empty_grid = {tg.grid_val_T: T.zeros((0, 3), dtype=tg.grid_val_T.dtype),
+                      tg.universal_grid_matrix_T: T.zeros((9, 0), dtype=tg.universal_grid_matrix_T.dtype),
+                      tg.final_block: T.zeros((1, 0), dtype=tg.final_block.dtype)}
+
+        with tg.explicit_grid():
+            weights = tg.kriging_weights(self.data.n_faults)
+
+        th_fn = theano.function(tg.input_parameters_list(), weights,
+                                givens=empty_grid,
+                                on_unused_input='ignore',
+                                allow_input_downcast=False,
+                                profile=False)
+        return th_fn
+
+    def compile_th_fn_evaluate(self):
+        """
+        Compile the theano function that computes the model at given points using precomputed dual kriging
+        parameters. The inputs are the input data (see get_input_data), the weights (see get_kriging_weights), the
+        points to interpolate and their universal drift terms (see InterpolatorClass.grid_to_theano)
+
+        Returns:
+            theano.compile.function_module.Function: Compiled function
+        """
+        import theano
+        import theano.tensor as T
+
+        tg = self.interpolator.tg
+        weights = T.vector('Dual kriging parameters', dtype=tg.weights_dtype)
+        grid_val = T.matrix('Coordinates of the points to interpolate', dtype=tg.grid_val_T.dtype)
+        universal_grid_matrix = T.matrix('Universal terms of the points to interpolate',
+                                         dtype=tg.universal_grid_matrix_T.dtype)
+        given_grid = {tg.grid_val_T: grid_val,
+                      tg.universal_grid_matrix_T: universal_grid_matrix,
+                      tg.final_block: T.zeros((1, grid_val.shape[0]), dtype=tg.final_block.dtype)}
+
+        with tg.explicit_grid():
+            block = tg.whole_block_model(self.data.n_faults, compute_all=self.compute_all, only_last=self.only_last,
+                                         weights=weights)
+
+        th_fn = theano.function(tg.input_parameters_list() + [weights, grid_val, universal_grid_matrix], block,
+                                givens=given_grid,
+                                mode=tg.compile_mode(only_last=self.only_last),
+                                on_unused_input='ignore',
+                                allow_input_downcast=False,
+                                profile=False)
+        return th_fn
+
+    def compile_th_fn_series(self):
+        """
+        Compile the theano functions that compute the faults block and the block of one lithology series independently
+        of the others (see TheanoGraph_pro.single_series_block). The inputs of the series function are the input data
+        (see get_input_data), the index of the series and the faults block if there are faults
+
+        Returns:
+            theano.compile.function_module.Function: Compiled function of the faults block. None without faults
+
+            theano.compile.function_module.Function: Compiled function of a series. It returns a list with the block
+        """
+        import theano
+        import theano.tensor as T
+
+        tg = self.interpolator.tg
+        n_faults = self.data.n_faults
+
+        th_fn_faults = None
+        fault_matrix = None
+        series_input = [T.iscalar('Index of the lithology series')]
+        if n_faults != 0:
+            tg.whole_block_model(n_faults, compute_all=False)
+            th_fn_faults = theano.function(tg.input_parameters_list(), tg.fault_matrix,
+                                           on_unused_input='ignore',
+                                           allow_input_downcast=False,
+                                           profile=False)
+
+            fault_matrix = T.matrix('Faults block', dtype=tg.dtype)
+            series_input.append(fault_matrix)
+
+        # The output is a list because the copies of a function (one per thread) always return a list
+        th_fn_series = theano.function(tg.input_parameters_list() + series_input,
+                                       [tg.single_series_block(series_input[0], n_faults,
+                                                               compute_all=self.compute_all,
+                                                               fault_matrix=fault_matrix)],
+                                       on_unused_input='ignore',
+                                       allow_input_downcast=False,
+                                       profile=False)
+        return th_fn_faults, th_fn_series
+
+    def compute_series_parallel(self, u_grade=None, n_threads=None):
+        """
+        Compute the model with the lithology series in parallel. Every series is solved and evaluated at the whole
+        grid in its own thread and the blocks are merged afterwards in stratigraphic order: every series fills only
+        the cells that the younger series left empty, as in th_fn. The faults are computed first since they are a drift
+        of the series. Every thread calls its own copy of the compiled function with its own copy of the input data,
+        so no storage is shared between threads. The threads only run in parallel while the ops release the GIL (BLAS
+        and LAPACK calls of the C linker), not in the elementwise or python ops, so the speedup over th_fn is not
+        guaranteed. Measure it for a model with benchmarks/bench_parallel_series.py
+
+        Args:
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+            n_threads (int): Number of threads. Default parallel_series or the number of cores
+
+        Returns:
+            numpy.array: Same result than th_fn
+        """
+        n_faults = self.data.n_faults
+        n_series = len(self.interpolator.tg.len_series_f.get_value()) - 1 - n_faults
+        input_data = self.get_input_data(u_grade=u_grade)
+
+        if n_series == 0:
+            return self.th_fn(*input_data)
+
+        if not n_threads:
+            n_threads = self.parallel_series if self.parallel_series is not True else cpu_count()
+        n_threads = max(1, min(int(n_threads), n_series))
+
+        if not self.th_fn_series:
+            self.th_fn_faults, th_fn_series = self.compile_th_fn_series()
+            self.th_fn_series = [th_fn_series]
+        while len(self.th_fn_series) < n_threads:
+            self.th_fn_series.append(self.th_fn_series[0].copy())
+
+        fault_block = [self.th_fn_faults(*input_data)] if n_faults != 0 else []
+
+        def compute_series(n_thread):
+            th_fn_series = self.th_fn_series[n_thread]
+            thread_input = [np.array(i, copy=True) for i in input_data + fault_block]
+            # The output storage of the function is reused in the next call
+            return [np.array(th_fn_series(*thread_input[:len(input_data)] + [np.int32(series)] +
+                                          thread_input[len(input_data):])[0], copy=True)
+                    for series in range(n_thread, n_series, n_threads)]
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            blocks_per_thread = list(pool.map(compute_series, range(n_threads)))
+        blocks = [blocks_per_thread[series % n_threads][series // n_threads] for series in range(n_series)]
+
+        return self.merge_series(blocks)
+
+    def merge_series(self, blocks):
+        """
+        Merge the blocks of the lithology series computed on their own (see TheanoGraph_pro.single_series_block) in
+        stratigraphic order: every series fills only the cells that the younger series left empty, as in th_fn
+
+        Args:
+            blocks (list): numpy.array with the block of every lithology series
+
+        Returns:
+            numpy.array: Same result than th_fn
+        """
+        n_faults = self.data.n_faults
+        final_block = np.zeros_like(blocks[0])
+        all_series = []
+        for block in blocks:
+            if self.interpolator.tg.segmentation == 'sigmoid':
+                yet_simulated = final_block[0] < 0.5
+            else:
+                yet_simulated = final_block[0] == 0
+            final_block[:, yet_simulated] = block[:, yet_simulated]
+            if self.compute_all and n_faults != 0:
+                final_block[2] = block[2]
+            all_series.append(final_block.copy())
+
+        if self.only_last:
+            return all_series[-1]
+        return np.array(all_series)
+
+    def series_keys(self, input_data):
+        """
+        Hash of everything the block of every series depends on: its rows of the input data, the shared parameters
+        of the kriging systems, the grid and the slope of the segmentation. The lithology series also depend on the
+        faults, so their keys include the key of the faults
+
+        Args:
+            input_data (list): Arrays of get_input_data
+
+        Returns:
+            str: Key of the faults block. None without faults
+
+            list: Key of every lithology series
+        """
+        tg = self.interpolator.tg
+        n_faults = self.data.n_faults
+        len_series_i, len_series_f = tg.len_series_i.get_value(), tg.len_series_f.get_value()
+
+        def rows(first, last):
+            dips = slice(len_series_f[first], len_series_f[last])
+            interfaces = slice(len_series_i[first], len_series_i[last])
+            return [i[dips] for i in input_data[:4]] + [i[interfaces] for i in input_data[4:]]
+
+        common = [np.array(str(self.interpolator.grid_key)), tg.sig_slope.get_value()]
+        faults_key = None
+        if n_faults != 0:
+            faults_key = self.interpolator.hash_kriging_input(rows(0, n_faults) + common, n_faults=n_faults)
+
+        series_keys = [self.interpolator.hash_kriging_input(rows(i, i + 1) + common + [np.array([i]),
+                                                                                       np.array(str(faults_key))],
+                                                            n_faults=n_faults)
+                       for i in range(n_faults, len(len_series_f) - 1)]
+        return faults_key, series_keys
+
+    def compute_model_incremental(self, u_grade=None):
+        """
+        Compute the model again only for the series whose input changed since the last call (see series_keys). The
+        other series take their block from the previous call, so neither their kriging system is solved nor the grid
+        evaluated. If the faults change all the series are computed. The series are computed on their own and merged
+        as in compute_series_parallel. With the incremental solver the series that changed update the factorization
+        of their covariance matrix (see kriging_solvers.IncrementalKrigingSolve)
+
+        Args:
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Same result than th_fn. Which series were computed (faults first) is in
+            self.series_recomputed
+        """
+        n_faults = self.data.n_faults
+        input_data = self.get_input_data(u_grade=u_grade)
+        faults_key, series_keys = self.series_keys(input_data)
+
+        if not series_keys:
+            self.series_recomputed = [True] * n_faults
+            return self.th_fn(*input_data)
+
+        if not self.th_fn_series:
+            self.th_fn_faults, th_fn_series = self.compile_th_fn_series()
+            self.th_fn_series = [th_fn_series]
+
+        cached = self._series_blocks
+        blocks = {}
+        fault_block = []
+        self.series_recomputed = []
+        if n_faults != 0:
+            self.series_recomputed += [faults_key not in cached] * n_faults
+            if faults_key not in cached:
+                cached[faults_key] = np.array(self.th_fn_faults(*input_data), copy=True)
+            blocks[faults_key] = cached[faults_key]
+            fault_block = [blocks[faults_key]]
+
+        for series, key in enumerate(series_keys):
+            self.series_recomputed.append(key not in cached)
+            if key not in cached:
+                # The output storage of the function is reused in the next call
+                cached[key] = np.array(self.th_fn_series[0](*input_data + [np.int32(series)] + fault_block)[0],
+                                       copy=True)
+            blocks[key] = cached[key]
+
+        # Only the blocks of the current data are kept
+        self._series_blocks = blocks
+        return self.merge_series([blocks[key] for key in series_keys])
+
+    def compile_th_fn_ensemble(self):
+        """
+        Compile the theano function that computes the lithology block of N realizations of the input data in one call
+        (see TheanoGraph_pro.ensemble_block_model). The inputs are the input data (see get_input_data) with a leading
+        axis of realizations
+
+        Returns:
+            theano.compile.function_module.Function: Compiled function
+        """
+        import theano
+
+        tg = self.interpolator.tg
+        input_data_ensemble_T, lithology_ensemble = tg.ensemble_block_model(self.data.n_faults)
+
+        th_fn = theano.function(input_data_ensemble_T, lithology_ensemble,
+                                mode=tg.compile_mode(only_last=True),
                                 on_unused_input='ignore',
                                 allow_input_downcast=False,
                                 profile=False)
         return th_fn
 
+    def compute_ensemble(self, input_data_ensemble, u_grade=None):
+        """
+        Lithology block of N realizations of the input data in one compiled call. Each realization costs the same
+        as th_fn, only the python overhead of N separate calls is saved. The grid kernels are computed again for
+        every realization (see TheanoGraph_pro.ensemble_block_model)
+
+        Args:
+            input_data_ensemble (list): The 6 arrays of get_input_data (dips position, dip angles, azimuth, polarity,
+                reference and rest points). Every array either has a leading axis with the N realizations or is the
+                same for all the realizations
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Lithology block of every realization. Shape (N, n_grid)
+        """
+        # The shared parameters (number of points per series...) are set from the current data
+        input_data = self.get_input_data(u_grade=u_grade)
+        input_data_ensemble = [np.asarray(i, dtype=single.dtype) for i, single in zip(input_data_ensemble, input_data)]
+
+        n_realizations = max(i.shape[0] for i, single in zip(input_data_ensemble, input_data)
+                             if i.ndim == single.ndim + 1)
+        input_data_ensemble = [i if i.ndim == single.ndim + 1 else
+                               np.ascontiguousarray(np.broadcast_to(i, (n_realizations,) + i.shape))
+                               for i, single in zip(input_data_ensemble, input_data)]
+
+        if self.th_fn_ensemble is None:
+            self.th_fn_ensemble = self.compile_th_fn_ensemble()
+
+        return self.th_fn_ensemble(*input_data_ensemble)
+
+    def compile_th_fn_stages(self):
+        """
+        Compile a theano function per stage of a series: covariance matrix and b vector, kriging solve, potential
+        field at the grid and segmentation. Every function takes the input data, the index of the series, the block
+        before the series and the output of the previous stage (see theanograf.TheanoGraph_pro.series_stages). The
+        lithology functions also take the faults block if there are faults
+
+        Returns:
+            dict: {'fault': functions, 'lithology': functions}. The functions are a dict with the keys covariance, solve,
+            evaluation and segmentation
+        """
+        import theano
+        import theano.tensor as T
+
+        tg = self.interpolator.tg
+        n_faults = self.data.n_faults
+        th_fn_stages = {}
+
+        for kind in (['fault'] if n_faults != 0 else []) + ['lithology']:
+            series = T.iscalar('Index of the series')
+            final_block = T.matrix('Block before the series', dtype=tg.dtype)
+            inputs = tg.input_parameters_list() + [series, final_block]
+            fault_matrix = None
+            if kind == 'lithology' and n_faults != 0:
+                fault_matrix = T.matrix('Faults block', dtype=tg.dtype)
+                inputs.append(fault_matrix)
+
+            block, stages = tg.series_stages(series, n_faults, compute_all=self.compute_all, fault=kind == 'fault',
+                                             final_block=final_block, fault_matrix=fault_matrix)
+            C_matrix, b, weights, Z_x = [stages[k] for k in ('covariance_matrix', 'b_vector', 'weights',
+                                                             'potential_field')]
+            C_matrix_in, b_in, weights_in, Z_x_in = C_matrix.type(), b.type(), weights.type(), Z_x.type()
+
+            def compile_stage(extra_inputs, output, givens):
+                return theano.function(inputs + extra_inputs, output, givens=givens,
+                                       mode=tg.compile_mode(),
+                                       on_unused_input='ignore',
+                                       allow_input_downcast=False)
+
+            th_fn_stages[kind] = {
+                'covariance': compile_stage([], [C_matrix, b], []),
+                'solve': compile_stage([C_matrix_in, b_in], weights, [(C_matrix, C_matrix_in), (b, b_in)]),
+                'evaluation': compile_stage([weights_in], Z_x, [(weights, weights_in)]),
+                'segmentation': compile_stage([Z_x_in], block, [(Z_x, Z_x_in)])}
+
+        return th_fn_stages
+
+    def compute_model_instrumented(self, u_grade=None):
+        """
+        Compute the model stage by stage recording the wall time, the peak memory and the size of the arrays of every
+        stage: data_prep, upload of the shared variables (only if the input data changed, see
+        InterpolatorClass.data_prep) and, per series, covariance, solve, evaluation and segmentation (see
+        instrumentation.ModelReport). The stages are the same operations than in th_fn, only
+        compiled in separate functions (see compile_th_fn_stages), so the result is the same than th_fn. The times
+        and memory are the ones of those functions, not of th_fn: a th_fn call, as in compute_model, keeps the
+        intermediate arrays inside a single graph and can be faster and use less memory than the sum of the stages
+
+        Args:
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Same result than th_fn
+
+            gempy.instrumentation.ModelReport: Record of every stage
+        """
+        from gempy import instrumentation
+
+        if self.th_fn_stages is None:
+            self.th_fn_stages = self.compile_th_fn_stages()
+
+        tg = self.interpolator.tg
+        report = instrumentation.ModelReport()
+
+        with report.record('data_prep') as entry, instrumentation.record_uploads(self.interpolator, entry):
+            input_data = self.get_input_data(u_grade=u_grade)
+            entry['arrays'] = {i.name: data for i, data in zip(tg.input_parameters_list(), input_data)}
+
+        n_faults = self.data.n_faults
+        n_series = len(tg.len_series_f.get_value()) - 1
+        series_names = list(self.data.series.columns)
+        if len(series_names) != n_series:
+            series_names = [str(i) for i in range(n_series)]
+
+        n_grid = tg.final_block.get_value().shape[1]
+        fault_block = np.zeros((1, n_grid + 2 * input_data[5].shape[0]), dtype=tg.dtype)
+        lithology_block = np.tile(tg.final_block.get_value(), (3 if self.compute_all else 1, 1))
+        all_series = []
+
+        for i in range(n_series):
+            fault = i < n_faults
+            th_fn = self.th_fn_stages['fault' if fault else 'lithology']
+            series_input = input_data + [np.int32(i), fault_block if fault else lithology_block]
+            if not fault and n_faults != 0:
+                series_input.append(fault_block)
+
+            with report.record('covariance', series_names[i], fault) as entry:
+                C_matrix, b = th_fn['covariance'](*series_input)
+                entry['arrays'] = {'covariance_matrix': C_matrix, 'b_vector': b}
+            with report.record('solve', series_names[i], fault) as entry:
+                weights = th_fn['solve'](*series_input + [C_matrix, b])
+                entry['arrays'] = {'weights': weights}
+            with report.record('evaluation', series_names[i], fault) as entry:
+                Z_x = th_fn['evaluation'](*series_input + [weights])
+                entry['arrays'] = {'potential_field': Z_x}
+            with report.record('segmentation', series_names[i], fault) as entry:
+                block = th_fn['segmentation'](*series_input + [Z_x])
+                entry['arrays'] = {'block': block}
+
+            if fault:
+                fault_block = block
+            else:
+                lithology_block = block
+                all_series.append(block)
+
+        if not all_series:
+            return fault_block, report
+        if self.only_last:
+            return all_series[-1], report
+        return np.array(all_series), report
+
+    def get_kriging_weights(self, u_grade=None, input_data=None):
+        """
+        Dual kriging parameters of every series. They are cached and only computed again when the input data or the
+        kriging parameters change
+
+        Args:
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+            input_data (list): Arrays of get_input_data if the caller already prepared them. Default None (they are
+                prepared here)
+
+        Returns:
+            list: numpy.array with the dual kriging parameters of every series
+        """
+        if input_data is None:
+            input_data = self.get_input_data(u_grade=u_grade)
+        key = self.interpolator.hash_kriging_input(input_data, n_faults=self.data.n_faults)
+
+        if key != self._kriging_weights_key:
+            if self.th_fn_weights is None:
+                self.th_fn_weights = self.compile_th_fn_weights()
+            self._kriging_weights = self.th_fn_weights(*input_data)
+            self._kriging_weights_key = key
+
+        len_series_w = self.interpolator.tg.len_series_w.get_value()
+        return np.split(self._kriging_weights, len_series_w[1:-1])
+
+    def evaluate(self, points, u_grade=None):
+        """
+        Compute the model at arbitrary points reusing the dual kriging parameters (see get_kriging_weights), i.e.
+        without solving the kriging systems again
+
+        Args:
+            points (numpy.array): Coordinates of the points to interpolate in the real scale. Shape (n, 3)
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Block model (and potential fields if compute_all) at the points with the same layout than
+            th_fn
+        """
+        input_data = self.get_input_data(u_grade=u_grade)
+        self.get_kriging_weights(input_data=input_data)
+
+        points_rescaled = self.data.grid.rescale(np.asarray(points))
+        grid_val, universal_grid_matrix = self.interpolator.grid_to_theano(points_rescaled)
+
+        if self.th_fn_evaluate is None:
+            self.th_fn_evaluate = self.compile_th_fn_evaluate()
+
+        return self.th_fn_evaluate(*input_data + [self._kriging_weights, grid_val, universal_grid_matrix])
+
+    def section_points(self, cell_number=None, direction='y', plane=None, resolution=(50, 50)):
+        """
+        Coordinates of the points of a 2D section. Either a section of the regular grid perpendicular to a cartesian
+        direction, with the same nodes than the grid, or an arbitrary plane
+
+        Args:
+            cell_number (int): Position of the section in the grid along direction. Required if plane is None
+            direction (str): x, y or z. Direction perpendicular to the section of the grid
+            plane (list): [origin, u, v]. Arbitrary plane from the point origin spanned by the vectors u and v in the
+                real scale. If given cell_number and direction are ignored
+            resolution (list): Number of points of the plane along u and v
+
+        Returns:
+            numpy.array: Coordinates of the points in the real scale. Shape (n, 3)
+
+            tuple: Shape of the section. For the sections of the grid the axes are in the order x, y, z without the
+            direction, as PlotData.plot_block_section slices the block
+        """
+        if plane is not None:
+            origin, u, v = (np.asarray(p, dtype='float64') for p in plane)
+            s, t = np.meshgrid(np.linspace(0, 1, resolution[0]), np.linspace(0, 1, resolution[1]), indexing='ij')
+            points = origin + s.reshape(-1, 1) * u + t.reshape(-1, 1) * v
+            return points, tuple(resolution)
+
+        assert direction in ('x', 'y', 'z'), str(direction) + ' must be a cartesian direction, i.e. xyz'
+        assert isinstance(cell_number, (int, np.integer)), 'cell_number must be an int for a section of the grid'
+        # Same nodes than the grid (see GridClass.axes)
+        axes = self.interpolator._grid_scaled.axes()
+        axes['xyz'.index(direction)] = axes['xyz'.index(direction)][[cell_number]]
+        points = np.vstack([a.ravel() for a in np.meshgrid(*axes, indexing="ij")]).T.astype("float32")
+        shape = tuple(len(a) for i, a in enumerate(axes) if i != 'xyz'.index(direction))
+        return points, shape
+
+    def compute_section(self, cell_number=None, direction='y', plane=None, resolution=(50, 50), u_grade=None):
+        """
+        Compute the model only at a 2D section (see section_points) reusing the dual kriging parameters (see
+        evaluate), so a section costs the evaluation of its points instead of the whole grid
+
+        Args:
+            cell_number (int): Position of the section in the grid along direction. Required if plane is None
+            direction (str): x, y or z. Direction perpendicular to the section of the grid
+            plane (list): [origin, u, v]. Arbitrary plane from the point origin spanned by the vectors u and v in the
+                real scale
+            resolution (list): Number of points of the plane along u and v
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Block model (and potential fields if compute_all) with the same layout than th_fn but the
+            points axis reshaped to the shape of the section
+        """
+        points, shape = self.section_points(cell_number=cell_number, direction=direction, plane=plane,
+                                            resolution=resolution)
+        return self.evaluate_shaped(points, shape, u_grade=u_grade)
+
+    def dem_points(self, dem, extent=None):
+        """
+        Coordinates of the nodes of a digital elevation model
+
+        Args:
+            dem (numpy.array): Elevation of the nodes of a regular 2D grid. Shape (nx, ny), i.e. the first axis is x as
+                in the grid of the model
+            extent (list): [x_min, x_max, y_min, y_max] of the nodes of the DEM. Default the extent of the model
+
+        Returns:
+            numpy.array: Coordinates of the nodes in the real scale. Shape (nx * ny, 3)
+        """
+        dem = np.asarray(dem)
+        assert dem.ndim == 2, 'The DEM has to be a 2D array (nx, ny)'
+        if extent is None:
+            extent = self.interpolator._grid_scaled._grid_ext[:4]
+
+        x, y = np.meshgrid(np.linspace(extent[0], extent[1], dem.shape[0]),
+                           np.linspace(extent[2], extent[3], dem.shape[1]), indexing="ij")
+        return np.vstack((x.ravel(), y.ravel(), dem.ravel())).T
+
+    def compute_geological_map(self, dem, extent=None, u_grade=None):
+        """
+        Compute the model only at the surface of a digital elevation model (see dem_points) reusing the dual kriging
+        parameters (see evaluate), so a map costs the evaluation of the nodes of the DEM instead of the whole grid
+
+        Args:
+            dem (numpy.array): Elevation of the nodes of a regular 2D grid. Shape (nx, ny)
+            extent (list): [x_min, x_max, y_min, y_max] of the nodes of the DEM. Default the extent of the model
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Block model (and potential fields if compute_all) with the same layout than th_fn but the
+            points axis reshaped to the shape of the DEM
+        """
+        return self.evaluate_shaped(self.dem_points(dem, extent=extent), np.shape(dem), u_grade=u_grade)
+
+    def evaluate_shaped(self, points, shape, u_grade=None):
+        """
+        Compute the model at arbitrary points (see evaluate) and reshape the points axis
+
+        Args:
+            points (numpy.array): Coordinates of the points to interpolate in the real scale. Shape (n, 3)
+            shape (tuple): Shape of the points, e.g. of a section or a map
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Output with the layout of th_fn and the points axis with the given shape
+        """
+        sol = self.evaluate(points, u_grade=u_grade)[..., :len(points)]
+        return sol.reshape(sol.shape[:-1] + tuple(shape))
+
+    def output_layout(self):
+        """
+        Shape of the output of th_fn without the axis of the points. Every lithology series (only the last one if
+        only_last) has a row with the lithology block and, if compute_all, a row with its potential field and one with
+        the faults block (see theanograf.TheanoGraph_pro.whole_block_model). Without lithology series the output is
+        the faults block
+
+        Returns:
+            tuple: (number of lithology series, rows) or (rows,) if only_last or there are only faults
+        """
+        n_lithologies = len(self.interpolator.tg.len_series_i.get_value()) - 1 - self.data.n_faults
+        if n_lithologies == 0:
+            return (1,)
+        layout = (3 if self.compute_all else 1,)
+        if not self.only_last:
+            layout = (n_lithologies,) + layout
+        return layout
+
+    def lithology_block(self, sol):
+        """
+        Final lithology block of an output of th_fn (or of evaluate, compute_section...)
+
+        Args:
+            sol (numpy.array): Output with the layout of th_fn (see output_layout) not squeezed
+
+        Returns:
+            numpy.array: Lithology block after the last series
+        """
+        rows = self.output_layout()[-1]
+        return sol.reshape((-1, rows) + sol.shape[len(self.output_layout()):])[-1, 0]
+
+    def potential_field(self, sol, n_pf):
+        """
+        Potential field of a series from an output of th_fn computed with compute_all
+
+        Args:
+            sol (numpy.array): Output with the layout of th_fn (see output_layout) not squeezed
+            n_pf (int): Number of the series, faults included
+
+        Returns:
+            numpy.array: Potential field of the series
+        """
+        layout = self.output_layout()
+        n_lithologies = len(self.interpolator.tg.len_series_i.get_value()) - 1 - self.data.n_faults
+        assert self.compute_all and self.data.n_faults <= n_pf < self.data.n_faults + n_lithologies, \
+            'Only the potential fields of the lithology series are computed and only with compute_all'
+        assert not self.only_last or n_pf == self.data.n_faults + n_lithologies - 1, \
+            'With only_last only the potential field of the last series is kept'
+
+        fields = sol.reshape((-1, layout[-1]) + sol.shape[len(layout):])
+        return fields[n_pf - self.data.n_faults if not self.only_last else 0, 1]
+
+    def compute_model_adaptive(self, levels=2, u_grade=None):
+        """
+        Compute the block model evaluating the grid adaptively (see octree): first every 2**levels nodes and then only
+        the cells where the lithology or the faults block change, down to the resolution of the grid. The kriging
+        systems are solved once (see get_kriging_weights).
+
+        Args:
+            levels (int): Number of levels of refinement. The coarse grid has to resolve the thinnest unit
+            u_grade (list): Grade of the drift of every series. Default self.u_grade
+
+        Returns:
+            numpy.array: Block model with the same layout than th_fn. The potential fields are only computed at the
+            evaluated nodes and are NaN elsewhere
+        """
+        from gempy import octree
+
+        input_data = self.get_input_data(u_grade=u_grade)
+        self.get_kriging_weights(input_data=input_data)
+        if self.th_fn_evaluate is None:
+            self.th_fn_evaluate = self.compile_th_fn_evaluate()
+
+        grid = self.interpolator._grid_scaled
+        assert grid.n_points == np.prod(grid._grid_res), 'The adaptive evaluation needs a regular grid'
+
+        # Only the blocks decide where to refine, not the potential fields
+        layout = self.output_layout()
+        segmented_rows = np.ones(layout, dtype=bool)
+        if layout[-1] == 3:
+            segmented_rows[..., 1] = False
+
+        def evaluate(indices):
+            grid_val, universal_grid_matrix = self.interpolator.grid_to_theano(grid.points(indices))
+            sol = self.th_fn_evaluate(*input_data + [self._kriging_weights, grid_val, universal_grid_matrix])
+            return sol.reshape(-1, sol.shape[-1])[:, :len(indices)]
+
+        block, evaluated = octree.refine_block(evaluate, grid._grid_res, levels, segmented_rows.ravel())
+        self.adaptive_evaluated = evaluated
+        return block.reshape(layout + (-1,))
+
     def rescale_data(self, geo_data, rescaling_factor=None):
         """
         Rescale the data of a DataManagement object between 0 and 1 due to stability problem of the float32.
@@ -1010,22 +1951,25 @@ class InterpolatorInput:
 
         new_coord_foliations = (geo_data.foliations[['X', 'Y', 'Z']] -
                                 centers) / rescaling_factor + 0.5001
-        try:
-            geo_data.interfaces[['X_std', 'Y_std', 'Z_std']] = (geo_data.interfaces[
-                                                                    ['X_std', 'Y_std', 'Z_std']]) / rescaling_factor
-            geo_data.foliations[['X_std', 'Y_std', 'Z_std']] = (geo_data.foliations[
-                                                                    ['X_std', 'Y_std', 'Z_std']]) / rescaling_factor
-        except KeyError:
-            pass
 
         new_coord_extent = (geo_data.extent - np.repeat(centers, 2)) / rescaling_factor + 0.5001
 
-        geo_data_rescaled = copy.deepcopy(geo_data)
+        # Only the data frames are copied. The grid is rescaled on demand (see RescaledGrid) so it is not duplicated
+        geo_data_rescaled = copy.copy(geo_data)
+        geo_data_rescaled.interfaces = geo_data.interfaces.copy()
+        geo_data_rescaled.foliations = geo_data.foliations.copy()
         geo_data_rescaled.interfaces[['X', 'Y', 'Z']] = new_coord_interfaces
         geo_data_rescaled.foliations[['X', 'Y', 'Z']] = new_coord_foliations
         geo_data_rescaled.extent = new_coord_extent.as_matrix()
+        try:
+            geo_data_rescaled.interfaces[['X_std', 'Y_std', 'Z_std']] = \
+                geo_data.interfaces[['X_std', 'Y_std', 'Z_std']] / rescaling_factor
+            geo_data_rescaled.foliations[['X_std', 'Y_std', 'Z_std']] = \
+                geo_data.foliations[['X_std', 'Y_std', 'Z_std']] / rescaling_factor
+        except KeyError:
+            pass
 
-        geo_data_rescaled.grid.grid = (geo_data.grid.grid - centers.as_matrix()) / rescaling_factor + 0.5001
+        geo_data_rescaled.grid = RescaledGrid(geo_data.grid, centers.as_matrix(), rescaling_factor)
 
         self.rescaling_factor = rescaling_factor
         geo_data_rescaled.rescaling_factor = rescaling_factor
@@ -1155,9 +2099,43 @@ class InterpolatorInput:
 
         Keyword Args:
             verbose(int): Level of verbosity during the execution of the functions (up to 5). Default 0
+            chunk_size (int): Evaluate the grid in chunks of this number of points. Default None (whole grid)
+            memory_budget (float): Bytes available to compute the model. The grid is evaluated at once if the
+                estimated peak memory fits, otherwise in the biggest chunks that fit (see memory_planner). If nothing
+                fits a MemoryError with the breakdown of the estimate is raised. Default None (no budget, the grid is
+                evaluated at once and there is only a warning if the estimate is above the physical memory)
+            compute_all (bool): If the potential field and the faults block are computed. Only used to estimate the
+                memory. Default True
+            only_last (bool): If only the block after the last series is kept. Only used to estimate the memory.
+                Default False
+            sparse_threshold (float): Maximum density of the covariance matrix to use a sparse solver. Only the solve
+                is sparse, the covariance matrix is assembled dense. Default 0.1
+            neighbour_evaluation (bool): Evaluate every chunk of the grid only with the data within the range.
+                Default False
+            solver (str): Solver of the kriging system. 'direct', 'iterative', 'incremental' or 'mixed'. The
+                incremental solver keeps the factorization of every series, so computing the model again after
+                moving a few points (e.g. interactively) only costs a low rank update. The mixed solver refines the
+                float32 solution in float64, so with dtype='float32' only the solve is in double precision.
+                Default 'direct'
+            solver_options (dict): Options of the iterative solver: method ('gmres' or 'minres'), preconditioner
+                (None, 'jacobi', 'block_jacobi' or 'ilu'), tol, maxiter, block_size and drop_tol. See
+                kriging_solvers.IterativeKrigingSolve. Options of the incremental solver: max_rank and
+                max_factorizations. See kriging_solvers.IncrementalKrigingSolve. Options of the mixed solver: tol,
+                max_refinements and fallback_tol. See kriging_solvers.MixedPrecisionKrigingSolve
+            segmentation (str): 'hard' or 'sigmoid'. The sigmoid segmentation makes the block differentiable respect
+                the input data, e.g. for gradient based samplers. Default 'hard'
+            sigmoid_slope (float): Slope of the sigmoid segmentation. It can be changed later without compiling
+                again in tg.sig_slope. Default 1000
+            regular_grid (bool): Generate the coordinates and drift terms of a regular grid in the graph from the
+                coordinates of its axes instead of uploading them (see theanograf.TheanoGraph_pro). The distances are
+                computed per axis, so the potential field differs from the explicit grid by rounding errors. Only
+                with this option the points of the grid and their drift terms are not uploaded to theano. Default
+                False
         """
 
         def __init__(self, _data_scaled, _grid_scaled=None, *args, **kwargs):
+            import theano
+            from gempy import theanograf
 
             # verbose is a list of strings. See theanograph
             verbose = kwargs.get('verbose', [0])
@@ -1172,7 +2150,39 @@ class InterpolatorInput:
             # Drift grade
             u_grade = kwargs.get('u_grade', [2, 2])
 
+            # Evaluation of the grid in chunks. Either a fixed number of points or a memory budget in bytes
+            self.chunk_size = kwargs.get('chunk_size', None)
+            self.memory_budget = kwargs.get('memory_budget', None)
+
+            # Options of the compilation that change the memory of the model
+            self.compute_all = kwargs.get('compute_all', True)
+            self.only_last = kwargs.get('only_last', False)
 
+            # Estimate of the peak memory of the model. It chooses the evaluation of the grid with the first data
+            # (see plan_memory)
+            self.memory_plan = None
+
+            # Time and size of the values given to the theano shared variables while they are recorded (see upload).
+            # None if they are not recorded
+            self.uploads = None
+
+            # Hash of the grid set by set_theano_shared_parameteres. The blocks cached per series are only valid for
+            # the same grid (see InterpolatorInput.series_keys)
+            self.grid_key = None
+
+            # Arrays prepared by data_prep and the hash of what they were prepared from (see data_prep_key)
+            self._data_prep_key = None
+            self._data_prep_cache = None
+            self._data_prep_rest_mask = None
+
+            # Rows of the interfaces that are rest points (all but the first point of every formation). Set by
+            # data_prep
+            self.pandas_rest_layer_points = None
+
+            # Evaluation of every chunk only with the data in range. Small chunks keep the neighbourhoods small
+            self.neighbour_evaluation = kwargs.get('neighbour_evaluation', False)
+            if self.neighbour_evaluation and not (self.chunk_size or self.memory_budget):
+                self.chunk_size = 500
 
             # We hide the scaled copy of DataManagement object from the user. The scaling happens in gempy what is a
             # bit weird. Maybe at some point I should bring the function to this module
@@ -1186,7 +2196,16 @@ class InterpolatorInput:
 
             # Importing the theano graph. The methods of this object generate different parts of graph.
             # See theanograf doc
-            self.tg = theanograf.TheanoGraph_pro(dtype=dtype, verbose=verbose,)
+            self.tg = theanograf.TheanoGraph_pro(dtype=dtype, verbose=verbose,
+                                                 chunk_evaluation=bool(self.chunk_size),
+                                                 sparse_threshold=kwargs.get('sparse_threshold', 0.1),
+                                                 neighbour_evaluation=self.neighbour_evaluation,
+                                                 solver=kwargs.get('solver', 'direct'),
+                                                 solver_options=kwargs.get('solver_options', None),
+                                                 segmentation=kwargs.get('segmentation', 'hard'),
+                                                 regular_grid=kwargs.get('regular_grid', False))
+            if 'sigmoid_slope' in kwargs:
+                self.upload(self.tg.sig_slope, np.cast[dtype](kwargs['sigmoid_slope']))
 
             # Sorting data in case the user provides it unordered
             self.order_table()
@@ -1194,16 +2213,24 @@ class InterpolatorInput:
             # Setting theano parameters
             self.set_theano_shared_parameteres(range_var=range_var)
 
-            # Extracting data from the pandas dataframe to numpy array in the required form for the theano function
+            # Extracting data from the pandas dataframe to numpy array in the required form for the theano function.
+            # It also checks that the model fits in memory
             self.data_prep(u_grade=u_grade)
 
-            # Avoid crashing my pc
-            import theano
-            if theano.config.optimizer != 'fast_run':
-                assert self.tg.grid_val_T.get_value().shape[0] * \
-                       np.math.factorial(len(self.tg.len_series_i.get_value())) < 2e7, \
-                       'The grid is too big for the number of potential fields. Reduce the grid or change the' \
-                       'optimization flag to fast run'
+        def upload(self, shared_variable, value, borrow=False):
+            """
+            Set the value of a theano shared variable of the graph. The time and the size of the value are appended
+            to self.uploads if they are recorded (see instrumentation.record_uploads)
+            Args:
+                shared_variable (theano.compile.SharedVariable): variable of self.tg
+                value (numpy.array): new value
+                borrow (bool): see theano.compile.SharedVariable.set_value
+            """
+            t = time.perf_counter()
+            shared_variable.set_value(value, borrow=borrow)
+            if self.uploads is not None:
+                self.uploads.append({'name': shared_variable.name, 'time': time.perf_counter() - t,
+                                     'shape': np.shape(value), 'nbytes': np.asarray(value).nbytes})
 
         def set_formation_number(self):
             """
@@ -1258,7 +2285,8 @@ class InterpolatorInput:
             """
             Ideally this method will extract the data from the pandas dataframes to individual numpy arrays to be input
             of the theano function. However since some of the shared parameters are function of these arrays shape I also
-            set them here
+            set them here. The arrays are cached and only prepared again when the interfaces, the foliations, the drift
+            or the grid change (see data_prep_key)
             Returns:
                 idl (list): List of arrays which are the input for the theano function:
                     - numpy.array: dips_position
@@ -1270,48 +2298,52 @@ class InterpolatorInput:
             """
 
             u_grade = kwargs.get('u_grade', None)
+
+            key = self.data_prep_key(u_grade)
+            if key == self._data_prep_key:
+                self.pandas_rest_layer_points = self._data_scaled.interfaces[self._data_prep_rest_mask]
+                return [xs.copy() for xs in self._data_prep_cache]
+
+            interfaces = self._data_scaled.interfaces
+            foliations = self._data_scaled.foliations
+
             # ==================
             # Extracting lengths
             # ==================
+            # The interfaces are sorted by series and formation (see order_table) so every formation and every series
+            # is a contiguous group of rows
+            def group_lengths(values):
+                if len(values) == 0:
+                    return np.zeros(0, dtype='int64')
+                boundaries = np.flatnonzero(values[1:] != values[:-1]) + 1
+                return np.diff(np.concatenate(([0], boundaries, [len(values)])))
+
             # Array containing the size of every formation. Interfaces
-            len_interfaces = np.asarray(
-                [np.sum(self._data_scaled.interfaces['formation number'] == i)
-                 for i in self._data_scaled.interfaces['formation number'].unique()])
+            len_interfaces = group_lengths(interfaces['formation number'].values)
 
             # Size of every layer in rests. SHARED (for theano)
             len_rest_form = (len_interfaces - 1)
-            self.tg.number_of_points_per_formation_T.set_value(len_rest_form)
+            self.upload(self.tg.number_of_points_per_formation_T, len_rest_form)
 
             # Position of the first point of every layer
             ref_position = np.insert(len_interfaces[:-1], 0, 0).cumsum()
 
-            # Drop the reference points using pandas indeces to get just the rest_layers array
-            pandas_rest_layer_points = self._data_scaled.interfaces.drop(ref_position)
-            self.pandas_rest_layer_points = pandas_rest_layer_points
-            # TODO: do I need this? PYTHON
-            # DEP- because per series the foliations do not belong to a formation but to the whole series
-            # len_foliations = np.asarray(
-            #     [np.sum(self._data_scaled.foliations['formation number'] == i)
-            #      for i in self._data_scaled.foliations['formation number'].unique()])
-
-            # -DEP- I think this was just a kind of print to know what was going on
-            #self.pandas_rest = pandas_rest_layer_points
+            # The rest points are all the interfaces but the reference points
+            rest_mask = np.ones(len(interfaces), dtype=bool)
+            rest_mask[ref_position] = False
+            self.pandas_rest_layer_points = interfaces[rest_mask]
 
             # Array containing the size of every series. Interfaces.
-            len_series_i = np.asarray(
-                [np.sum(pandas_rest_layer_points['order_series'] == i)
-                 for i in pandas_rest_layer_points['order_series'].unique()])
+            len_series_i = group_lengths(interfaces['order_series'].values[rest_mask])
 
             # Cumulative length of the series. We add the 0 at the beginning and set the shared value. SHARED
-            self.tg.len_series_i.set_value(np.insert(len_series_i, 0, 0).cumsum())
+            self.upload(self.tg.len_series_i, np.insert(len_series_i, 0, 0).cumsum())
 
             # Array containing the size of every series. Foliations.
-            len_series_f = np.asarray(
-                [np.sum(self._data_scaled.foliations['order_series'] == i)
-                 for i in self._data_scaled.foliations['order_series'].unique()])
+            len_series_f = group_lengths(foliations['order_series'].values)
 
             # Cumulative length of the series. We add the 0 at the beginning and set the shared value. SHARED
-            self.tg.len_series_f.set_value(np.insert(len_series_f, 0, 0).cumsum())
+            self.upload(self.tg.len_series_f, np.insert(len_series_f, 0, 0).cumsum())
 
             # =========================
             # Choosing Universal drifts
@@ -1323,30 +2355,29 @@ class InterpolatorInput:
                 u_grade[(len_series_i > 6) & (len_series_i < 12)] = 3
             print(u_grade)
             # it seems I have to pass list instead array_like that is weird
-            self.tg.u_grade_T.set_value(list(u_grade))
+            self.upload(self.tg.u_grade_T, list(u_grade))
+
+            # Length of the kriging system of every series: gradients, interfaces, drift and, for the series after
+            # the faults, the faults drift. Cumulative. SHARED
+            u_grade_series = np.zeros_like(len_series_i)
+            u_grade_series[:len(u_grade)] = np.asarray(u_grade)[:len(len_series_i)]
+            faults_drift = (np.arange(len(len_series_i)) >= self._data_scaled.n_faults) * \
+                           (self._data_scaled.n_faults > 0)
+            len_series_w = 3 * len_series_f + len_series_i + u_grade_series + faults_drift
+            self.upload(self.tg.len_series_w, np.insert(len_series_w, 0, 0).cumsum())
 
             # ================
             # Prepare Matrices
             # ================
-            # Rest layers matrix # PYTHON VAR
-            rest_layer_points = pandas_rest_layer_points[['X', 'Y', 'Z']].as_matrix()
+            interfaces_coord = interfaces[['X', 'Y', 'Z']].as_matrix()
 
-            # TODO delete
-            # -DEP- Again i was just a check point
-            # self.rest_layer_points = rest_layer_points
+            # Rest layers matrix # PYTHON VAR
+            rest_layer_points = interfaces_coord[rest_mask]
 
             # Ref layers matrix #VAR
-            # Calculation of the ref matrix and tile. Iloc works with the row number
-            # Here we extract the reference points
-            aux_1 = self._data_scaled.interfaces.iloc[ref_position][['X', 'Y', 'Z']].as_matrix()
-
-            # We initialize the matrix
-            ref_layer_points = np.zeros((0, 3))
-
-            # TODO I hate loop it has to be a better way
-            # Tiling very reference points as many times as rest of the points we have
-            for e, i in enumerate(len_interfaces):
-                ref_layer_points = np.vstack((ref_layer_points, np.tile(aux_1[e], (i - 1, 1))))
+            # Here we extract the reference points and repeat every one as many times as rest points has its layer
+            aux_1 = interfaces_coord[ref_position]
+            ref_layer_points = np.repeat(aux_1, len_rest_form, axis=0)
 
             # -DEP- was just a check point
             self.ref_layer_points = ref_layer_points
@@ -1357,16 +2388,161 @@ class InterpolatorInput:
                 'not have duplicated values in your dataframes'
 
             # Foliations, this ones I tile them inside theano. PYTHON VAR
-            dips_position = self._data_scaled.foliations[['X', 'Y', 'Z']].as_matrix()
-            dip_angles = self._data_scaled.foliations["dip"].as_matrix()
-            azimuth = self._data_scaled.foliations["azimuth"].as_matrix()
-            polarity = self._data_scaled.foliations["polarity"].as_matrix()
+            dips_position = foliations[['X', 'Y', 'Z']].as_matrix()
+            dip_angles = foliations["dip"].as_matrix()
+            azimuth = foliations["azimuth"].as_matrix()
+            polarity = foliations["polarity"].as_matrix()
 
             # Set all in a list casting them in the chosen dtype
             idl = [np.cast[self.dtype](xs) for xs in (dips_position, dip_angles, azimuth, polarity,
                    ref_layer_points, rest_layer_points)]
 
-            return idl
+            # The evaluation of the grid and the size of the chunks depend on the size of the kriging systems
+            self.plan_memory()
+
+            self._data_prep_key = key
+            self._data_prep_cache = idl
+            self._data_prep_rest_mask = rest_mask
+
+            # Copies so the callers cannot modify the cache in place
+            return [xs.copy() for xs in idl]
+
+        def data_prep_key(self, u_grade=None):
+            """
+            Hash of everything data_prep depends on: the columns of the interfaces and foliations it reads, the drift,
+            the number of faults and the size of the grid. It is cheap compared to data_prep since it does not group
+            the data
+            Args:
+                u_grade (list): Grade of the drift of every series
+
+            Returns:
+                str: Hexadecimal digest
+            """
+            key = hashlib.sha1(str((None if u_grade is None else list(u_grade), self._data_scaled.n_faults,
+                                    self.dtype, self.tg.final_block.get_value().shape)).encode())
+            for df, columns in ((self._data_scaled.interfaces, ['X', 'Y', 'Z', 'formation number', 'order_series']),
+                                (self._data_scaled.foliations, ['X', 'Y', 'Z', 'dip', 'azimuth', 'polarity',
+                                                                'order_series'])):
+                for column in columns:
+                    array = np.ascontiguousarray(df[column].values)
+                    if array.dtype == object:
+                        array = array.astype(str)
+                    key.update(str((column, array.shape, array.dtype)).encode())
+                    key.update(array.tobytes())
+            return key.hexdigest()
+
+        def plan_memory(self):
+            """
+            Estimate the peak memory of the model with the current data and grid (see memory_planner) and set how
+            the grid is evaluated. The first time the evaluation at once or in chunks is chosen to fit in the memory
+            budget. Afterwards the graph may be compiled already, so only the size of the chunks can change.
+
+            Returns:
+                gempy.memory_planner.MemoryPlan: Estimate of the peak memory. Also in self.memory_plan
+            """
+            from gempy import memory_planner
+
+            if self.neighbour_evaluation:
+                chunks = True
+            elif self.memory_plan is not None:
+                chunks = self.tg.chunk_evaluation
+            else:
+                chunks = None
+
+            self.memory_plan = memory_planner.plan(np.diff(self.tg.len_series_w.get_value()),
+                                                   n_grid=self.tg.final_block.get_value().shape[1],
+                                                   len_points=int(self.tg.len_series_i.get_value()[-1]),
+                                                   n_faults=self._data_scaled.n_faults, dtype=self.dtype,
+                                                   compute_all=self.compute_all, only_last=self.only_last,
+                                                   memory_budget=self.memory_budget, chunk_size=self.chunk_size,
+                                                   chunks=chunks, regular_grid=self.tg.regular_grid)
+
+            # Without a budget the model is computed anyway, but it will probably swap or be killed
+            physical_memory = memory_planner.physical_memory()
+            if self.memory_budget is None and physical_memory and self.memory_plan.peak_memory > physical_memory:
+                import warnings
+                warnings.warn('The model needs around %.2f MB, more than the physical memory of %.2f MB. Give a '
+                              'memory_budget to evaluate the grid in chunks.\n%r' %
+                              (self.memory_plan.peak_memory / 2**20, physical_memory / 2**20, self.memory_plan))
+
+            self.tg.chunk_evaluation = self.memory_plan.strategy == 'chunks'
+            if self.tg.chunk_evaluation:
+                self.upload(self.tg.grid_chunk_size_T, np.int64(self.memory_plan.chunk_size))
+            return self.memory_plan
+
+        def grid_to_theano(self, grid, chunk_size=65536):
+            """
+            Coordinates and universal drift terms of the points to interpolate as the theano graph takes them. They are
+            computed in chunks so the only arrays of the size of the grid are the outputs in self.dtype
+            Args:
+                grid (numpy.array or RescaledGrid): Rescaled coordinates of the points to interpolate. Shape (n, 3).
+                    A RescaledGrid is rescaled chunk by chunk
+                chunk_size (int): Number of points processed at once
+
+            Returns:
+                numpy.array: Coordinates of the points. I add a small number to avoid problems with the origin point
+
+                numpy.array: Drift terms (x, y, z, x**2, y**2, z**2, xy, xz, yz). Shape (9, n)
+            """
+            if isinstance(grid, RescaledGrid):
+                n_points, points = grid.n_points, grid.points
+            else:
+                n_points, points = len(grid), grid.__getitem__
+
+            grid_val = np.empty((n_points, 3), dtype=self.dtype)
+            _universal_matrix = np.empty((9, n_points), dtype=self.dtype)
+            for c_0 in range(0, n_points, chunk_size):
+                chunk = slice(c_0, c_0 + chunk_size)
+                g = points(chunk)
+                grid_val[chunk] = g + 10e-6
+
+                # Creating the drift matrix. TODO find the official name of this matrix?
+                _universal_matrix[0:3, chunk] = g.T + 1e-10
+                _universal_matrix[3:6, chunk] = (g ** 2).T + 1e-10
+                _universal_matrix[6, chunk] = g[:, 0] * g[:, 1] + 1e-10
+                _universal_matrix[7, chunk] = g[:, 0] * g[:, 2] + 1e-10
+                _universal_matrix[8, chunk] = g[:, 1] * g[:, 2] + 1e-10
+
+            return grid_val, _universal_matrix
+
+        def hash_kriging_input(self, input_data, n_faults=0):
+            """
+            Hash of everything the dual kriging parameters depend on: the input data and the shared parameters of the
+            kriging systems (but not the grid)
+            Args:
+                input_data (list): Output of data_prep
+                n_faults (int): Number of faults
+
+            Returns:
+                str: Hexadecimal digest
+            """
+            shared_parameters = (self.tg.a_T, self.tg.c_o_T, self.tg.nugget_effect_grad_T, self.tg.i_reescale,
+                                 self.tg.gi_reescale, self.tg.u_grade_T, self.tg.len_series_i, self.tg.len_series_f,
+                                 self.tg.len_series_w, self.tg.n_formations_per_serie, self.tg.n_formation,
+                                 self.tg.number_of_points_per_formation_T)
+
+            kriging_hash = hashlib.sha1(str(n_faults).encode())
+            for array in list(input_data) + [shared.get_value() for shared in shared_parameters]:
+                array = np.ascontiguousarray(array)
+                kriging_hash.update(str((array.shape, array.dtype)).encode())
+                kriging_hash.update(array.tobytes())
+            return kriging_hash.hexdigest()
+
+        def hash_grid(self):
+            """
+            Hash of the rescaled grid. A regular grid is given by its extent and resolution, so its points are not
+            generated
+            Returns:
+                str: Hexadecimal digest
+            """
+            grid = self._grid_scaled
+            grid_hash = hashlib.sha1(str((grid.n_points, grid.regular, grid.rescaling_factor)).encode())
+            grid_hash.update(np.ascontiguousarray(grid.centers).tobytes())
+            if grid.regular:
+                grid_hash.update(str((list(grid._grid_ext), list(grid._grid_res))).encode())
+            else:
+                grid_hash.update(np.ascontiguousarray(grid.real_grid.points()).tobytes())
+            return grid_hash.hexdigest()
 
         def set_theano_shared_parameteres(self, **kwargs):
             """
@@ -1409,20 +2585,13 @@ class InterpolatorInput:
             # Asserting that the drift grade is in this range
            # assert (0 <= all(u_grade) <= 2)
 
-            # Creating the drift matrix. TODO find the official name of this matrix?
-            _universal_matrix = np.vstack((self._grid_scaled.grid.T,
-                                           (self._grid_scaled.grid ** 2).T,
-                                           self._grid_scaled.grid[:, 0] * self._grid_scaled.grid[:, 1],
-                                           self._grid_scaled.grid[:, 0] * self._grid_scaled.grid[:, 2],
-                                           self._grid_scaled.grid[:, 1] * self._grid_scaled.grid[:, 2]))
-
             # Setting shared variables
             # Range
-            self.tg.a_T.set_value(np.cast[self.dtype](range_var))
+            self.upload(self.tg.a_T, np.cast[self.dtype](range_var))
             # Covariance at 0
-            self.tg.c_o_T.set_value(np.cast[self.dtype](c_o))
+            self.upload(self.tg.c_o_T, np.cast[self.dtype](c_o))
             # Foliations nugget effect
-            self.tg.nugget_effect_grad_T.set_value(np.cast[self.dtype](nugget_effect))
+            self.upload(self.tg.nugget_effect_grad_T, np.cast[self.dtype](nugget_effect))
 
             # TODO change the drift to the same style I have the faults so I do not need to do this
             # # Drift grade
@@ -1434,13 +2603,35 @@ class InterpolatorInput:
                 # TODO Deprecated
                 # self.tg.c_resc.set_value(1)
 
-            # Just grid. I add a small number to avoid problems with the origin point
-            self.tg.grid_val_T.set_value(np.cast[self.dtype](self._grid_scaled.grid + 10e-6))
-            # Universal grid
-            self.tg.universal_grid_matrix_T.set_value(np.cast[self.dtype](_universal_matrix + 1e-10))
+            if self.tg.regular_grid and not getattr(self._grid_scaled, 'regular', False):
+                if self.tg.regular_grid_built:
+                    raise ValueError('The compiled functions generate a regular grid. Create the interpolator again '
+                                     'with regular_grid=False to use another grid')
+                # Nothing generates the regular grid yet, so the graphs can still take the points of any grid
+                self.tg.regular_grid = False
+
+            if self.tg.regular_grid:
+                # Only the axes of the grid. The points and their drift terms are generated in the graph
+                for axis_T, axis in zip((self.tg.grid_x_T, self.tg.grid_y_T, self.tg.grid_z_T),
+                                        self._grid_scaled.axes()):
+                    self.upload(axis_T, np.cast[self.dtype](axis + 10e-6))
+                for axis_T, axis in zip((self.tg.grid_x_drift_T, self.tg.grid_y_drift_T, self.tg.grid_z_drift_T),
+                                        self._grid_scaled.axes()):
+                    self.upload(axis_T, np.asarray(axis, dtype='float64'))
+                self.upload(self.tg.grid_val_T, np.zeros((0, 3), dtype=self.dtype))
+                self.upload(self.tg.universal_grid_matrix_T, np.zeros((9, 0), dtype=self.dtype))
+                n_grid = self._grid_scaled.n_points
+            else:
+                grid_val, universal_grid_matrix = self.grid_to_theano(self._grid_scaled)
+                # Just grid
+                self.upload(self.tg.grid_val_T, grid_val, borrow=True)
+                # Universal grid
+                self.upload(self.tg.universal_grid_matrix_T, universal_grid_matrix, borrow=True)
+                n_grid = grid_val.shape[0]
+            self.grid_key = self.hash_grid()
 
             # Initialization of the block model
-            self.tg.final_block.set_value(np.zeros((1, self._grid_scaled.grid.shape[0]), dtype='float32'))
+            self.upload(self.tg.final_block, np.zeros((1, n_grid), dtype='float32'))
 
             # Initialization of the boolean array that represent the areas of the block model to be computed in the
             # following series
@@ -1450,11 +2641,12 @@ class InterpolatorInput:
             #self.tg.n_formation.set_value(np.insert(_data_rescaled.interfaces['formation number'].unique(),
             #                                        0, 0)[::-1])
 
-            self.tg.n_formation.set_value(self._data_scaled.interfaces['formation number'].unique())
+            self.upload(self.tg.n_formation, self._data_scaled.interfaces['formation number'].unique())
 
             # Number of formations per series. The function is not pretty but the result is quite clear
-            self.tg.n_formations_per_serie.set_value(
-                np.insert(self._data_scaled.interfaces.groupby('order_series').formation.nunique().values.cumsum(), 0, 0))
+            self.upload(self.tg.n_formations_per_serie,
+                        np.insert(self._data_scaled.interfaces.groupby('order_series').formation.nunique().values.cumsum(),
+                                  0, 0))
 
         def get_kriging_parameters(self, verbose=0):
             # range
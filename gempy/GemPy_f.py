@@ -24,13 +24,33 @@ import numpy as _np
 # --DEP-- import pandas as _pn
 import warnings
 import copy
-from gempy.Visualization import PlotData
-try:
-    from gempy.visualization_vtk import visualize, export_vtk_rectilinear
-except ModuleNotFoundError:
-    warnings.warn('Vtk package is not installed. No vtk visualization available.')
 from gempy.DataManagement import InputData, InterpolatorInput
-from IPython.core.debugger import Tracer
+# The plotting modules (matplotlib, seaborn, vtk) are imported the first time they are used
+
+
+def PlotData(geo_data, *args, **kwargs):
+    """
+    gempy.Visualization.PlotData. matplotlib and seaborn are imported the first time it is called, so headless workers
+    do not load them
+    """
+    from gempy.Visualization import PlotData
+    return PlotData(geo_data, *args, **kwargs)
+
+
+def visualize(geo_data, *args, **kwargs):
+    """
+    gempy.visualization_vtk.visualize. vtk is imported the first time it is called
+    """
+    from gempy.visualization_vtk import visualize
+    return visualize(geo_data, *args, **kwargs)
+
+
+def export_vtk_rectilinear(geo_data, block_lith, path=None):
+    """
+    gempy.visualization_vtk.export_vtk_rectilinear. vtk is imported the first time it is called
+    """
+    from gempy.visualization_vtk import export_vtk_rectilinear
+    return export_vtk_rectilinear(geo_data, block_lith, path=path)
 
 
 
@@ -128,6 +148,16 @@ def get_series(geo_gata):
 
 
 def get_grid(geo_data):
+    """
+    Coordinates of all the points of the grid
+
+    Args:
+        geo_data (gempy.DataManagement.InputData)
+
+    Returns:
+        numpy.array: Shape (n, 3). For a regular grid it is created on the first call and kept read only (see
+        InputData.GridClass.points to generate only some of them)
+    """
     return geo_data.grid.grid
 
 
@@ -302,6 +332,7 @@ def set_grid(geo_data, new_grid=None, extent=None, resolution=None, grid_type="r
 
 
 def plot_data(geo_data, direction="y", series="all", **kwargs):
+    from gempy.Visualization import PlotData
     plot = PlotData(geo_data)
     plot.plot_data(direction=direction, series=series, **kwargs)
     # TODO saving options
@@ -309,6 +340,7 @@ def plot_data(geo_data, direction="y", series="all", **kwargs):
 
 
 def plot_section(geo_data, block, cell_number, direction="y", **kwargs):
+    from gempy.Visualization import PlotData
     plot = PlotData(geo_data)
     plot.plot_block_section(cell_number, block=block, direction=direction, **kwargs)
     # TODO saving options
@@ -317,6 +349,7 @@ def plot_section(geo_data, block, cell_number, direction="y", **kwargs):
 
 def plot_potential_field(geo_data, potential_field, cell_number, n_pf=0,
                          direction="y", plot_data=True, series="all", *args, **kwargs):
+    from gempy.Visualization import PlotData
 
     plot = PlotData(geo_data)
     plot.plot_potential_field(potential_field, cell_number, n_pf=n_pf,
@@ -324,6 +357,10 @@ def plot_potential_field(geo_data, potential_field, cell_number, n_pf=0,
                               *args, **kwargs)
 
 def plot_data_3D(geo_data):
+    try:
+        from gempy.visualization_vtk import visualize
+    except ModuleNotFoundError:
+        raise ModuleNotFoundError('Vtk package is not installed. No vtk visualization available.')
     r, i = visualize(geo_data)
     del r, i
     return None
@@ -338,6 +375,46 @@ def set_interpolation_data(geo_data, **kwargs):
     in_data = InterpolatorInput(geo_data, **kwargs)
     return in_data
 
+
+def prewarm_cache(geo_data, cache_dir=None, variants=None, **kwargs):
+    """
+    Compile and store in the on disk cache the functions of known model shapes, so later calls of
+    set_interpolation_data with models of the same structure (number of faults and series, dtype, options of the
+    interpolator) load them instead of compiling
+
+    Args:
+        geo_data (gempy.DataManagement.InputData or list): Template model or list of template models. Only their
+            structure matters, not the data
+        cache_dir (str): Directory of the cache. Default the environment variable GEMPY_CACHE_DIR
+        variants (list): dicts of options of InterpolatorInput. A function is stored for every template and variant,
+            e.g. [{'compute_all': True}, {'compute_all': False}]
+        **kwargs: Options of InterpolatorInput common to all the variants
+
+    Returns:
+        list: paths of the cached functions. The functions with the incremental solver are not cached
+    """
+    from gempy import function_cache
+
+    if cache_dir is None:
+        cache_dir = function_cache.default_cache_dir()
+    assert cache_dir is not None, 'Give a cache_dir or set the environment variable GEMPY_CACHE_DIR'
+
+    if isinstance(geo_data, InputData):
+        geo_data = [geo_data]
+
+    paths = []
+    for template in geo_data:
+        for variant in variants or [{}]:
+            options = dict(kwargs, **variant)
+            options['cache_dir'] = cache_dir
+            interp_data = InterpolatorInput(template, **options)
+            if interp_data.interpolator.tg.kriging_solver.stateful:
+                continue
+            key = function_cache.cache_key(interp_data.graph_structure(compute_all=interp_data.compute_all,
+                                                                       only_last=interp_data.only_last))
+            paths.append(os.path.join(cache_dir, key + '.pkl'))
+    return paths
+
 # =====================================
 # Functions for the InterpolatorData
 # =====================================
@@ -387,10 +464,132 @@ def get_th_fn(interp_data, dtype=None, u_grade=None, **kwargs):
     return interp_data.compile_th_fn(dtype=dtype, **kwargs)
 
 
-def compute_model(interp_data, u_grade=None):
+def compute_model(interp_data, u_grade=None, instrumentation=False):
+    """
+    Compute the block model
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        u_grade (list): Grade of the drift of every series
+        instrumentation (bool): If True the model is computed stage by stage and the wall time, peak memory and size
+            of the arrays of every stage is returned as well (see InterpolatorInput.compute_model_instrumented). The
+            stages run as separately compiled functions, so the report does not time the th_fn call of the default
+            path
+
+    With the incremental solver only the series whose data changed since the last call are computed (see
+    InterpolatorInput.compute_model_incremental)
+
+    Returns:
+        numpy.array: Block model. If instrumentation, also a gempy.instrumentation.ModelReport
+    """
     if getattr(interp_data, 'th_th', None):
         interp_data.compile_th_fn()
 
+    if instrumentation:
+        sol, report = interp_data.compute_model_instrumented(u_grade=u_grade)
+        return _np.squeeze(sol), report
+
+    if interp_data.parallel_series:
+        return _np.squeeze(interp_data.compute_series_parallel(u_grade=u_grade))
+
+    if interp_data.interpolator.tg.kriging_solver.stateful:
+        return _np.squeeze(interp_data.compute_model_incremental(u_grade=u_grade))
+
     i = interp_data.get_input_data(u_grade=u_grade)
     sol = interp_data.th_fn(*i)
     return _np.squeeze(sol)
+
+
+def compute_model_ensemble(interp_data, input_data_ensemble, u_grade=None):
+    """
+    Compute the lithology block of N realizations of the input data in one compiled call. Every realization is
+    computed as a whole model, grid kernels included, only the overhead of N separate calls is saved
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        input_data_ensemble (list): The arrays of interp_data.get_input_data() with a leading axis of realizations.
+            Arrays without it are shared by all the realizations
+        u_grade (list): Grade of the drift of every series
+
+    Returns:
+        numpy.array: Lithology block of every realization. Shape (N, n_grid)
+    """
+    return interp_data.compute_ensemble(input_data_ensemble, u_grade=u_grade)
+
+
+def compute_model_at(interp_data, points, u_grade=None):
+    """
+    Compute the model at arbitrary points reusing the dual kriging parameters of interp_data. The kriging systems are
+    only solved again if the data or the kriging parameters changed (see InterpolatorInput.get_kriging_weights)
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        points (numpy.array): Coordinates of the points in the real scale. Shape (n, 3)
+        u_grade (list): Grade of the drift of every series
+
+    Returns:
+        numpy.array: Block model (and potential fields) at the points
+    """
+    sol = interp_data.evaluate(points, u_grade=u_grade)
+    return _np.squeeze(sol)
+
+
+def compute_section(interp_data, cell_number=None, direction="y", plane=None, resolution=(50, 50), u_grade=None):
+    """
+    Compute the model only at a 2D section reusing the dual kriging parameters of interp_data: a section of the grid
+    perpendicular to a cartesian direction or an arbitrary plane (see InterpolatorInput.compute_section)
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        cell_number (int): Position of the section in the grid along direction. Required if plane is None
+        direction (str): x, y or z. Direction perpendicular to the section of the grid
+        plane (list): [origin, u, v]. Arbitrary plane from the point origin spanned by the vectors u and v in the
+            real scale. If given cell_number and direction are ignored
+        resolution (list): Number of points of the plane along u and v
+        u_grade (list): Grade of the drift of every series
+
+    Returns:
+        numpy.array: Block model (and potential fields) at the section. The last two axes are the section
+    """
+    if plane is None:
+        assert isinstance(cell_number, (int, _np.integer)), 'cell_number must be an int for a section of the grid'
+    sol = interp_data.compute_section(cell_number=cell_number, direction=direction, plane=plane,
+                                      resolution=resolution, u_grade=u_grade)
+    return _np.squeeze(sol)
+
+
+def compute_geological_map(interp_data, dem, extent=None, u_grade=None):
+    """
+    Compute the geological map on a topographic surface reusing the dual kriging parameters of interp_data, i.e.
+    the model is only evaluated at the nodes of the digital elevation model (see
+    InterpolatorInput.compute_geological_map)
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        dem (numpy.array): Elevation of the nodes of a regular 2D grid. Shape (nx, ny), the first axis is x
+        extent (list): [x_min, x_max, y_min, y_max] of the nodes of the DEM. Default the extent of the model
+        u_grade (list): Grade of the drift of every series
+
+    Returns:
+        numpy.array: Block model (and potential fields) at the surface. The last two axes are the map
+    """
+    sol = interp_data.compute_geological_map(dem, extent=extent, u_grade=u_grade)
+    return _np.squeeze(sol)
+
+
+def compute_model_adaptive(interp_data, levels=2, u_grade=None):
+    """
+    Compute the block model refining the grid only around the interfaces and faults. The grid is evaluated every
+    2**levels nodes and the cells where the blocks change are refined down to the resolution of the grid (see
+    InterpolatorInput.compute_model_adaptive)
+
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+        levels (int): Number of levels of refinement
+        u_grade (list): Grade of the drift of every series
+
+    Returns:
+        numpy.array: Block model. The potential fields are NaN at the nodes that were not evaluated
+    """
+    sol = interp_data.compute_model_adaptive(levels=levels, u_grade=u_grade)
+    return _np.squeeze(sol)
@@ -4,10 +4,26 @@ import theano
 def create_model_op(interp_data):
     input_data_T = interp_data.interpolator.tg.input_parameters_list()
     input_data_P = interp_data.get_input_data()
-    return theano.OpFromGraph(input_data_T, [interp_data.interpolator.tg.whole_block_model(interp_data.n_faults)],
+    return theano.OpFromGraph(input_data_T, [interp_data.interpolator.tg.whole_block_model(interp_data.data.n_faults)],
                               on_unused_input='ignore')
 
 
+def create_ensemble_model_op(interp_data):
+    """
+    Theano Op with the lithology block of N realizations of the input data (see
+    TheanoGraph_pro.ensemble_block_model). The realizations are looped inside the Op and each one costs a whole
+    model, so N realizations cost N times th_fn
+    Args:
+        interp_data (gempy.DataManagement.InterpolatorInput)
+
+    Returns:
+        theano.OpFromGraph: Op of the input data with a leading axis of realizations
+    """
+    input_data_ensemble_T, lithology_ensemble = interp_data.interpolator.tg.ensemble_block_model(
+        interp_data.data.n_faults)
+    return theano.OpFromGraph(input_data_ensemble_T, [lithology_ensemble], on_unused_input='ignore')
+
+
 # Code to select only some of the raws or a column stochastic:
 #     ref = pm.Deterministic('reference', T.set_subtensor(
 #         ref[T.nonzero(T.cast(select.as_matrix(), "int8"))[0], 2],
@@ -17,7 +17,6 @@ import sys
 # This is for sphenix to find the packages
 sys.path.append( path.dirname( path.dirname( path.abspath(__file__) ) ) )
 
-from IPython.core.debugger import Pdb
 from gempy.colors import color_dict_rgb, color_dict_hex
 
 # TODO: inherit pygeomod classes
@@ -167,6 +166,8 @@ class PlotData(object):
 
         Args:
             cell_number(int): position of the array to plot
+            block(numpy.ndarray, theano shared or gempy.DataManagement.InterpolatorInput): Lithology block. Given an
+                InterpolatorInput only the section is computed (see InterpolatorInput.compute_section)
             direction(str): xyz. Caartesian direction to be plotted
                 interpolation(str): Type of interpolation of plt.imshow. Default 'none'.  Acceptable values are 'none'
                 ,'nearest', 'bilinear', 'bicubic',
@@ -178,30 +179,36 @@ class PlotData(object):
         Returns:
             Block plot
         """
-        if block is not None:
-            import theano
-            import numpy
-            assert (type(block) is theano.tensor.sharedvar.TensorSharedVariable or
-                    type(block) is numpy.ndarray), \
-                'Block has to be a theano shared object or numpy array.'
-            if type(block) is numpy.ndarray:
-                _block = block
-            else:
-                _block = block.get_value()
-        else:
-            try:
-                _block = self._data.interpolator.tg.final_block.get_value()
-            except AttributeError:
-                raise AttributeError('There is no block to plot')
-
-        plot_block = _block.reshape(self._data.resolution[0], self._data.resolution[1], self._data.resolution[2])
+        from gempy.DataManagement import InterpolatorInput
         _a, _b, _c, extent_val, x, y = self._slice(direction, cell_number)[:-2]
 
+        if isinstance(block, InterpolatorInput):
+            # Only the points of the section are computed
+            plot_section = block.lithology_block(block.compute_section(cell_number, direction))
+        else:
+            if block is not None:
+                import theano
+                import numpy
+                assert (type(block) is theano.tensor.sharedvar.TensorSharedVariable or
+                        type(block) is numpy.ndarray), \
+                    'Block has to be a theano shared object, numpy array or InterpolatorInput.'
+                if type(block) is numpy.ndarray:
+                    _block = block
+                else:
+                    _block = block.get_value()
+            else:
+                try:
+                    _block = self._data.interpolator.tg.final_block.get_value()
+                except AttributeError:
+                    raise AttributeError('There is no block to plot')
+
+            plot_block = _block.reshape(self._data.resolution[0], self._data.resolution[1], self._data.resolution[2])
+            plot_section = plot_block[_a, _b, _c]
 
         if plot_data:
             self.plot_data(direction, 'all')
 
-        plt.imshow(plot_block[_a, _b, _c].T, origin="bottom", cmap=self._cmap, norm=self._norm,
+        plt.imshow(plot_section.T, origin="bottom", cmap=self._cmap, norm=self._norm,
                    extent=extent_val,
                    interpolation=interpolation, **kwargs)
 
@@ -215,7 +222,9 @@ class PlotData(object):
 
         Args:
             cell_number(int): position of the array to plot
-            potential_field(str): name of the potential field (or series) to plot
+            potential_field(numpy.ndarray or gempy.DataManagement.InterpolatorInput): potential field to plot. Given
+                an InterpolatorInput only the section of the potential field n_pf is computed (see
+                InterpolatorInput.compute_section)
             n_pf(int): number of the  potential field (or series) to plot
             direction(str): xyz. Caartesian direction to be plotted
             serie: *Deprecated*
@@ -228,9 +237,18 @@ class PlotData(object):
         if plot_data:
             self.plot_data(direction, 'all')
 
+        from gempy.DataManagement import InterpolatorInput
         _a, _b, _c, extent_val, x, y = self._slice(direction, cell_number)[:-2]
-        plt.contour(potential_field.reshape(
-            self._data.resolution[0], self._data.resolution[1], self._data.resolution[2])[_a, _b, _c].T,
+
+        if isinstance(potential_field, InterpolatorInput):
+            # Only the points of the section are computed
+            plot_section = potential_field.potential_field(potential_field.compute_section(cell_number, direction),
+                                                           n_pf)
+        else:
+            plot_section = potential_field.reshape(
+                self._data.resolution[0], self._data.resolution[1], self._data.resolution[2])[_a, _b, _c]
+
+        plt.contour(plot_section.T,
                     cell_number,
                     extent=extent_val, *args,
                     **kwargs)
@@ -9,16 +9,11 @@ Created on 1/5/2017
 @author: Miguel de la Varga
 """
 
-import theano
-import theano.tensor as T
-import matplotlib.pyplot as plt
-import pymc3 as pm
 import numpy as np
 import pandas as pn
 
-from bokeh.io import show
-import bokeh.layouts as bl
-import bokeh.plotting as bp
+# theano, matplotlib, pymc3 and bokeh are imported in the functions that use them, so importing the module does not
+# load them
 
 
 def choose_lithology_elements(df, litho, elem=None, coord = True):
@@ -90,6 +85,8 @@ def theano_sed():
         theano.compile.function_module.Function: Compiled function
 
     """
+    import theano
+    import theano.tensor as T
 
     theano.config.compute_test_value = "ignore"
 
@@ -129,6 +126,7 @@ def compute_variogram(df, properties, euclidian_distances, tol=10, lags=np.logsp
     Returns:
         list: semvariance aor cross-semivariance
     """
+    import matplotlib.pyplot as plt
 
     # Tiling the properties to a square matrix
     element = (df[properties[0]].as_matrix().reshape(-1, 1) -
@@ -437,6 +435,9 @@ class SGS(object):
         Returns:
             pymc.Model: PyMC3 model to be sampled using MCMC
         """
+        import pymc3 as pm
+        import theano.tensor as T
+
         self.n_exp = n_exp
         self.n_gauss = n_gauss
         n_var = self.n_properties
@@ -494,6 +495,9 @@ class SGS(object):
         Returns:
             None
         """
+        from bokeh.io import show
+        import bokeh.layouts as bl
+        import bokeh.plotting as bp
 
         if not trace:
             trace = self.trace
@@ -579,6 +583,10 @@ class SGS(object):
         Returns:
             None
         """
+        from bokeh.io import show
+        import bokeh.layouts as bl
+        import bokeh.plotting as bp
+
         n_exp = self.n_exp
         n_gauss = self.n_gauss
         trace = self.trace
@@ -704,6 +712,9 @@ class SGS(object):
 
 
 def fit_cross_cov(df, lags, n_exp=2, n_gaus=2, range_mu=None):
+    import pymc3 as pm
+    import theano.tensor as T
+
     n_var = df.columns.shape[0]
     n_basis_f = n_var * (n_exp + n_gaus)
     prior_std_reg = df.std(0).max() * 10
@@ -757,6 +768,10 @@ def gaus_vario(lags, sill, range_):
 
 
 def plot_cross_variograms(trace, lags, df, n_exp=2, n_gaus=2, iter_plot=200, experimental=None):
+    from bokeh.io import show
+    import bokeh.layouts as bl
+    import bokeh.plotting as bp
+
     n_equations = trace['weights'].shape[1]
     n_iter = trace['weights'].shape[0]
     lags_tiled = np.tile(lags, (iter_plot, 1))
@@ -795,6 +810,10 @@ def plot_cross_variograms(trace, lags, df, n_exp=2, n_gaus=2, iter_plot=200, exp
 
 
 def plot_cross_covariance(trace, lags, df, n_exp=2, n_gaus=2, nuggets=None, iter_plot=200):
+    from bokeh.io import show
+    import bokeh.layouts as bl
+    import bokeh.plotting as bp
+
     n_equations = trace['weights'].shape[1]
     n_iter = trace['weights'].shape[0]
     lags_tiled = np.tile(lags, (iter_plot, 1))
@@ -898,6 +917,7 @@ def cross_covariance(trace, sed, sample, nuggets=None, n_var=1, n_exp=2, n_gaus=
 
 
 def clustering_grid(grid_to_inter, n_clusters=50, plot=False):
+    import matplotlib.pyplot as plt
     from sklearn.cluster import KMeans
     clust = KMeans(n_clusters=n_clusters).fit(grid_to_inter)
     if plot:
@@ -915,10 +935,12 @@ def clustering_grid(grid_to_inter, n_clusters=50, plot=False):
     return clust
 
 
-def select_points(df, grid_to_inter, cluster, SED_f = theano_sed(), n_rep=10):
+def select_points(df, grid_to_inter, cluster, SED_f=None, n_rep=10):
 
     points_cluster = np.bincount(cluster.labels_)
-  #  SED_f = theano_sed()
+    # The function is compiled here and not as default argument, which would compile it when importing the module
+    if SED_f is None:
+        SED_f = theano_sed()
 
     for i in range(n_rep):
         for i_clust in range(cluster.n_clusters):
@@ -0,0 +1,157 @@
+"""
+On disk cache of the compiled theano functions of the interpolator. Compiling the graph of a model takes from seconds
+to minutes while the compiled function only depends on the structure of the graph (number of faults, number of
+series, dtype, options of the interpolator...) and not on the data, which is given as input and in theano shared
+variables. The functions are pickled with the optimized graph so loading them skips the optimization.
+
+The shared variables of a pickled function are copies, so when a function is loaded they are swapped by the shared
+variables of the TheanoGraph_pro object of the interpolator, matched by the name of the attribute. The Ops are
+unpickled copies too, so the functions with a stateful kriging solver (see kriging_solvers.KrigingSolve.stateful)
+are not cached.
+"""
+from __future__ import division
+
+import os
+import sys
+import json
+import pickle
+import hashlib
+
+import numpy as np
+import theano
+
+
+def default_cache_dir():
+    """
+    Directory of the cache given by the environment variable GEMPY_CACHE_DIR
+
+    Returns:
+        str: path. None if the variable is not set, i.e. the functions are not cached
+    """
+    return os.environ.get('GEMPY_CACHE_DIR')
+
+
+def cache_key(structure):
+    """
+    Key of a compiled function. Besides the structure of the graph it depends on the versions of python, numpy and
+    theano and on the source of the modules that build the graph, so any change of the code invalidates the cache
+
+    Args:
+        structure (dict): Parameters that define the graph. They must be serializable with json
+
+    Returns:
+        str: hexadecimal sha1
+    """
+    key = hashlib.sha1()
+    key.update(json.dumps(structure, sort_keys=True).encode())
+    key.update(('python %s numpy %s theano %s' % (sys.version, np.__version__, theano.__version__)).encode())
+    key.update(('mode %s optimizer %s device %s floatX %s' % (theano.config.mode, theano.config.optimizer,
+                                                              theano.config.device, theano.config.floatX)).encode())
+
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for module in ('theanograf.py', 'kriging_solvers.py'):
+        with open(os.path.join(source_dir, module), 'rb') as f:
+            key.update(f.read())
+    return key.hexdigest()
+
+
+def shared_variables_names(th_fn, tg):
+    """
+    Attribute of tg that holds every shared variable of the compiled function
+
+    Args:
+        th_fn (theano.compile.function_module.Function): compiled function
+        tg (gempy.theanograf.TheanoGraph_pro): object that built the graph
+
+    Returns:
+        list: Name of the attribute of every shared variable in the order of th_fn.maker.inputs. None if a shared
+        variable is not an attribute of tg
+    """
+    attributes = {id(value): name for name, value in vars(tg).items()
+                  if isinstance(value, theano.compile.SharedVariable)}
+    names = []
+    for i in th_fn.maker.inputs:
+        if isinstance(i.variable, theano.compile.SharedVariable):
+            names.append(attributes.get(id(i.variable)))
+    return names
+
+
+def save(th_fn, tg, key, cache_dir=None):
+    """
+    Pickle a compiled function in the cache
+
+    Args:
+        th_fn (theano.compile.function_module.Function): compiled function
+        tg (gempy.theanograf.TheanoGraph_pro): object that built the graph
+        key (str): see cache_key
+        cache_dir (str): Default default_cache_dir()
+
+    Returns:
+        bool: True if the function was stored
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    names = shared_variables_names(th_fn, tg)
+    if cache_dir is None or None in names:
+        return False
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+
+    # The graphs are deep for the default recursion limit of pickle
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        # Write to a temporary file first so other processes never read half a file
+        path = os.path.join(cache_dir, key + '.pkl')
+        with open(path + '.%d.tmp' % os.getpid(), 'wb') as f:
+            pickle.dump({'shared_variables': names, 'th_fn': th_fn}, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.%d.tmp' % os.getpid(), path)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    return True
+
+
+def load(tg, key, cache_dir=None):
+    """
+    Load a compiled function from the cache and bind it to the shared variables of tg
+
+    Args:
+        tg (gempy.theanograf.TheanoGraph_pro): object that holds the shared variables of the interpolator
+        key (str): see cache_key
+        cache_dir (str): Default default_cache_dir()
+
+    Returns:
+        theano.compile.function_module.Function: compiled function. None if it is not in the cache or it cannot be
+        loaded
+    """
+    if cache_dir is None:
+        cache_dir = default_cache_dir()
+    if cache_dir is None:
+        return None
+    path = os.path.join(cache_dir, key + '.pkl')
+    if not os.path.isfile(path):
+        return None
+
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, 50000))
+    try:
+        with open(path, 'rb') as f:
+            cached = pickle.load(f)
+    except Exception:
+        # A corrupted or incompatible file is compiled again
+        return None
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+
+    th_fn = cached['th_fn']
+    shared_variables = [i.variable for i in th_fn.maker.inputs
+                        if isinstance(i.variable, theano.compile.SharedVariable)]
+    swap = {}
+    for variable, name in zip(shared_variables, cached['shared_variables']):
+        new_variable = getattr(tg, name, None)
+        if not isinstance(new_variable, theano.compile.SharedVariable) or new_variable.type != variable.type:
+            return None
+        swap[variable] = new_variable
+
+    return th_fn.copy(swap=swap)
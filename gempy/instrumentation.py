@@ -0,0 +1,165 @@
+"""
+Timing and memory instrumentation of the computation of a model. The stages of every series (covariance matrix,
+kriging solve, evaluation of the potential field at the grid and segmentation) are computed with separate compiled
+functions (see InterpolatorInput.compute_model_instrumented) and every call is recorded in a ModelReport, so the
+graph does not need to be patched with print nodes (see the verbose option of theanograf.TheanoGraph_pro).
+
+The report describes those stage functions, not th_fn, which is what compute_model runs otherwise. th_fn computes the
+same operations in a single graph, so theano can fuse and reuse memory across the stages, and its time and peak memory
+can be lower than the sum of the stages.
+
+The peak memory is measured with tracemalloc, which also traces the memory of the numpy arrays.
+"""
+from __future__ import division
+
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pn
+
+
+class ModelReport(object):
+    """
+    Wall time, peak memory and size of the arrays of every stage of the computation of a model. The stages are
+    timed with the separately compiled functions of InterpolatorInput.compile_th_fn_stages, not with th_fn
+
+    Attributes:
+        stages (list): A dict per stage with the keys:
+            - stage (str): data_prep, upload, covariance, solve, evaluation or segmentation
+            - series (str): Name of the series. None for the stages of the whole model
+            - fault (bool): If the series is a fault
+            - time (float): Wall time in seconds
+            - peak_memory (int): Peak of memory allocated during the stage in bytes. Before python 3.9 with a
+              tracing started by the caller it is the peak of the tracing above the memory at the start of the
+              stage, which can be higher than the real one if the peak of the tracing was reached before the stage
+            - arrays (dict): Shape of the arrays produced by the stage
+            - nbytes (int): Size of the arrays produced by the stage in bytes
+    """
+    def __init__(self):
+        self.stages = []
+
+    @contextmanager
+    def record(self, stage, series=None, fault=False):
+        """
+        Record the time and the peak memory of the code in the with block. The arrays produced by the stage can be
+        added to the yielded dict under 'arrays' and the records of the stages nested in it under 'nested'. Their
+        time is not counted in the stage and they are added to the report after it
+
+        Args:
+            stage (str): Name of the stage
+            series (str): Name of the series
+            fault (bool): If the series is a fault
+
+        Yields:
+            dict: Record of the stage
+        """
+        # A tracing started by the caller is never stopped. Its peak can only be reset from python 3.9
+        # (tracemalloc.reset_peak), before the peak is taken relative to the memory at the start of the stage
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start()
+        elif hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        memory_0 = tracemalloc.get_traced_memory()[0]
+
+        entry = {'stage': stage, 'series': series, 'fault': fault, 'arrays': {}, 'nested': []}
+        t = time.perf_counter()
+        try:
+            yield entry
+        finally:
+            nested = entry.pop('nested')
+            entry['time'] = time.perf_counter() - t - sum(n['time'] for n in nested)
+            entry['peak_memory'] = max(tracemalloc.get_traced_memory()[1] - memory_0, 0)
+            if not tracing:
+                tracemalloc.stop()
+
+            arrays = entry['arrays']
+            entry['nbytes'] = int(sum(np.asarray(a).nbytes for a in arrays.values()))
+            entry['arrays'] = {name: tuple(np.shape(a)) for name, a in arrays.items()}
+            self.stages.append(entry)
+            self.stages.extend(nested)
+
+    @property
+    def total_time(self):
+        """
+        Returns:
+            float: Wall time of all the stages in seconds
+        """
+        return sum(s['time'] for s in self.stages)
+
+    @property
+    def peak_memory(self):
+        """
+        Returns:
+            int: Maximum peak of memory of the stages in bytes
+        """
+        return max([s['peak_memory'] for s in self.stages] + [0])
+
+    def to_dataframe(self):
+        """
+        Returns:
+            pandas.core.frame.DataFrame: A row per stage
+        """
+        return pn.DataFrame(self.stages, columns=['stage', 'series', 'fault', 'time', 'peak_memory', 'nbytes',
+                                                  'arrays'])
+
+    def by_stage(self):
+        """
+        Returns:
+            pandas.core.frame.DataFrame: Total time, maximum peak of memory and size of the arrays of every stage
+        """
+        return self.to_dataframe().groupby('stage', sort=False).agg({'time': 'sum', 'peak_memory': 'max',
+                                                                     'nbytes': 'sum'})
+
+    def by_series(self):
+        """
+        Returns:
+            pandas.core.frame.DataFrame: Total time, maximum peak of memory and size of the arrays of every series
+        """
+        df = self.to_dataframe().dropna(subset=['series'])
+        return df.groupby(['series', 'fault'], sort=False).agg({'time': 'sum', 'peak_memory': 'max',
+                                                               'nbytes': 'sum'})
+
+    def to_dict(self):
+        """
+        Returns:
+            dict: total time, peak memory and the list of stages. Only python types, so it can be serialized
+        """
+        return {'total_time': self.total_time,
+                'peak_memory': int(self.peak_memory),
+                'stages': [dict(s, arrays={k: list(v) for k, v in s['arrays'].items()}) for s in self.stages]}
+
+    def __repr__(self):
+        return 'ModelReport(total_time=%.4f s, peak_memory=%d bytes)\n%s' % (self.total_time, self.peak_memory,
+                                                                             self.by_stage())
+
+
+@contextmanager
+def record_uploads(interpolator, entry):
+    """
+    Record the values given to the theano shared variables by the interpolator (see InterpolatorClass.upload) as an
+    upload stage of the report, nested in the stage of entry, so it is added to the report after it
+
+    Args:
+        interpolator (gempy.DataManagement.InterpolatorInput.InterpolatorClass): Interpolator that uploads the values
+        entry (dict): Record of the stage that uploads the values (see ModelReport.record)
+
+    Yields:
+        None
+    """
+    interpolator.uploads = []
+    try:
+        yield
+    finally:
+        uploads, interpolator.uploads = interpolator.uploads, None
+
+        upload = {'stage': 'upload', 'series': None, 'fault': False,
+                  'time': sum(u['time'] for u in uploads),
+                  'arrays': {u['name']: tuple(u['shape']) for u in uploads}}
+        # The values are copied, so the memory of the upload is the size of the arrays
+        upload['nbytes'] = upload['peak_memory'] = int(sum(u['nbytes'] for u in uploads))
+        # Nothing is uploaded when the input data is cached (see InterpolatorClass.data_prep)
+        if uploads:
+            entry['nested'].append(upload)
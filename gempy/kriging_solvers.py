@@ -0,0 +1,549 @@
+"""
+Theano operations to solve the kriging system. The covariance function is a cubic with compact support so every
+covariance between points further than the range is exactly 0. When the range is small compared to the extent of the
+model most of the covariance matrix is zero and a sparse direct solver is much cheaper than a dense one. Only the
+solve exploits the sparsity: the covariance matrix is still assembled dense in the graph (see
+TheanoGraph_pro.covariance_matrix) and converted here, so the memory of the assembly is still O(n^2).
+
+For big systems (thousands of constraints per series) a direct solver is O(n^3). IterativeKrigingSolve solves the
+system with a preconditioned Krylov method instead. When the same model is computed again after moving a few points
+(interactive editing) IncrementalKrigingSolve updates the factorization of the previous call instead.
+MixedPrecisionKrigingSolve factorizes the system in float32 and refines the solution in float64.
+
+The operations behave as theano.tensor.slinalg.solve (same gradient) but choose the solver at run time. The solver
+used and its diagnostics (density, iterations, residual...) are recorded per call in solve_records, not in the Ops:
+theano merges equal Ops and the function cache unpickles copies of them.
+"""
+from __future__ import division
+
+import collections
+import threading
+import warnings
+import numpy as np
+import scipy.linalg
+import scipy.sparse
+import scipy.sparse.linalg
+import theano
+import theano.tensor as T
+
+_records = threading.local()
+
+
+def solve_records():
+    """
+    Diagnostics of the last kriging solves run in this thread, oldest first. Every call of a solver appends a dict
+    with the name of the Op ('op'), the solver used ('solver') and the diagnostics of that solver
+    Returns:
+        collections.deque: records of the last 1000 solves
+    """
+    if not hasattr(_records, 'deque'):
+        _records.deque = collections.deque(maxlen=1000)
+    return _records.deque
+
+
+def last_solve():
+    """
+    Diagnostics of the last kriging solve run in this thread
+    Returns:
+        dict: record of the solve (see solve_records). None if nothing was solved yet
+    """
+    records = solve_records()
+    return records[-1] if records else None
+
+
+class KrigingSolve(theano.Op):
+    """
+    Solve the kriging system C x = b. The covariance of the interfaces (see TheanoGraph_pro.cov_interfaces) has a
+    constant offset in all its entries, so C is a sparse matrix plus a rank one matrix. The density of the sparse
+    part (fraction of non zero entries) is measured every call and if it is below sparse_threshold the system is
+    solved with a sparse LU decomposition (SuperLU) and the Sherman-Morrison formula for the offset. Otherwise the
+    system is solved with the same dense LAPACK routine as theano.tensor.slinalg.solve
+
+    Args:
+        sparse_threshold (float): Maximum density of C to use the sparse solver. 0 always uses the dense solver
+        sparse_min_size (int): Minimum size of C to use the sparse solver. For small systems the dense solver is
+            faster whatever the density
+        offset (float): Constant added to every entry of the covariance of the interfaces
+
+    Every call records (see solve_records) the solver used, 'dense' or 'sparse', and the density of the sparse part
+    of C
+    """
+    __props__ = ('sparse_threshold', 'sparse_min_size', 'offset')
+
+    # If the Op keeps data between calls. The functions with a stateful Op are not cached on disk (see
+    # InterpolatorInput.compile_th_fn): the unpickled Op would keep its own state, apart from the one of the
+    # interpolator
+    stateful = False
+
+    def __init__(self, sparse_threshold=0.1, sparse_min_size=1000, offset=1e-6):
+        self.sparse_threshold = sparse_threshold
+        self.sparse_min_size = sparse_min_size
+        self.offset = offset
+
+    def make_node(self, C, b, offset_0, offset_1):
+        """
+        Args:
+            C (theano.tensor.matrix): Covariance matrix
+            b (theano.tensor.vector): Independent vector
+            offset_0 (theano.tensor.scalar): First row of the covariance of the interfaces in C
+            offset_1 (theano.tensor.scalar): Last row (excluded) of the covariance of the interfaces in C
+        """
+        C = T.as_tensor_variable(C)
+        b = T.as_tensor_variable(b)
+        offset_0 = T.as_tensor_variable(offset_0)
+        offset_1 = T.as_tensor_variable(offset_1)
+        assert C.ndim == 2, 'C must be a matrix'
+        assert b.ndim == 1, 'b must be a vector'
+
+        x = T.vector(dtype=theano.scalar.upcast(C.dtype, b.dtype))
+        return theano.Apply(self, [C, b, offset_0, offset_1], [x])
+
+    def sparse_part(self, C, offset_0, offset_1):
+        """
+        Density of C once the offset of the interfaces is removed
+        Args:
+            C (numpy.array): covariance matrix
+            offset_0 (int): First row of the covariance of the interfaces
+            offset_1 (int): Last row (excluded) of the covariance of the interfaces
+
+        Returns:
+            float: fraction of non zero entries
+        """
+        C_I = C[offset_0:offset_1, offset_0:offset_1]
+        nnz = np.count_nonzero(C) - np.count_nonzero(C_I) + \
+            np.count_nonzero(C_I != np.asarray(self.offset, dtype=C.dtype))
+        return nnz / C.size if C.size else 1.
+
+    def record(self, **diagnostics):
+        """
+        Append the diagnostics of a call to the records of this thread
+        Args:
+            **diagnostics: solver used and its diagnostics
+        """
+        diagnostics['op'] = type(self).__name__
+        solve_records().append(diagnostics)
+
+    def perform(self, node, inputs, output_storage):
+        C, b, offset_0, offset_1 = inputs
+        offset_0, offset_1 = int(offset_0), int(offset_1)
+
+        density = self.sparse_part(C, offset_0, offset_1)
+        if C.shape[0] >= self.sparse_min_size and density <= self.sparse_threshold:
+            self.record(solver='sparse', density=density)
+
+            # Sparse part. The entries beyond the range are exactly 0 again
+            S = C.copy()
+            S[offset_0:offset_1, offset_0:offset_1] -= np.asarray(self.offset, dtype=C.dtype)
+            lu = scipy.sparse.linalg.splu(scipy.sparse.csc_matrix(S))
+
+            # Sherman-Morrison with u = offset in the rows of the interfaces and v = 1 in their columns
+            u = np.zeros_like(b)
+            u[offset_0:offset_1] = self.offset
+            y = lu.solve(b)
+            z = lu.solve(u)
+            x = y - z * y[offset_0:offset_1].sum() / (1 + z[offset_0:offset_1].sum())
+        else:
+            self.record(solver='dense', density=density)
+            x = scipy.linalg.solve(C, b)
+        output_storage[0][0] = np.asarray(x, dtype=node.outputs[0].dtype)
+
+    def infer_shape(self, node, shapes):
+        return [shapes[1]]
+
+    def grad(self, inputs, output_gradients):
+        """
+        Reverse-mode gradient of x = C^-1 b: b_bar = C^-T x_bar and C_bar = -b_bar x^T. C^T has the same offset
+        """
+        C, b, offset_0, offset_1 = inputs
+        x = self(C, b, offset_0, offset_1)
+        b_bar = self(C.T, output_gradients[0], offset_0, offset_1)
+        C_bar = -T.outer(b_bar, x)
+        # x can be float64 with float32 inputs (MixedPrecisionKrigingSolve)
+        return [T.cast(C_bar, C.dtype), T.cast(b_bar, b.dtype), theano.gradient.DisconnectedType()(),
+                theano.gradient.DisconnectedType()()]
+
+    def connection_pattern(self, node):
+        return [[True], [True], [False], [False]]
+
+
+class IterativeKrigingSolve(KrigingSolve):
+    """
+    Solve the kriging system C x = b with a preconditioned Krylov method. The kriging matrix is symmetric but
+    indefinite (the drift block is 0) so the methods are GMRES or MINRES. The product by C is done with the sparse
+    part of C plus the offset of the interfaces when C is sparse enough (see KrigingSolve) and with the dense matrix
+    otherwise. The memory is O(n^2) at most and there is no factorization of C
+
+    Args:
+        method (str): 'gmres' or 'minres'
+        preconditioner (str): None, 'jacobi', 'block_jacobi' or 'ilu' (incomplete LU of the sparse part of C). MINRES
+            needs a symmetric positive definite preconditioner so it only accepts None and 'jacobi'
+        tol (float): Relative tolerance of the residual
+        maxiter (int): Maximum number of iterations. Default the method default
+        block_size (int): Size of the diagonal blocks of the block Jacobi preconditioner
+        drop_tol (float): Drop tolerance of the incomplete LU
+        max_restarts (int): Number of times the method is restarted if the residual is still above tol
+        sparse_threshold (float): Maximum density of C to use the sparse product
+        offset (float): Constant added to every entry of the covariance of the interfaces
+
+    Every call records (see solve_records) the product used ('dense' or 'sparse'), the density of C, the number of
+    iterations, the relative residual ||C x - b|| / ||b|| and the convergence flag info (0 means converged,
+    otherwise the number of iterations)
+    """
+    __props__ = ('method', 'preconditioner', 'tol', 'maxiter', 'block_size', 'drop_tol', 'max_restarts',
+                 'sparse_threshold', 'offset')
+
+    def __init__(self, method='gmres', preconditioner='block_jacobi', tol=1e-6, maxiter=None, block_size=500,
+                 drop_tol=1e-4, max_restarts=10, sparse_threshold=0.1, offset=1e-6):
+        assert method in ('gmres', 'minres'), 'method must be either gmres or minres'
+        assert preconditioner in (None, 'jacobi', 'block_jacobi', 'ilu'), 'Unknown preconditioner'
+        assert method == 'gmres' or preconditioner in (None, 'jacobi'), \
+            'minres needs a symmetric positive definite preconditioner: None or jacobi'
+
+        super(IterativeKrigingSolve, self).__init__(sparse_threshold=sparse_threshold, sparse_min_size=0,
+                                                    offset=offset)
+        self.method = method
+        self.preconditioner = preconditioner
+        self.tol = tol
+        self.maxiter = maxiter
+        self.block_size = block_size
+        self.drop_tol = drop_tol
+        self.max_restarts = max_restarts
+
+    def operator(self, C, offset_0, offset_1):
+        """
+        Product by C in float64
+        Args:
+            C (numpy.array): covariance matrix
+            offset_0 (int): First row of the covariance of the interfaces
+            offset_1 (int): Last row (excluded) of the covariance of the interfaces
+
+        Returns:
+            scipy.sparse.linalg.LinearOperator: C
+
+            scipy.sparse.csc_matrix: Sparse part of C if C is sparse enough, otherwise None
+
+            float: Density of the sparse part of C
+        """
+        density = self.sparse_part(C, offset_0, offset_1)
+        if density > self.sparse_threshold:
+            return scipy.sparse.linalg.aslinearoperator(C.astype('float64')), None, density
+
+        S = C.copy()
+        S[offset_0:offset_1, offset_0:offset_1] -= np.asarray(self.offset, dtype=C.dtype)
+        S = scipy.sparse.csc_matrix(S, dtype='float64')
+
+        def matvec(v):
+            v = np.ravel(v)
+            Cv = S.dot(v)
+            Cv[offset_0:offset_1] += self.offset * v[offset_0:offset_1].sum()
+            return Cv
+
+        return scipy.sparse.linalg.LinearOperator(C.shape, matvec=matvec, rmatvec=matvec, dtype='float64'), S, \
+            density
+
+    def preconditioner_operator(self, C, S):
+        """
+        Approximation of C^-1
+        Args:
+            C (numpy.array): covariance matrix
+            S (scipy.sparse.csc_matrix): Sparse part of C. None if C is dense
+
+        Returns:
+            scipy.sparse.linalg.LinearOperator: Preconditioner
+        """
+        n = C.shape[0]
+        if self.preconditioner is None:
+            return None
+
+        elif self.preconditioner == 'jacobi':
+            # The drift block has 0 diagonal
+            diagonal = np.abs(np.diag(C))
+            diagonal[diagonal == 0] = 1
+            return scipy.sparse.linalg.LinearOperator((n, n), matvec=lambda v: np.ravel(v) / diagonal,
+                                                      dtype=C.dtype)
+
+        elif self.preconditioner == 'block_jacobi':
+            # The last block takes also the drift rows, which alone are singular
+            limits = list(range(0, n, self.block_size)) + [n]
+            if len(limits) > 2 and n - limits[-2] < self.block_size:
+                limits.pop(-2)
+            blocks = []
+            for b_0, b_1 in zip(limits[:-1], limits[1:]):
+                with warnings.catch_warnings():
+                    warnings.simplefilter('error', scipy.linalg.LinAlgWarning)
+                    try:
+                        blocks.append((b_0, b_1, scipy.linalg.lu_factor(C[b_0:b_1, b_0:b_1]), None))
+                    except (scipy.linalg.LinAlgError, scipy.linalg.LinAlgWarning):
+                        blocks.append((b_0, b_1, None, scipy.linalg.pinv(C[b_0:b_1, b_0:b_1])))
+
+            def block_solve(v):
+                v = np.ravel(v)
+                x = np.empty_like(v)
+                for b_0, b_1, lu, inverse in blocks:
+                    if lu is not None:
+                        x[b_0:b_1] = scipy.linalg.lu_solve(lu, v[b_0:b_1])
+                    else:
+                        x[b_0:b_1] = inverse.dot(v[b_0:b_1])
+                return x
+
+            return scipy.sparse.linalg.LinearOperator((n, n), matvec=block_solve, dtype=C.dtype)
+
+        elif self.preconditioner == 'ilu':
+            if S is None:
+                S = scipy.sparse.csc_matrix(C)
+            ilu = scipy.sparse.linalg.spilu(S, drop_tol=self.drop_tol)
+            return scipy.sparse.linalg.LinearOperator((n, n), matvec=lambda v: ilu.solve(np.ravel(v)),
+                                                      dtype=C.dtype)
+
+    def perform(self, node, inputs, output_storage):
+        C, b, offset_0, offset_1 = inputs
+        offset_0, offset_1 = int(offset_0), int(offset_1)
+
+        # The offset is found in the dtype of C but the Krylov iterations lose orthogonality quickly in float32
+        A, S, density = self.operator(C, offset_0, offset_1)
+        C, b = C.astype('float64'), b.astype('float64')
+        M = self.preconditioner_operator(C, S)
+
+        iterations = [0]
+
+        def count(*args):
+            iterations[0] += 1
+
+        # The stopping criteria of scipy are on the preconditioned residual (minres also relative to ||C|| ||x||) so
+        # the methods are restarted from the last solution until the true residual is below tol
+        x, info = None, 0
+        for restart in range(self.max_restarts + 1):
+            if self.method == 'gmres':
+                x, info = scipy.sparse.linalg.gmres(A, b, x0=x, tol=self.tol, maxiter=self.maxiter, M=M,
+                                                    callback=count)
+            else:
+                x, info = scipy.sparse.linalg.minres(A, b, x0=x, tol=self.tol, maxiter=self.maxiter, M=M,
+                                                     callback=count)
+            residual = np.linalg.norm(A.matvec(x) - b) / np.linalg.norm(b)
+            if info != 0 or residual <= self.tol:
+                break
+
+        info = info if info != 0 or residual <= self.tol else iterations[0]
+        self.record(solver='dense' if S is None else 'sparse', density=density, iterations=iterations[0],
+                    residual=residual, info=info)
+
+        if info != 0:
+            warnings.warn('The kriging system did not converge after %d iterations. Relative residual %g' %
+                          (iterations[0], residual))
+
+        output_storage[0][0] = np.asarray(x, dtype=node.outputs[0].dtype)
+
+
+class IncrementalKrigingSolve(KrigingSolve):
+    """
+    Solve the kriging system C x = b keeping the LU factorization of the covariance matrix of every series between
+    calls. Moving k points only changes their rows and columns in C, so C = C_0 + U V^T with U and V of rank 2k and
+    the new system is solved with the factorization of C_0 and the Woodbury identity in O(n^2 k) instead of O(n^3).
+    The factorization is recomputed once the accumulated rank of the changes is bigger than max_rank. Series whose
+    matrix did not change only need the triangular solves (or nothing if b did not change either). Within a model,
+    InterpolatorInput.compute_model_incremental does not even assemble nor evaluate the series whose data did not
+    change, so only the series with the moved points reach the solver
+
+    Every call is matched with the stored factorization of the same size that differs in fewer rows, so no
+    bookkeeping of the series is needed and the results are always those of the current C. The factorizations are
+    shared by every function using the Op (e.g. the threads of InterpolatorInput.compute_series_parallel) so a call
+    holds a lock while it reads or updates them
+
+    Args:
+        max_rank (int): Maximum rank of the update before factorizing C again
+        max_factorizations (int): Number of factorizations kept. At least the number of series of the model
+        offset (float): Constant added to every entry of the covariance of the interfaces
+
+    Every call records (see solve_records) the solver used, 'factorization', 'update' or 'cached', and the rank of
+    the update
+    """
+    __props__ = ('max_rank', 'max_factorizations', 'offset')
+    stateful = True
+
+    def __init__(self, max_rank=100, max_factorizations=20, offset=1e-6):
+        super(IncrementalKrigingSolve, self).__init__(sparse_threshold=0, offset=offset)
+        self.max_rank = max_rank
+        self.max_factorizations = max_factorizations
+
+        self.factorizations = []
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks cannot be pickled (function_cache)
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def changed_rows(difference):
+        """
+        Rows such that every change of C is either in those rows or in the columns with the same indices. Moving a
+        point changes its row and its column so the greedy choice of the row with more changes finds it
+        Args:
+            difference (numpy.array): Boolean matrix with the entries of C that changed
+
+        Returns:
+            numpy.array: Indices of the rows
+        """
+        difference = difference | difference.T
+        degree = difference.sum(axis=1)
+        rows = []
+        while degree.any():
+            row = np.argmax(degree)
+            rows.append(row)
+            degree -= difference[:, row]
+            difference[:, row] = False
+            difference[row, :] = False
+            degree[row] = 0
+        return np.array(rows, dtype='int64')
+
+    def closest_factorization(self, C, offset_0, offset_1):
+        """
+        Stored factorization with the fewest rows (and columns) different from C
+        Args:
+            C (numpy.array): covariance matrix
+            offset_0 (int): First row of the covariance of the interfaces
+            offset_1 (int): Last row (excluded) of the covariance of the interfaces
+
+        Returns:
+            dict: Stored factorization. None if there is no factorization of the same size
+
+            numpy.array: Indices of the rows that changed
+        """
+        closest, changed = None, None
+        for factorization in self.factorizations:
+            if factorization['C'].shape != C.shape or factorization['offsets'] != (offset_0, offset_1):
+                continue
+            rows = self.changed_rows(factorization['C'] != C)
+            if closest is None or rows.shape[0] < changed.shape[0]:
+                closest, changed = factorization, rows
+        return closest, changed
+
+    def perform(self, node, inputs, output_storage):
+        C, b, offset_0, offset_1 = inputs
+        offset_0, offset_1 = int(offset_0), int(offset_1)
+        C, b = C.astype('float64'), b.astype('float64')
+
+        with self.lock:
+            x = self.solve(C, b, offset_0, offset_1)
+
+        output_storage[0][0] = np.asarray(x, dtype=node.outputs[0].dtype)
+
+    def solve(self, C, b, offset_0, offset_1):
+        """
+        Solve C x = b with the closest stored factorization, updating the stored factorizations. Call it holding the
+        lock
+        Args:
+            C (numpy.array): covariance matrix in float64
+            b (numpy.array): independent vector in float64
+            offset_0 (int): First row of the covariance of the interfaces
+            offset_1 (int): Last row (excluded) of the covariance of the interfaces
+
+        Returns:
+            numpy.array: x
+        """
+        factorization, changed = self.closest_factorization(C, offset_0, offset_1)
+
+        if factorization is None or 2 * changed.shape[0] > self.max_rank:
+            if factorization is not None:
+                self.factorizations.remove(factorization)
+            factorization = {'C': C, 'offsets': (offset_0, offset_1), 'lu': scipy.linalg.lu_factor(C),
+                             'b': None, 'x': None}
+            self.factorizations.append(factorization)
+            if len(self.factorizations) > self.max_factorizations:
+                self.factorizations.pop(0)
+            changed = np.zeros(0, dtype='int64')
+            self.record(solver='factorization', rank=0)
+        else:
+            self.record(solver='cached' if changed.shape[0] == 0 else 'update', rank=2 * changed.shape[0])
+
+        if changed.shape[0] == 0:
+            # Same matrix as the factorization
+            if factorization['b'] is not None and np.array_equal(factorization['b'], b):
+                x = factorization['x'].copy()
+            else:
+                x = scipy.linalg.lu_solve(factorization['lu'], b)
+                factorization['b'], factorization['x'] = b, x
+        else:
+            # C - C_0 = U V^T with the changed rows in V and the changed columns (without those rows) in U
+            k = changed.shape[0]
+            D = C - factorization['C']
+            U = np.zeros((C.shape[0], 2 * k))
+            V = np.zeros((C.shape[0], 2 * k))
+            U[changed, np.arange(k)] = 1
+            U[:, k:] = D[:, changed]
+            U[changed, k:] = 0
+            V[:, :k] = D[changed, :].T
+            V[changed, k + np.arange(k)] = 1
+
+            # Woodbury identity
+            y = scipy.linalg.lu_solve(factorization['lu'], b)
+            Z = scipy.linalg.lu_solve(factorization['lu'], U)
+            x = y - Z.dot(scipy.linalg.solve(np.eye(2 * k) + V.T.dot(Z), V.T.dot(y)))
+
+        return x
+
+
+class MixedPrecisionKrigingSolve(KrigingSolve):
+    """
+    Solve the kriging system C x = b with a float32 LU decomposition and float64 iterative refinement: the residual
+    r = b - C x is computed in float64 and the correction C dx = r solved with the float32 factorization until the
+    relative residual is below tol. The graph (covariances and kernels of the grid) can be float32 while the dual
+    kriging parameters are as accurate as with a float64 solve. If the refinement does not reach fallback_tol (C too
+    ill conditioned for float32) the system is factorized again in float64. The solution is returned in float64
+    whatever the dtype of C, rounding it to float32 would throw the refinement away
+
+    Args:
+        tol (float): Relative residual ||C x - b|| / ||b|| to stop the refinement
+        max_refinements (int): Maximum number of refinement steps
+        fallback_tol (float): Relative residual over which the system is solved in float64
+        offset (float): Constant added to every entry of the covariance of the interfaces
+
+    Every call records (see solve_records) the solver used, 'mixed' or 'float64' if the refinement did not converge,
+    the number of refinement steps and the relative residual in float64
+    """
+    __props__ = ('tol', 'max_refinements', 'fallback_tol', 'offset')
+
+    def __init__(self, tol=1e-10, max_refinements=10, fallback_tol=1e-6, offset=1e-6):
+        super(MixedPrecisionKrigingSolve, self).__init__(sparse_threshold=0, offset=offset)
+        self.tol = tol
+        self.max_refinements = max_refinements
+        self.fallback_tol = fallback_tol
+
+    def make_node(self, C, b, offset_0, offset_1):
+        node = super(MixedPrecisionKrigingSolve, self).make_node(C, b, offset_0, offset_1)
+        return theano.Apply(self, node.inputs, [T.dvector()])
+
+    def perform(self, node, inputs, output_storage):
+        C, b, offset_0, offset_1 = inputs
+        C_64, b_64 = C.astype('float64'), b.astype('float64')
+        b_norm = np.linalg.norm(b_64) or 1.
+
+        solver = 'mixed'
+        lu = scipy.linalg.lu_factor(C.astype('float32'), check_finite=False)
+        x = scipy.linalg.lu_solve(lu, b.astype('float32'), check_finite=False).astype('float64')
+        residual = np.linalg.norm(b_64 - C_64.dot(x)) / b_norm
+
+        refinements = 0
+        while residual > self.tol and refinements < self.max_refinements:
+            r = b_64 - C_64.dot(x)
+            x_new = x + scipy.linalg.lu_solve(lu, r.astype('float32'), check_finite=False)
+            residual_new = np.linalg.norm(b_64 - C_64.dot(x_new)) / b_norm
+            refinements += 1
+            # The refinement stagnates at the float64 rounding or diverges if C is too ill conditioned
+            if not residual_new < residual:
+                break
+            x, residual = x_new, residual_new
+
+        if not residual <= self.fallback_tol:
+            solver = 'float64'
+            x = scipy.linalg.solve(C_64, b_64)
+            residual = np.linalg.norm(b_64 - C_64.dot(x)) / b_norm
+
+        self.record(solver=solver, refinements=refinements, residual=residual)
+
+        output_storage[0][0] = np.asarray(x, dtype=node.outputs[0].dtype)
@@ -0,0 +1,179 @@
+"""
+Estimate of the peak memory of the computation of a model from the shapes of the input data and choice of the way
+the grid is evaluated: at once or in chunks of points (see theanograf.TheanoGraph_pro chunk_evaluation).
+
+The peak is the memory alive during the whole computation (the grid, the scan outputs of the faults and the
+lithology series) plus the biggest stage of a series: the assembly and solve of the covariance matrix, the kernels
+between the data and the points to interpolate or the segmentation of the potential field. The number of temporary
+arrays of every stage is an upper bound measured with the instrumentation of compute_model (see instrumentation).
+"""
+from __future__ import division
+
+import os
+
+import numpy as np
+
+# Number of len(DK) x len(DK) arrays alive while the kriging system is assembled and solved
+n_covariance_temporaries = 16
+
+# Number of len(DK) x chunk arrays alive at the same time in the kernels of the grid
+n_kernel_temporaries = 12
+
+# Number of arrays of the size of the block alive during the segmentation of a potential field
+n_block_temporaries = 16
+
+# Arrays of the size of the grid uploaded to the graph: coordinates (3), universal drift (9) and initial block (1).
+# Only the initial block for a regular grid, whose coordinates and drift are generated with the kernels
+n_grid_arrays = 13
+n_regular_grid_arrays = 1
+
+
+class MemoryPlan(object):
+    """
+    Estimated peak memory of the computation of a model and way of evaluating the grid
+
+    Attributes:
+        strategy (str): 'whole' if the grid is evaluated at once or 'chunks'
+        chunk_size (int): Number of points evaluated at once. None if the grid is evaluated at once
+        breakdown (dict): Bytes of every part of the peak memory: grid, scan outputs, covariance, kernels and
+            segmentation. Only the biggest of the last three is alive at the same time
+        memory_budget (float): Bytes available. None if there is no limit
+    """
+    def __init__(self, strategy, chunk_size, breakdown, memory_budget=None):
+        self.strategy = strategy
+        self.chunk_size = chunk_size
+        self.breakdown = breakdown
+        self.memory_budget = memory_budget
+
+    @property
+    def peak_memory(self):
+        """
+        Returns:
+            int: Estimated peak memory in bytes
+        """
+        b = self.breakdown
+        return b['grid'] + b['scan outputs'] + max(b['covariance'], b['kernels'], b['segmentation'])
+
+    @property
+    def fits(self):
+        """
+        Returns:
+            bool: If the peak memory is within the memory budget
+        """
+        return self.memory_budget is None or self.peak_memory <= self.memory_budget
+
+    def __repr__(self):
+        lines = ['MemoryPlan(strategy=%s, chunk_size=%s)' % (self.strategy, self.chunk_size)]
+        lines += ['    %-14s %10.2f MB' % (name, nbytes / 2**20) for name, nbytes in self.breakdown.items()]
+        lines.append('    %-14s %10.2f MB' % ('peak', self.peak_memory / 2**20))
+        if self.memory_budget is not None:
+            lines.append('    %-14s %10.2f MB' % ('budget', self.memory_budget / 2**20))
+        return '\n'.join(lines)
+
+
+def physical_memory():
+    """
+    Returns:
+        int: Bytes of physical memory of the machine. None if it cannot be found
+    """
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def estimate(len_series_w, n_grid, len_points, n_faults=0, dtype='float32', compute_all=True, only_last=False,
+             chunk_size=None, regular_grid=False):
+    """
+    Estimate the peak memory of the computation of a model
+
+    Args:
+        len_series_w (numpy.array): Length of the kriging system of every series (faults first)
+        n_grid (int): Number of points of the grid
+        len_points (int): Number of rest interface points of all the series
+        n_faults (int): Number of faults
+        dtype (str): dtype of the graph
+        compute_all (bool): If the potential field and the faults block are computed as well as the lithologies
+        only_last (bool): If only the block after the last series is kept
+        chunk_size (int): Number of points evaluated at once. None evaluates the grid at once
+        regular_grid (bool): If the coordinates and drift terms of the grid are generated in the graph
+
+    Returns:
+        MemoryPlan: Plan without memory budget
+    """
+    itemsize = np.dtype(dtype).itemsize
+    len_series_w = np.asarray(len_series_w, dtype='int64')
+    n_series = len(len_series_w)
+    n_lithologies = n_series - n_faults
+
+    # The interface points are evaluated with the grid
+    width = n_grid + 2 * len_points
+    points = width if chunk_size is None else min(chunk_size, width)
+
+    # Every iteration of the scans keeps its block and the kriging parameters of all the series
+    n_states = min(n_lithologies, 1) if only_last else n_lithologies
+    scan_outputs = n_faults * (width + len_series_w.sum()) + \
+        n_states * ((3 if compute_all else 1) * n_grid + len_series_w.sum())
+
+    length_of_C = len_series_w.max() if n_series else 0
+    if regular_grid:
+        grid_arrays, generated_arrays = n_regular_grid_arrays, n_grid_arrays - n_regular_grid_arrays
+    else:
+        grid_arrays, generated_arrays = n_grid_arrays, 0
+    breakdown = {'grid': grid_arrays * n_grid * itemsize,
+                 'scan outputs': int(scan_outputs) * itemsize,
+                 'covariance': int(n_covariance_temporaries * length_of_C ** 2) * itemsize,
+                 'kernels': int((n_kernel_temporaries * length_of_C + generated_arrays) * points) * itemsize,
+                 'segmentation': n_block_temporaries * width * itemsize}
+    return MemoryPlan('whole' if chunk_size is None else 'chunks', chunk_size, breakdown)
+
+
+def plan(len_series_w, n_grid, len_points, n_faults=0, dtype='float32', compute_all=True, only_last=False,
+         memory_budget=None, chunk_size=None, chunks=None, regular_grid=False):
+    """
+    Choose how to evaluate the grid so the peak memory fits in the memory budget. The grid is evaluated at once
+    when it fits, otherwise in the biggest chunks that fit.
+
+    Args:
+        len_series_w (numpy.array): Length of the kriging system of every series (faults first)
+        n_grid (int): Number of points of the grid
+        len_points (int): Number of rest interface points of all the series
+        n_faults (int): Number of faults
+        dtype (str): dtype of the graph
+        compute_all (bool): If the potential field and the faults block are computed as well as the lithologies
+        only_last (bool): If only the block after the last series is kept
+        memory_budget (float): Bytes available. None for no limit
+        chunk_size (int): Number of points evaluated at once. If given it is not chosen from the budget
+        chunks (bool): True to evaluate the grid in chunks, False at once. None chooses the strategy
+        regular_grid (bool): If the coordinates and drift terms of the grid are generated in the graph
+
+    Returns:
+        MemoryPlan: Strategy, chunk size and breakdown of the peak memory
+
+    Raises:
+        MemoryError: If the model does not fit in the memory budget, with the breakdown of the smallest plan
+    """
+    kwargs = dict(n_faults=n_faults, dtype=dtype, compute_all=compute_all, only_last=only_last,
+                  regular_grid=regular_grid)
+
+    if chunk_size:
+        candidate = estimate(len_series_w, n_grid, len_points, chunk_size=chunk_size, **kwargs)
+    elif memory_budget is None:
+        candidate = estimate(len_series_w, n_grid, len_points,
+                             chunk_size=n_grid + 2 * len_points if chunks else None, **kwargs)
+    else:
+        candidate = estimate(len_series_w, n_grid, len_points, **kwargs)
+        if chunks or (chunks is None and candidate.peak_memory > memory_budget):
+            # Biggest chunk whose kernels fit next to the arrays alive during the whole computation
+            b = candidate.breakdown
+            bytes_per_point = b['kernels'] / (n_grid + 2 * len_points)
+            available = memory_budget - b['grid'] - b['scan outputs']
+            chunk_size = int(min(max(available // bytes_per_point, 1), n_grid + 2 * len_points))
+            candidate = estimate(len_series_w, n_grid, len_points, chunk_size=chunk_size, **kwargs)
+
+    candidate.memory_budget = memory_budget
+    if not candidate.fits:
+        raise MemoryError('The model needs around %.2f MB, more than the memory budget of %.2f MB. Reduce the '
+                          'grid or the data.\n%r' % (candidate.peak_memory / 2**20, memory_budget / 2**20,
+                                                     candidate))
+    return candidate
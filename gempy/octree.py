@@ -0,0 +1,121 @@
+"""
+Adaptive evaluation of a regular grid. The model is evaluated first at a coarse subset of the nodes of the grid (every
+2**levels nodes along every axis). Every level the cells of the coarse grid whose corners have different segmented
+values (lithologies or fault blocks) are split in 8 and the new nodes are evaluated, while the nodes of cells with
+the same value at the 8 corners take that value without being evaluated. After the last level every node of the grid
+has a value, so the result is the same regular block but only the nodes around the interfaces are evaluated.
+
+Bodies thinner than a coarse cell that do not touch any of its corners are missed, so the coarse grid (the number of
+levels) has to resolve the thinnest unit of the model.
+"""
+from __future__ import division
+
+import itertools
+
+import numpy as np
+
+
+def level_nodes(n, level):
+    """
+    Nodes of an axis evaluated at a level: every 2**level nodes and the last one
+
+    Args:
+        n (int): Number of nodes of the axis
+        level (int): Level. 0 is the full resolution
+
+    Returns:
+        numpy.array: Indices of the nodes
+    """
+    return np.unique(np.r_[np.arange(0, n - 1, 2 ** level), n - 1])
+
+
+def node_cells(coarse, fine):
+    """
+    Cells of a coarse axis that contain (border included) every node of a fine axis
+
+    Args:
+        coarse (numpy.array): Nodes of the coarse axis
+        fine (numpy.array): Nodes of the fine axis
+
+    Returns:
+        numpy.array: float matrix (len(fine), number of cells) with 1 where the node is in the cell
+    """
+    if len(coarse) == 1:
+        return np.ones((len(fine), 1), dtype='float32')
+    return ((coarse[None, :-1] <= fine[:, None]) & (fine[:, None] <= coarse[None, 1:])).astype('float32')
+
+
+def refine_block(evaluate, resolution, levels, segmented_rows):
+    """
+    Evaluate a regular grid refining only the cells where the segmented values change
+
+    Args:
+        evaluate (function): Takes the flat indices of the nodes of the grid to evaluate and returns the values of
+            the model at them. Shape (n_rows, len(indices))
+        resolution (list): [nx, ny, nz]. The nodes of the grid are sorted as in GridClass.create_regular_grid_3d
+        levels (int): Number of levels of refinement. The coarse grid takes every 2**levels nodes
+        segmented_rows (numpy.array): bool mask of the rows of the output that are segmented and decide where the
+            cells are refined. The other rows (potential fields) are only known at the evaluated nodes
+
+    Returns:
+        numpy.array: Values of the model at every node. Shape (n_rows, nx * ny * nz). The not segmented rows are
+        NaN at the nodes that were not evaluated
+
+        numpy.array: bool mask of the evaluated nodes
+    """
+    nx, ny, nz = resolution
+    n_points = nx * ny * nz
+    segmented_rows = np.asarray(segmented_rows, dtype=bool)
+    block = np.full((len(segmented_rows), n_points), np.nan, dtype='float32')
+    evaluated = np.zeros(n_points, dtype=bool)
+
+    def flat(ix, iy, iz):
+        return (ix * ny + iy) * nz + iz
+
+    def evaluate_nodes(indices):
+        values = evaluate(indices)
+        block[:, indices] = values
+        evaluated[indices] = True
+        return values[segmented_rows]
+
+    # Coarse grid
+    axes = [level_nodes(n, levels) for n in resolution]
+    indices = flat(*np.meshgrid(*axes, indexing='ij')).ravel()
+    values = evaluate_nodes(indices).reshape((-1,) + tuple(len(a) for a in axes))
+
+    for level in range(levels - 1, -1, -1):
+        fine = [level_nodes(n, level) for n in resolution]
+
+        # Cells with different values at their corners. Axes of a single node have a flat cell
+        corner = values[:, :max(len(axes[0]) - 1, 1), :max(len(axes[1]) - 1, 1), :max(len(axes[2]) - 1, 1)]
+        refine = np.zeros(corner.shape[1:], dtype=bool)
+        offsets = [(0, 1) if len(a) > 1 else (0,) for a in axes]
+        for dx, dy, dz in itertools.product(*offsets):
+            refine |= (values[:, dx:dx + corner.shape[1], dy:dy + corner.shape[2], dz:dz + corner.shape[3]] !=
+                       corner).any(axis=0)
+
+        # Nodes of the fine grid in a refined cell
+        cells = [node_cells(c, f) for c, f in zip(axes, fine)]
+        need = np.tensordot(cells[0], refine.astype('float32'), axes=(1, 0))
+        need = np.tensordot(cells[1], need, axes=(1, 1))
+        need = np.tensordot(cells[2], need, axes=(1, 2)).transpose(2, 1, 0) > 0
+
+        # The nodes take the value of the cell they are in, which is homogeneous unless the node is evaluated
+        lower = [np.clip(np.searchsorted(c, f, side='right') - 1, 0, max(len(c) - 2, 0)) for c, f in zip(axes, fine)]
+        fine_values = values[np.ix_(np.arange(values.shape[0]), *lower)]
+
+        # Nodes of the coarse grid keep their value and the new nodes of the refined cells are evaluated
+        known = np.zeros(need.shape, dtype=bool)
+        known_ix = np.ix_(*[np.searchsorted(f, c) for c, f in zip(axes, fine)])
+        known[known_ix] = True
+        fine_values[(slice(None),) + known_ix] = values
+
+        new = np.nonzero(need & ~known)
+        if len(new[0]):
+            fine_values[(slice(None),) + new] = evaluate_nodes(flat(*[f[n] for f, n in zip(fine, new)]))
+
+        values = fine_values
+        axes = fine
+
+    block[segmented_rows] = values.reshape(values.shape[0], -1)
+    return block, evaluated
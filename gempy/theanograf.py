@@ -10,12 +10,14 @@ import theano
 import theano.tensor as T
 import numpy as np
 import sys
+from contextlib import contextmanager
+from theano.ifelse import ifelse
+from gempy import kriging_solvers
 
 theano.config.optimizer = 'fast_compile'
 theano.config.exception_verbosity = 'high'
 theano.config.compute_test_value = 'off'
 theano.config.floatX = 'float32'
-theano.config.profile_memory = True
 
 
 class TheanoGraph_pro(object):
@@ -26,7 +28,9 @@ class TheanoGraph_pro(object):
     of these methods is more and more difficult to provide (if you are in a branch close to the trunk you need all the
     results of the branches above)
     """
-    def __init__(self, verbose=[0], dtype='float32'):
+    def __init__(self, verbose=[0], dtype='float32', chunk_evaluation=False, sparse_threshold=0.1,
+                 neighbour_evaluation=False, solver='direct', solver_options=None, segmentation='hard',
+                 regular_grid=False):
         """
         In the init we need to create all the symbolic parameters that are used in the process. Most of the variables
         are shared parameters initialized with random values. At this stage we only care about the type and shape of the
@@ -37,11 +41,60 @@ class TheanoGraph_pro(object):
             as variable so this argument will be deprecated soon
             verbose (list): name of the nodes you want to print
             dtype (str): type of float either 32 or 64
+            chunk_evaluation (bool): If True the potential field is evaluated looping the points to interpolate in
+            blocks of grid_chunk_size_T points, so the memory of the kernels is O(chunk x n_data) instead of
+            O(grid x n_data)
+            sparse_threshold (float): Maximum density of the covariance matrix to solve the kriging system with a
+            sparse solver (see kriging_solvers.KrigingSolve). 0 always uses the dense solver. The covariance matrix
+            is assembled dense anyway, only the solve is sparse
+            neighbour_evaluation (bool): If True the points to interpolate are sorted in spatial bins and every chunk
+            is evaluated only with the data within the range of the chunk. Implies chunk_evaluation
+            solver (str): 'direct' to solve the kriging system with a LU decomposition (dense or sparse),
+            'iterative' to use a preconditioned Krylov method (see kriging_solvers.IterativeKrigingSolve) or
+            'incremental' to update the factorization of the previous call with the rows that changed (see
+            kriging_solvers.IncrementalKrigingSolve) or 'mixed' to factorize in float32 and refine the solution
+            in float64 (see kriging_solvers.MixedPrecisionKrigingSolve)
+            solver_options (dict): kwargs of kriging_solvers.IterativeKrigingSolve (method, preconditioner, tol,
+            maxiter...), kriging_solvers.IncrementalKrigingSolve (max_rank, max_factorizations) or
+            kriging_solvers.MixedPrecisionKrigingSolve (tol, max_refinements, fallback_tol)
+            segmentation (str): 'hard' to segment the lithologies with steps of the potential field or 'sigmoid' to
+            use sigmoid functions with slope sig_slope, so the block is differentiable respect the input data
+            regular_grid (bool): If True the grid is given by the coordinates of its nodes along every axis (grid_x_T,
+            grid_y_T and grid_z_T) and the coordinates and drift terms of the points are generated in the graph, in
+            chunks if chunk_evaluation. Otherwise, the default, the points are given in grid_val_T and
+            universal_grid_matrix_T
         """
 
         # Pass the verbose list as property
         self.verbose = verbose
+        self.dtype = dtype
         self.compute_all = False
+        self.chunk_evaluation = chunk_evaluation or neighbour_evaluation
+        self.neighbour_evaluation = neighbour_evaluation
+        self.regular_grid = regular_grid
+        # True once a graph generates the points of the regular grid (see grid_points). From then on the grid has
+        # to stay regular
+        self.regular_grid_built = False
+
+        assert segmentation in ('hard', 'sigmoid'), 'segmentation must be either hard or sigmoid'
+        self.segmentation = segmentation
+
+        # Solver of the kriging system. It chooses between a dense and a sparse solver at run time
+        assert solver in ('direct', 'iterative', 'incremental', 'mixed'), \
+            'solver must be direct, iterative, incremental or mixed'
+        if solver == 'iterative':
+            self.kriging_solver = kriging_solvers.IterativeKrigingSolve(sparse_threshold=sparse_threshold,
+                                                                        **(solver_options or {}))
+        elif solver == 'incremental':
+            self.kriging_solver = kriging_solvers.IncrementalKrigingSolve(**(solver_options or {}))
+        elif solver == 'mixed':
+            self.kriging_solver = kriging_solvers.MixedPrecisionKrigingSolve(**(solver_options or {}))
+        else:
+            self.kriging_solver = kriging_solvers.KrigingSolve(sparse_threshold=sparse_threshold)
+
+        # The mixed solver gives the dual kriging parameters in float64 so the weighted sums of the kernels are in
+        # float64 too and the potential field is only rounded to dtype at the end
+        self.weights_dtype = 'float64' if solver == 'mixed' else dtype
 
 
 
@@ -66,13 +119,32 @@ class TheanoGraph_pro(object):
         self.u_grade_T = theano.shared(np.arange(2, dtype='int64'), "Grade of the universal drift")
         self.a_T = theano.shared(np.cast[dtype](1.), "Range")
         self.c_o_T = theano.shared(np.cast[dtype](1.), 'Covariance at 0')
-        self.nugget_effect_grad_T = theano.shared(np.cast[dtype](0.01))
+        self.nugget_effect_grad_T = theano.shared(np.cast[dtype](0.01), 'Nugget effect of the gradients')
+
+        # Slope of the sigmoid segmentation. The potential field of the rescaled data varies in the order of 0.1
+        self.sig_slope = theano.shared(np.cast[dtype](1000.), 'Slope of the sigmoid segmentation')
         # -DEP-
         # self.c_resc = theano.shared(np.cast[dtype](1), "Rescaling factor")
         self.grid_val_T = theano.shared(np.cast[dtype](np.zeros((2, 3))), 'Coordinates of the grid '
                                                                           'points to interpolate')
         # Shape is 9x2, 9 drift funcitons and 2 points
-        self.universal_grid_matrix_T = theano.shared(np.cast[dtype](np.zeros((9, 2))))
+        self.universal_grid_matrix_T = theano.shared(np.cast[dtype](np.zeros((9, 2))),
+                                                     'Universal terms of the grid points')
+
+        # Coordinates of the nodes of a regular grid along every axis when regular_grid. The nodes are sorted as
+        # GridClass.create_regular_grid_3d, i.e. x varies the slowest
+        self.grid_x_T = theano.shared(np.cast[dtype](np.zeros(2)), 'Coordinates of the grid along x')
+        self.grid_y_T = theano.shared(np.cast[dtype](np.zeros(1)), 'Coordinates of the grid along y')
+        self.grid_z_T = theano.shared(np.cast[dtype](np.zeros(1)), 'Coordinates of the grid along z')
+
+        # The same coordinates in float64 without the small offset of grid_x_T. The drift terms of the grid are
+        # computed from them, as in InterpolatorClass.grid_to_theano
+        self.grid_x_drift_T = theano.shared(np.zeros(2), 'Coordinates of the grid along x for the drift')
+        self.grid_y_drift_T = theano.shared(np.zeros(1), 'Coordinates of the grid along y for the drift')
+        self.grid_z_drift_T = theano.shared(np.zeros(1), 'Coordinates of the grid along z for the drift')
+
+        # Number of points to interpolate evaluated at once when chunk_evaluation is True
+        self.grid_chunk_size_T = theano.shared(np.int64(100000), 'Number of points evaluated per chunk')
 
         # -DEP- Now I pass it as attribute when I create that part of the graph
         #self.n_faults = theano.shared(0, 'Number of faults to compute')#
@@ -86,7 +158,8 @@ class TheanoGraph_pro(object):
         self.len_series_f = theano.shared(np.arange(2, dtype='int64'), 'Length of foliations in every series')
         self.n_formations_per_serie = theano.shared(np.arange(3, dtype='int64'), 'List with the number of formations')
         self.n_formation = theano.shared(np.arange(2, dtype='int64'), "Value of the formation")
-        self.number_of_points_per_formation_T = theano.shared(np.zeros(3, dtype='int64'))
+        self.number_of_points_per_formation_T = theano.shared(np.zeros(3, dtype='int64'), 'Number of points per formation')
+        self.len_series_w = theano.shared(np.arange(2, dtype='int64'), 'Length of the kriging weights of every series')
 
         # ======================
         # VAR
@@ -116,12 +189,23 @@ class TheanoGraph_pro(object):
 
         self.u_grade_T_op = theano.shared(0)
         self.len_points = self.rest_layer_points_all.shape[0]
-        self.fault_matrix = T.zeros((0, self.grid_val_T.shape[0] + 2*self.len_points))
+        self.fault_matrix = T.zeros((0, self.n_grid() + 2*self.len_points))
 
 
         self.len_i_0 = 0
         self.len_i_1 = 1
 
+        # Dual kriging parameters of all the series. If they are given (see whole_block_model) solve_kriging takes
+        # them instead of solving the kriging system
+        self.weights_given = None
+        self.series_weights = None
+
+        # Output of the stages of the last series built: covariance_matrix, b_vector, weights (see solve_kriging) and
+        # potential_field (see potential_field_at_all). series_stages compiles them separately
+        self.stage_outputs = {}
+        self.len_w_0 = 0
+        self.len_w_1 = 1
+
 
 
 
@@ -148,6 +232,21 @@ class TheanoGraph_pro(object):
                self.ref_layer_points_all, self.rest_layer_points_all]
         return ipl
 
+    @staticmethod
+    def safe_sqrt(x):
+        """
+        Square root with gradient 0 at 0. The gradient of the square root is infinite at 0 (distance of a point to
+        itself), so the zeros are replaced by 1 inside the root and set back to 0. The values are the same than
+        T.sqrt
+        Args:
+            x (theano.tensor.matrix): non negative values
+
+        Returns:
+            theano.tensor.matrix: square root of x
+        """
+        zero = T.eq(x, 0)
+        return T.switch(zero, 0, T.sqrt(T.switch(zero, 1, x)))
+
     @staticmethod
     def squared_euclidean_distances(x_1, x_2):
         """
@@ -160,8 +259,9 @@ class TheanoGraph_pro(object):
             theano.tensor.matrix: Distancse matrix. shape n_points x n_points
         """
 
-        # T.maximum avoid negative numbers increasing stability
-        sqd = T.sqrt(T.maximum(
+        # T.maximum avoid negative numbers increasing stability. safe_sqrt keeps the zero distances (e.g. of a point to
+        # itself) differentiable
+        sqd = TheanoGraph_pro.safe_sqrt(T.maximum(
             (x_1**2).sum(1).reshape((x_1.shape[0], 1)) +
             (x_2**2).sum(1).reshape((1, x_2.shape[0])) -
             2 * x_1.dot(x_2.T), 0
@@ -195,6 +295,23 @@ class TheanoGraph_pro(object):
 
         return length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C
 
+    def unique_reference_points(self):
+        """
+        Reference points of the series without repetitions. data_prep repeats the reference point of every formation
+        once per rest point, so the rows of ref_layer_points are groups of equal consecutive rows
+        Returns:
+            theano.tensor.matrix: unique reference points. Shape number of groups x 3
+
+            theano.tensor.vector: index of the unique reference point of every row of ref_layer_points
+        """
+        n_ref = self.ref_layer_points.shape[0]
+        new_point = T.concatenate((T.ones((T.minimum(n_ref, 1),), dtype='int64'),
+                                   T.neq(self.ref_layer_points[1:], self.ref_layer_points[:-1]).any(axis=1)))
+        ref_unique = self.ref_layer_points[T.nonzero(new_point)[0]]
+        ref_index = T.cumsum(new_point) - 1
+
+        return ref_unique, ref_index
+
     def cov_interfaces(self):
         """
         Create covariance function for the interfaces
@@ -204,34 +321,29 @@ class TheanoGraph_pro(object):
 
         """
 
-        # Compute euclidian distances
+        # Compute euclidian distances. The reference points are repeated, so their distances are computed only for the
+        # unique points and expanded. The distances rest - reference are the transpose of reference - rest
+        ref_unique, ref_index = self.unique_reference_points()
         sed_rest_rest = self.squared_euclidean_distances(self.rest_layer_points, self.rest_layer_points)
-        sed_ref_rest = self.squared_euclidean_distances(self.ref_layer_points, self.rest_layer_points)
-        sed_rest_ref = self.squared_euclidean_distances(self.rest_layer_points, self.ref_layer_points)
-        sed_ref_ref = self.squared_euclidean_distances(self.ref_layer_points, self.ref_layer_points)
+        sed_ref_rest = self.squared_euclidean_distances(ref_unique, self.rest_layer_points)
+        sed_ref_ref = self.squared_euclidean_distances(ref_unique, ref_unique)
+
+        def covariance(sed):
+            # Cubic covariance function
+            return (sed < self.a_T) * (1 - 7 * (sed / self.a_T) ** 2 +
+                                       35 / 4 * (sed / self.a_T) ** 3 -
+                                       7 / 2 * (sed / self.a_T) ** 5 +
+                                       3 / 4 * (sed / self.a_T) ** 7)
 
-        # Covariance matrix for interfaces
+        C_ref_rest = covariance(sed_ref_rest)[ref_index]
+
+        # Covariance matrix for interfaces. The offset of 1e-6 is removed again by the sparse solver (see
+        # kriging_solvers.KrigingSolve)
         C_I = (self.c_o_T * self.i_reescale * (
-            (sed_rest_rest < self.a_T) *  # Rest - Rest Covariances Matrix
-            (1 - 7 * (sed_rest_rest / self.a_T) ** 2 +
-             35 / 4 * (sed_rest_rest / self.a_T) ** 3 -
-             7 / 2 * (sed_rest_rest / self.a_T) ** 5 +
-             3 / 4 * (sed_rest_rest / self.a_T) ** 7) -
-            ((sed_ref_rest < self.a_T) *  # Reference - Rest
-             (1 - 7 * (sed_ref_rest / self.a_T) ** 2 +
-              35 / 4 * (sed_ref_rest / self.a_T) ** 3 -
-              7 / 2 * (sed_ref_rest / self.a_T) ** 5 +
-              3 / 4 * (sed_ref_rest / self.a_T) ** 7)) -
-            ((sed_rest_ref < self.a_T) *  # Rest - Reference
-             (1 - 7 * (sed_rest_ref / self.a_T) ** 2 +
-              35 / 4 * (sed_rest_ref / self.a_T) ** 3 -
-              7 / 2 * (sed_rest_ref / self.a_T) ** 5 +
-              3 / 4 * (sed_rest_ref / self.a_T) ** 7)) +
-            ((sed_ref_ref < self.a_T) *  # Reference - References
-             (1 - 7 * (sed_ref_ref / self.a_T) ** 2 +
-              35 / 4 * (sed_ref_ref / self.a_T) ** 3 -
-              7 / 2 * (sed_ref_ref / self.a_T) ** 5 +
-              3 / 4 * (sed_ref_ref / self.a_T) ** 7)))) + 1e-6
+            covariance(sed_rest_rest) -  # Rest - Rest Covariances Matrix
+            C_ref_rest -  # Reference - Rest
+            C_ref_rest.T +  # Rest - Reference
+            covariance(sed_ref_ref)[ref_index][:, ref_index])) + 1e-6  # Reference - References
 
         # Add name to the theano node
         C_I.name = 'Covariance Interfaces'
@@ -246,8 +358,22 @@ class TheanoGraph_pro(object):
 
          """
 
-        # Euclidean distances
-        sed_dips_dips = self.squared_euclidean_distances(self.dips_position_tiled, self.dips_position_tiled)
+        # Euclidean distances. The tiled dips are the dips repeated once per dimension, so the distances and the terms
+        # of the covariance that only depend on them are computed for the dips and tiled
+        sed_dips = self.squared_euclidean_distances(self.dips_position, self.dips_position)
+        sed_dips_dips = T.tile(sed_dips, (self.n_dimensions, self.n_dimensions))
+
+        first_derivative = T.tile(
+            (sed_dips < self.a_T) *
+            self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed_dips / self.a_T ** 3 -
+                          35 / 2 * sed_dips ** 3 / self.a_T ** 5 +
+                          21 / 4 * sed_dips ** 5 / self.a_T ** 7),
+            (self.n_dimensions, self.n_dimensions))
+        second_derivative = T.tile(
+            (sed_dips < self.a_T) *
+            self.c_o_T * 7 * (9 * sed_dips ** 5 - 20 * self.a_T ** 2 * sed_dips ** 3 +
+                              15 * self.a_T ** 4 * sed_dips - 4 * self.a_T ** 5) / (2 * self.a_T ** 7),
+            (self.n_dimensions, self.n_dimensions))
 
         # Cartesian distances between dips positions
         h_u = T.vertical_stack(
@@ -284,20 +410,9 @@ class TheanoGraph_pro(object):
             T.eq(sed_dips_dips, 0),  # This is the condition
             0,  # If true it is equal to 0. This is how a direction affect another
             (  # else, following Chiles book
-                (h_u * h_v / sed_dips_dips ** 2) *
-                ((
-                     (sed_dips_dips < self.a_T) *  # first derivative
-                     (-self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed_dips_dips / self.a_T ** 3 -
-                                     35 / 2 * sed_dips_dips ** 3 / self.a_T ** 5 +
-                                     21 / 4 * sed_dips_dips ** 5 / self.a_T ** 7))) +
-                 (sed_dips_dips < self.a_T) *  # Second derivative
-                 self.c_o_T * 7 * (9 * sed_dips_dips ** 5 - 20 * self.a_T ** 2 * sed_dips_dips ** 3 +
-                                   15 * self.a_T ** 4 * sed_dips_dips - 4 * self.a_T ** 5) / (2 * self.a_T ** 7)) -
-                (perpendicularity_matrix *
-                 (sed_dips_dips < self.a_T) *  # first derivative
-                 self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed_dips_dips / self.a_T ** 3 -
-                               35 / 2 * sed_dips_dips ** 3 / self.a_T ** 5 +
-                               21 / 4 * sed_dips_dips ** 5 / self.a_T ** 7)))
+                (h_u * h_v / T.tile(sed_dips ** 2, (self.n_dimensions, self.n_dimensions))) *
+                (-first_derivative + second_derivative) -
+                perpendicularity_matrix * first_derivative)
         )
 
         # Setting nugget effect of the gradients
@@ -324,9 +439,17 @@ class TheanoGraph_pro(object):
               points in dip_pos
         """
 
-        # Euclidian distances
-        sed_dips_rest = self.squared_euclidean_distances(self.dips_position_tiled, self.rest_layer_points)
-        sed_dips_ref  = self.squared_euclidean_distances(self.dips_position_tiled, self.ref_layer_points)
+        # Euclidian distances. They are computed for the dips and the unique reference points and expanded with the
+        # first derivative of the covariance
+        ref_unique, ref_index = self.unique_reference_points()
+        sed_dips_rest = self.squared_euclidean_distances(self.dips_position, self.rest_layer_points)
+        sed_dips_ref = self.squared_euclidean_distances(self.dips_position, ref_unique)
+
+        def first_derivative(sed):
+            return T.tile((sed < self.a_T) *
+                          (- self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed / self.a_T ** 3 -
+                                           35 / 2 * sed ** 3 / self.a_T ** 5 +
+                                           21 / 4 * sed ** 5 / self.a_T ** 7)), (self.n_dimensions, 1))
 
         # Cartesian distances between dips and interface points
         # Rest
@@ -351,16 +474,8 @@ class TheanoGraph_pro(object):
 
         # Cross-Covariance gradients-interfaces
         C_GI = self.gi_reescale * (
-            (hu_rest *
-             (sed_dips_rest < self.a_T) *  # first derivative
-             (- self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed_dips_rest / self.a_T ** 3 -
-                              35 / 2 * sed_dips_rest ** 3 / self.a_T ** 5 +
-                              21 / 4 * sed_dips_rest ** 5 / self.a_T ** 7))) -
-            (hu_ref *
-             (sed_dips_ref < self.a_T) *  # first derivative
-             (- self.c_o_T * ((-14 / self.a_T ** 2) + 105 / 4 * sed_dips_ref / self.a_T ** 3 -
-                              35 / 2 * sed_dips_ref ** 3 / self.a_T ** 5 +
-                              21 / 4 * sed_dips_ref ** 5 / self.a_T ** 7)))
+            hu_rest * first_derivative(sed_dips_rest) -
+            hu_ref * first_derivative(sed_dips_ref)[:, ref_index]
         ).T
 
         # Add name to the theano node
@@ -657,20 +772,30 @@ class TheanoGraph_pro(object):
             theano.tensor.vector: Dual kriging parameters
 
         """
+        # The weights were computed before. We only need the ones of the computed series
+        if self.weights_given is not None:
+            DK_parameters = self.weights_given[self.len_w_0: self.len_w_1]
+            DK_parameters.name = 'Dual Kriging parameters'
+            self.stage_outputs['weights'] = DK_parameters
+            return DK_parameters
+
         C_matrix = self.covariance_matrix()
         b = self.b_vector()
-        # Solving the kriging system
-        # TODO: look for an eficient way to substitute nlianlg by a theano operation
-        import theano.tensor.slinalg
-        b2 = T.tile(b, (1, 1)).T
-        DK_parameters = theano.tensor.slinalg.solve(C_matrix, b2)
-        DK_parameters = DK_parameters.reshape((DK_parameters.shape[0],))
+        # Solving the kriging system. Dense or sparse depending on the number of covariances beyond the range
+        # -DEP-
+        # b2 = T.tile(b, (1, 1)).T
+        # DK_parameters = theano.tensor.slinalg.solve(C_matrix, b2)
+        # DK_parameters = DK_parameters.reshape((DK_parameters.shape[0],))
+        length_of_CG, length_of_CGI = self.matrices_shapes()[:2]
+        DK_parameters = self.kriging_solver(C_matrix, b, length_of_CG, length_of_CG + length_of_CGI)
       #  DK_parameters = T.dot(T.nlinalg.matrix_inverse(C_matrix), b)
         # Add name to the theano node
         DK_parameters.name = 'Dual Kriging parameters'
 
         if str(sys._getframe().f_code.co_name) in self.verbose:
             DK_parameters = theano.printing.Print(DK_parameters.name )(DK_parameters)
+
+        self.stage_outputs.update(covariance_matrix=C_matrix, b_vector=b, weights=DK_parameters)
         return DK_parameters
 
     def x_to_interpolate(self, verbose=0):
@@ -684,7 +809,10 @@ class TheanoGraph_pro(object):
         #yet_simulated = self.yet_simulated_func()
 
         # Removing points no simulated
-        pns = (self.grid_val_T * self.yet_simulated.reshape((self.yet_simulated.shape[0], 1))).nonzero_values()
+        if self.regular_grid:
+            pns = self.grid_points(T.nonzero(T.cast(self.yet_simulated, "int8"))[0])
+        else:
+            pns = (self.grid_val_T * self.yet_simulated.reshape((self.yet_simulated.shape[0], 1))).nonzero_values()
 
         # Adding the rest interface points
         grid_val = T.vertical_stack(pns.reshape((-1, 3)), self.rest_layer_points_all)
@@ -704,16 +832,138 @@ class TheanoGraph_pro(object):
 
         return grid_val
 
-    def extend_dual_kriging(self):
+    def n_grid(self):
         """
-        Tile the dual kriging vector to cover all the points to interpolate.So far I just make a matrix with the
-        dimensions len(DK)x(grid) but in the future maybe I have to try to loop all this part so consume less memory
+        Returns:
+            theano.tensor.scalar: Number of points of the grid
+        """
+        if self.regular_grid:
+            return self.grid_x_T.shape[0] * self.grid_y_T.shape[0] * self.grid_z_T.shape[0]
+        return self.grid_val_T.shape[0]
+
+    def grid_points(self, indices, axes=None):
+        """
+        Coordinates of some points of the grid. With regular_grid they are generated from the coordinates of the axes
+        so only the points asked for are in memory
+        Args:
+            indices (theano.tensor.vector): flat indices of the points in the grid
+            axes (list): theano.tensor.vector with the coordinates of the axes. Default grid_x_T, grid_y_T and
+                grid_z_T
+
+        Returns:
+            theano.tensor.matrix: Coordinates of the points. Shape len(indices) x 3
+        """
+        if not self.regular_grid:
+            return self.grid_val_T[indices]
+
+        self.regular_grid_built = True
+        grid_x, grid_y, grid_z = axes if axes is not None else (self.grid_x_T, self.grid_y_T, self.grid_z_T)
+        ny, nz = self.grid_y_T.shape[0], self.grid_z_T.shape[0]
+        return T.stack((grid_x[indices // (ny * nz)],
+                        grid_y[(indices // nz) % ny],
+                        grid_z[indices % nz]), axis=1)
+
+    @staticmethod
+    def universal_terms(points):
+        """
+        Drift terms (x, y, z, x**2, y**2, z**2, xy, xz, yz) of some points
+        Args:
+            points (theano.tensor.matrix): Coordinates of the points. Shape n x 3
+
+        Returns:
+            theano.tensor.matrix: Drift terms. Shape n x 9
+        """
+        return T.horizontal_stack(
+            points,
+            (points ** 2),
+            T.stack((points[:, 0] * points[:, 1],
+                     points[:, 0] * points[:, 2],
+                     points[:, 1] * points[:, 2]), axis=1))
+
+    def grid_universal_terms(self, indices):
+        """
+        Drift terms of some points of the grid. With regular_grid they are computed from the generated coordinates
+        without offset in float64 (grid_x_drift_T...) exactly as grid_to_theano does, otherwise they are taken from
+        universal_grid_matrix_T
+        Args:
+            indices (theano.tensor.vector): flat indices of the points in the grid
+
+        Returns:
+            theano.tensor.matrix: Drift terms. Shape 9 x len(indices)
+        """
+        if not self.regular_grid:
+            return self.universal_grid_matrix_T[:, indices]
+        points = self.grid_points(indices, (self.grid_x_drift_T, self.grid_y_drift_T, self.grid_z_drift_T))
+        return T.cast(self.universal_terms(points) + 1e-10, self.dtype).T
+
+    @contextmanager
+    def explicit_grid(self):
+        """
+        Context to build graphs that take the points to interpolate from grid_val_T and universal_grid_matrix_T even
+        with regular_grid, e.g. to give them as givens of a function
+        """
+        regular_grid, self.regular_grid = self.regular_grid, False
+        try:
+            yield
+        finally:
+            self.regular_grid = regular_grid
+
+    def universal_terms_to_interpolate(self):
+        """
+        Drift terms (x, y, z, x**2, y**2, z**2, xy, xz, yz) of the points to interpolate, i.e. the grid points yet to
+        be simulated plus the rest and the reference points. The universal terms of the grid are computed in python
+        since the grid is kind of constant, or generated in the graph with regular_grid
+        Returns:
+            theano.tensor.matrix: Drift terms. Shape 9 x number of points to interpolate
+        """
+
+        _universal_terms_interfaces_rest = self.universal_terms(self.rest_layer_points_all)
+
+        _universal_terms_interfaces_ref = self.universal_terms(self.ref_layer_points_all)
+
+        # I append rest and ref to grid
+        if self.regular_grid:
+            universal_grid = self.grid_universal_terms(T.nonzero(T.cast(self.yet_simulated, "int8"))[0])
+        else:
+            universal_grid = (self.universal_grid_matrix_T * self.yet_simulated).nonzero_values().reshape((9, -1))
+        universal_grid_interfaces_matrix = T.horizontal_stack(
+            universal_grid,
+            T.vertical_stack(_universal_terms_interfaces_rest, _universal_terms_interfaces_ref).T)
+
+        return universal_grid_interfaces_matrix
+
+    def fault_drift_to_interpolate(self):
+        """
+        Values of the faults block at the points to interpolate. The fault matrix contains the whole grid plus rest
+        and ref, so the same grid points that x_to_interpolate selects are taken, i.e. only the points yet to simulate
+        from the second lithology series on
+        Returns:
+            theano.tensor.matrix: Faults drift. Shape number of faults x number of points to interpolate
+        """
+        len_grid = self.n_grid()
+        fault_drift = T.horizontal_stack(
+            self.fault_matrix[:, :len_grid][:, T.nonzero(T.cast(self.yet_simulated, "int8"))[0]],
+            self.fault_matrix[:, len_grid:])
+
+        return fault_drift
+
+    def extend_dual_kriging(self, DK_parameters=None, grid_val=None):
+        """
+        Tile the dual kriging vector to cover all the points to interpolate. This makes a matrix with the
+        dimensions len(DK)x(grid), to keep the memory low pass only a chunk of points as grid_val (see
+        potential_field_at_chunks)
+        Args:
+            DK_parameters (theano.tensor.vector): dual kriging parameters. Default solve_kriging
+            grid_val (theano.tensor.matrix): points to interpolate. Default x_to_interpolate
+
         Returns:
             theano.tensor.matrix: Matrix with the Dk parameters repeated for all the points to interpolate
         """
 
-        grid_val = self.x_to_interpolate()
-        DK_parameters = self.solve_kriging()
+        if grid_val is None:
+            grid_val = self.x_to_interpolate()
+        if DK_parameters is None:
+            DK_parameters = self.solve_kriging()
 
 
         # Creation of a matrix of dimensions equal to the grid with the weights for every point (big 4D matrix in
@@ -722,25 +972,37 @@ class TheanoGraph_pro(object):
 
         return DK_weights
 
-    def gradient_contribution(self):
+    def gradient_contribution(self, grid_val=None, weights=None, hu_SimPoint=None, sed_dips_SimPoint=None):
         """
         Computation of the contribution of the foliations at every point to interpolate
+        Args:
+            grid_val (theano.tensor.matrix): points to interpolate. Default x_to_interpolate
+            weights (theano.tensor.matrix): dual kriging parameters tiled to grid_val. Default extend_dual_kriging
+            hu_SimPoint (theano.tensor.matrix): cartesian distances between the dips and grid_val. Default computed
+                from grid_val
+            sed_dips_SimPoint (theano.tensor.matrix): euclidean distances between the tiled dips and grid_val.
+                Default computed from grid_val
+
         Returns:
             theano.tensor.vector: Contribution of all foliations (input) at every point to interpolate
         """
-        weights = self.extend_dual_kriging()
+        if grid_val is None:
+            grid_val = self.x_to_interpolate()
+        if weights is None:
+            weights = self.extend_dual_kriging(grid_val=grid_val)
         length_of_CG = self.matrices_shapes()[0]
-        grid_val = self.x_to_interpolate()
 
         # Cartesian distances between the point to simulate and the dips
-        hu_SimPoint = T.vertical_stack(
-            (self.dips_position[:, 0] - grid_val[:, 0].reshape((grid_val[:, 0].shape[0], 1))).T,
-            (self.dips_position[:, 1] - grid_val[:, 1].reshape((grid_val[:, 1].shape[0], 1))).T,
-            (self.dips_position[:, 2] - grid_val[:, 2].reshape((grid_val[:, 2].shape[0], 1))).T
-        )
+        if hu_SimPoint is None:
+            hu_SimPoint = T.vertical_stack(
+                (self.dips_position[:, 0] - grid_val[:, 0].reshape((grid_val[:, 0].shape[0], 1))).T,
+                (self.dips_position[:, 1] - grid_val[:, 1].reshape((grid_val[:, 1].shape[0], 1))).T,
+                (self.dips_position[:, 2] - grid_val[:, 2].reshape((grid_val[:, 2].shape[0], 1))).T
+            )
 
         # Euclidian distances
-        sed_dips_SimPoint = self.squared_euclidean_distances(self.dips_position_tiled, grid_val)
+        if sed_dips_SimPoint is None:
+            sed_dips_SimPoint = self.squared_euclidean_distances(self.dips_position_tiled, grid_val)
 
         # Gradient contribution
         sigma_0_grad = T.sum(
@@ -758,19 +1020,31 @@ class TheanoGraph_pro(object):
 
         return sigma_0_grad
 
-    def interface_contribution(self):
+    def interface_contribution(self, grid_val=None, weights=None, sed_rest_SimPoint=None, sed_ref_SimPoint=None):
         """
           Computation of the contribution of the interfaces at every point to interpolate
+          Args:
+              grid_val (theano.tensor.matrix): points to interpolate. Default x_to_interpolate
+              weights (theano.tensor.matrix): dual kriging parameters tiled to grid_val. Default extend_dual_kriging
+              sed_rest_SimPoint (theano.tensor.matrix): euclidean distances between the rest points and grid_val.
+                  Default computed from grid_val
+              sed_ref_SimPoint (theano.tensor.matrix): euclidean distances between the reference points and
+                  grid_val. Default computed from grid_val
+
           Returns:
               theano.tensor.vector: Contribution of all interfaces (input) at every point to interpolate
           """
-        weights = self.extend_dual_kriging()
+        if grid_val is None:
+            grid_val = self.x_to_interpolate()
+        if weights is None:
+            weights = self.extend_dual_kriging(grid_val=grid_val)
         length_of_CG, length_of_CGI = self.matrices_shapes()[:2]
-        grid_val = self.x_to_interpolate()
 
         # Euclidian distances
-        sed_rest_SimPoint = self.squared_euclidean_distances(self.rest_layer_points, grid_val)
-        sed_ref_SimPoint = self.squared_euclidean_distances(self.ref_layer_points, grid_val)
+        if sed_rest_SimPoint is None:
+            sed_rest_SimPoint = self.squared_euclidean_distances(self.rest_layer_points, grid_val)
+        if sed_ref_SimPoint is None:
+            sed_ref_SimPoint = self.squared_euclidean_distances(self.ref_layer_points, grid_val)
 
         # Interface contribution
         sigma_0_interf = (T.sum(
@@ -792,15 +1066,23 @@ class TheanoGraph_pro(object):
 
         return sigma_0_interf
 
-    def universal_drift_contribution(self):
+    def universal_drift_contribution(self, grid_val=None, weights=None, universal_grid_interfaces_matrix=None):
         """
         Computation of the contribution of the universal drift at every point to interpolate
+        Args:
+            grid_val (theano.tensor.matrix): points to interpolate. Default x_to_interpolate
+            weights (theano.tensor.matrix): dual kriging parameters tiled to grid_val. Default extend_dual_kriging
+            universal_grid_interfaces_matrix (theano.tensor.matrix): drift terms of grid_val. Default
+                universal_terms_to_interpolate
+
         Returns:
             theano.tensor.vector: Contribution of the universal drift (input) at every point to interpolate
         """
-        weights = self.extend_dual_kriging()
+        if grid_val is None:
+            grid_val = self.x_to_interpolate()
+        if weights is None:
+            weights = self.extend_dual_kriging(grid_val=grid_val)
         length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C = self.matrices_shapes()
-        grid_val = self.x_to_interpolate()
 
         # Universal drift contribution
         # Universal terms used to calculate f0
@@ -818,33 +1100,8 @@ class TheanoGraph_pro(object):
         # Here I create the universal terms for rest and ref. The universal terms for the grid are done in python
         # and append here. The idea is that the grid is kind of constant so I do not have to recompute it every
         # time
-        _universal_terms_interfaces_rest = T.horizontal_stack(
-            self.rest_layer_points_all,
-            (self.rest_layer_points_all ** 2),
-            T.stack((self.rest_layer_points_all[:, 0] * self.rest_layer_points_all[:, 1],
-                     self.rest_layer_points_all[:, 0] * self.rest_layer_points_all[:, 2],
-                     self.rest_layer_points_all[:, 1] * self.rest_layer_points_all[:, 2]), axis=1))
-
-        _universal_terms_interfaces_ref = T.horizontal_stack(
-            self.ref_layer_points_all,
-            (self.ref_layer_points_all ** 2),
-            T.stack((self.ref_layer_points_all[:, 0] * self.ref_layer_points_all[:, 1],
-                     self.ref_layer_points_all[:, 0] * self.ref_layer_points_all[:, 2],
-                     self.ref_layer_points_all[:, 1] * self.ref_layer_points_all[:, 2]), axis=1),
-        )
-
-        # _universal_terms_interfaces = T.horizontal_stack(
-        #     self.rest_layer_points_all,
-        #     (self.rest_layer_points_all ** 2),
-        #     T.stack((self.rest_layer_points_all[:, 0] * self.rest_layer_points_all[:, 1],
-        #              self.rest_layer_points_all[:, 0] * self.rest_layer_points_all[:, 2],
-        #              self.rest_layer_points_all[:, 1] * self.rest_layer_points_all[:, 2]), axis=1)).T
-
-        # I append rest and ref to grid
-        universal_grid_interfaces_matrix = T.horizontal_stack(
-            (self.universal_grid_matrix_T * self.yet_simulated).nonzero_values().reshape((9, -1)),
-            T.vertical_stack(_universal_terms_interfaces_rest, _universal_terms_interfaces_ref).T)
-          #  T.tile(_universal_terms_interfaces, (1, 2)))
+        if universal_grid_interfaces_matrix is None:
+            universal_grid_interfaces_matrix = self.universal_terms_to_interpolate()
 
         # These are the magic terms to get the same as geomodeller
         gi_rescale_aux = T.repeat(self.gi_reescale, 9)
@@ -865,19 +1122,28 @@ class TheanoGraph_pro(object):
 
         return f_0
 
-    def faults_contribution(self):
+    def faults_contribution(self, grid_val=None, weights=None, fault_drift=None):
         """
         Computation of the contribution of the faults drift at every point to interpolate. To get these we need to
         compute a whole block model with the faults data
+        Args:
+            grid_val (theano.tensor.matrix): points to interpolate. Default x_to_interpolate
+            weights (theano.tensor.matrix): dual kriging parameters tiled to grid_val. Default extend_dual_kriging
+            fault_drift (theano.tensor.matrix): faults block at grid_val. Default fault_drift_to_interpolate
+
         Returns:
             theano.tensor.vector: Contribution of the faults drift (input) at every point to interpolate
         """
-        weights = self.extend_dual_kriging()
+        if grid_val is None:
+            grid_val = self.x_to_interpolate()
+        if weights is None:
+            weights = self.extend_dual_kriging(grid_val=grid_val)
+        if fault_drift is None:
+            fault_drift = self.fault_drift_to_interpolate()
         length_of_CG, length_of_CGI, length_of_U_I, length_of_faults, length_of_C = self.matrices_shapes()
-        grid_val = self.x_to_interpolate()
 
         # Contribution
-        f_1 = T.sum(weights[length_of_CG+length_of_CGI+length_of_U_I:, :] * self.fault_matrix[:, :grid_val.shape[0]], axis=0)
+        f_1 = T.sum(weights[length_of_CG+length_of_CGI+length_of_U_I:, :] * fault_drift, axis=0)
 
         # Add name to the theano node
         f_1.name = 'Faults contribution'
@@ -887,44 +1153,430 @@ class TheanoGraph_pro(object):
 
         return f_1
 
-    def potential_field_at_all(self):
+    def potential_field_at_chunk(self, grid_val, DK_parameters, universal_grid_interfaces_matrix, fault_drift):
+        """
+        Compute the potential field at a given set of points to interpolate. All the kernels are built with the shape
+        len(DK) x len(grid_val)
+        Args:
+            grid_val (theano.tensor.matrix): points to interpolate
+            DK_parameters (theano.tensor.vector): dual kriging parameters
+            universal_grid_interfaces_matrix (theano.tensor.matrix): drift terms at grid_val
+            fault_drift (theano.tensor.matrix): faults block at grid_val
+
+        Returns:
+            theano.tensor.vector: Potential field at grid_val
+        """
+        weights = self.extend_dual_kriging(DK_parameters, grid_val)
+
+        sigma_0_grad = self.gradient_contribution(grid_val, weights)
+        sigma_0_interf = self.interface_contribution(grid_val, weights)
+        f_0 = self.universal_drift_contribution(grid_val, weights, universal_grid_interfaces_matrix)
+        f_1 = self.faults_contribution(grid_val, weights, fault_drift)
+
+        return sigma_0_grad + sigma_0_interf + f_0 + f_1
+
+    def grid_axis_differences(self, points):
+        """
+        Differences between some points and the nodes of every axis of the regular grid. The distances between the
+        points and the grid are separable in these terms, so they are computed without the coordinates of the grid
+        (see potential_field_at_grid_nodes)
+        Args:
+            points (theano.tensor.matrix): coordinates of the points. Shape n_points x 3
+
+        Returns:
+            list: theano.tensor.matrix with the differences points - nodes along x, y and z. Shape n_points x nx, ny
+            and nz
+        """
+        return [points[:, i].reshape((-1, 1)) - axis.reshape((1, -1))
+                for i, axis in enumerate((self.grid_x_T, self.grid_y_T, self.grid_z_T))]
+
+    def grid_axis_sum(self, terms, nodes, lines=False):
+        """
+        Sum at some nodes of the regular grid of terms that depend on a single axis. With lines the terms along x and
+        y are added once per line and broadcast along z, otherwise every node gathers the terms of its axes. The
+        terms are added in the same order in both cases, so the result is the same
+        Args:
+            terms (list): theano.tensor.matrix of the terms along x, y and z. Shape n x nx, ny and nz. None for the
+                axes that do not contribute
+            nodes (theano.tensor.vector): flat indices of the nodes or, with lines, indices of the lines along z
+                (ix * ny + iy)
+            lines (bool): If nodes are lines along z
+
+        Returns:
+            theano.tensor.matrix: Sum of the terms at the nodes, in the order of the grid. Shape n x number of nodes
+        """
+        ny, nz = self.grid_y_T.shape[0], self.grid_z_T.shape[0]
+        n = [t for t in terms if t is not None][0].shape[0]
+
+        if lines:
+            line_terms = [t[:, i] for t, i in zip(terms[:2], (nodes // ny, nodes % ny)) if t is not None]
+            line_sum = sum(line_terms[1:], line_terms[0]) if line_terms else T.zeros((n, nodes.shape[0]),
+                                                                                      dtype=self.dtype)
+            z_terms = terms[2] if terms[2] is not None else T.zeros((n, nz), dtype=self.dtype)
+            return (line_sum.dimshuffle(0, 1, 'x') + z_terms.dimshuffle(0, 'x', 1)).reshape(
+                (n, nodes.shape[0] * nz))
+
+        # The terms are transposed so every node gathers contiguous rows
+        axes_nodes = (nodes // (ny * nz), (nodes // nz) % ny, nodes % nz)
+        node_terms = [t.T[i] for t, i in zip(terms, axes_nodes) if t is not None]
+        return sum(node_terms[1:], node_terms[0]).T
+
+    def potential_field_at_grid_nodes(self, nodes, DK_parameters, fault_matrix, lines=False):
+        """
+        Compute the potential field at some nodes of the regular grid. Same as potential_field_at_chunk but the
+        squared distances between the data and the grid are the sum of the squared differences along every axis (see
+        grid_axis_differences and grid_axis_sum). So there is no dot product of coordinates as in
+        squared_euclidean_distances, which also loses precision in float32
+        Args:
+            nodes (theano.tensor.vector): flat indices of the nodes or, with lines, indices of the lines along z
+            DK_parameters (theano.tensor.vector): dual kriging parameters
+            fault_matrix (theano.tensor.matrix): faults block at the grid
+            lines (bool): If nodes are lines along z, so all their nodes are evaluated
+
+        Returns:
+            theano.tensor.vector: Potential field at the nodes, in the order of the grid
+        """
+        if lines:
+            nz = self.grid_z_T.shape[0]
+            indices = (nodes.dimshuffle(0, 'x') * nz + T.arange(nz).dimshuffle('x', 0)).flatten()
+        else:
+            indices = nodes
+        grid_val = self.grid_points(indices)
+        weights = self.extend_dual_kriging(DK_parameters, grid_val)
+
+        def distances(differences):
+            # Euclidean distances, differentiable at 0 as squared_euclidean_distances
+            return self.safe_sqrt(self.grid_axis_sum([d ** 2 for d in differences], nodes, lines))
+
+        # Cartesian distances between the dips and the grid. The tiled dips are the dips repeated once per dimension,
+        # so are their distances
+        dips_differences = self.grid_axis_differences(self.dips_position)
+        hu_SimPoint = T.vertical_stack(*[
+            self.grid_axis_sum([d if j == i else None for j, d in enumerate(dips_differences)], nodes, lines)
+            for i in range(3)])
+        sed_dips_SimPoint = T.tile(distances(dips_differences), (self.n_dimensions, 1))
+
+        sed_rest_SimPoint = distances(self.grid_axis_differences(self.rest_layer_points))
+        sed_ref_SimPoint = distances(self.grid_axis_differences(self.ref_layer_points))
+
+        sigma_0_grad = self.gradient_contribution(grid_val, weights, hu_SimPoint, sed_dips_SimPoint)
+        sigma_0_interf = self.interface_contribution(grid_val, weights, sed_rest_SimPoint, sed_ref_SimPoint)
+        f_0 = self.universal_drift_contribution(grid_val, weights, self.grid_universal_terms(indices))
+        f_1 = self.faults_contribution(grid_val, weights, fault_matrix[:, indices])
+
+        return sigma_0_grad + sigma_0_interf + f_0 + f_1
+
+    def potential_field_at_chunk_neighbours(self, grid_val, DK_parameters, universal_grid_interfaces_matrix,
+                                            fault_drift):
+        """
+        Compute the potential field at a given set of points to interpolate using only the data within the range of
+        the bounding box of the points. The covariance function is 0 beyond the range so the rest of the data does not
+        contribute. The kernels are built with the shape len(DK in range) x len(grid_val)
+        Args:
+            grid_val (theano.tensor.matrix): points to interpolate
+            DK_parameters (theano.tensor.vector): dual kriging parameters
+            universal_grid_interfaces_matrix (theano.tensor.matrix): drift terms at grid_val
+            fault_drift (theano.tensor.matrix): faults block at grid_val
+
+        Returns:
+            theano.tensor.vector: Potential field at grid_val
+        """
+        length_of_CG, length_of_CGI = self.matrices_shapes()[:2]
+
+        # Distance from every data point to the bounding box of the points to interpolate
+        box_min = grid_val.min(axis=0)
+        box_max = grid_val.max(axis=0)
+
+        def distance_to_box(points):
+            return T.sqrt((T.maximum(T.maximum(box_min - points, points - box_max), 0) ** 2).sum(axis=1))
+
+        # The margin covers the rounding errors of squared_euclidean_distances
+        radius = self.a_T * 1.01
+        dips_in_range = T.nonzero(T.lt(distance_to_box(self.dips_position), radius))[0]
+        interfaces_in_range = T.nonzero(T.or_(T.lt(distance_to_box(self.rest_layer_points), radius),
+                                              T.lt(distance_to_box(self.ref_layer_points), radius)))[0]
+
+        # Dual kriging parameters of the data in range. The gradients are in the order x, y, z of all the dips
+        n_dips = self.dips_position.shape[0]
+        DK_in_range = T.concatenate((
+            DK_parameters[T.concatenate((dips_in_range, dips_in_range + n_dips, dips_in_range + 2 * n_dips))],
+            DK_parameters[length_of_CG: length_of_CG + length_of_CGI][interfaces_in_range],
+            DK_parameters[length_of_CG + length_of_CGI:]))
+
+        # The kernels take the data of the series from these attributes so we swap them for the data in range
+        data_series = (self.dips_position, self.dips_position_tiled, self.rest_layer_points, self.ref_layer_points)
+
+        self.dips_position = data_series[0][dips_in_range]
+        self.dips_position_tiled = T.tile(self.dips_position, (self.n_dimensions, 1))
+        self.rest_layer_points = data_series[2][interfaces_in_range]
+        self.ref_layer_points = data_series[3][interfaces_in_range]
+
+        Z_x = self.potential_field_at_chunk(grid_val, DK_in_range, universal_grid_interfaces_matrix, fault_drift)
+
+        self.dips_position, self.dips_position_tiled, self.rest_layer_points, self.ref_layer_points = data_series
+
+        return Z_x
+
+    def spatial_bins_order(self, points):
+        """
+        Order of the points that groups them in cubic bins of around grid_chunk_size_T points, so consecutive chunks
+        are compact in space
+        Args:
+            points (theano.tensor.matrix): points to interpolate
+
+        Returns:
+            theano.tensor.vector: Indices that sort the points by bin
+        """
+        points_min = points.min(axis=0)
+        extent = points.max(axis=0) - points_min
+        # Flat sets of points (e.g. sections)
+        extent = T.maximum(extent, extent.max() * 1e-3)
+
+        bin_length = (T.prod(extent) * self.grid_chunk_size_T / points.shape[0]) ** (1. / 3)
+        bins = T.cast(T.floor((points - points_min) / bin_length), 'int64')
+        n_bins = bins.max(axis=0) + 1
+
+        return T.argsort((bins[:, 0] * n_bins[1] + bins[:, 1]) * n_bins[2] + bins[:, 2])
+
+    def potential_field_at_chunks(self, DK_parameters=None):
         """
-        Compute the potential field at all the interpolation points, i.e. grid plus rest plus ref
+        Compute the potential field at all the interpolation points looping them in blocks of grid_chunk_size_T
+        points. The dual kriging system is solved once and only the kernels of the chunk are kept in memory so the
+        peak memory is O(chunk x n_data). The last chunk is padded with zeros and the padding is cut afterwards
+        Args:
+            DK_parameters (theano.tensor.vector): dual kriging parameters. Default solve_kriging
+
         Returns:
             theano.tensor.vector: Potential fields at all points
+        """
+        if DK_parameters is None:
+            DK_parameters = self.solve_kriging()
+
+        grid_val = self.x_to_interpolate()
+        universal_grid_interfaces_matrix = self.universal_terms_to_interpolate()
+        fault_drift = self.fault_drift_to_interpolate()
+
+        if self.neighbour_evaluation:
+            spatial_order = self.spatial_bins_order(grid_val)
+            grid_val = grid_val[spatial_order]
+            universal_grid_interfaces_matrix = universal_grid_interfaces_matrix[:, spatial_order]
+            fault_drift = fault_drift[:, spatial_order]
+
+        # Padding to a multiple of the chunk size. The points are padded with the last point so the padding does not
+        # change the bounding box of the last chunk
+        len_points = grid_val.shape[0]
+        n_chunks = (len_points - 1) // self.grid_chunk_size_T + 1
+        len_pad = n_chunks * self.grid_chunk_size_T - len_points
+
+        grid_val_pad = T.vertical_stack(grid_val, T.repeat(grid_val[-1:], len_pad, axis=0))
+        universal_pad = T.horizontal_stack(universal_grid_interfaces_matrix,
+                                           T.zeros((9, len_pad), dtype=universal_grid_interfaces_matrix.dtype))
+        fault_drift_pad = T.horizontal_stack(fault_drift,
+                                             T.zeros((fault_drift.shape[0], len_pad), dtype=fault_drift.dtype))
+
+        def chunk_potential(n_chunk, grid_val_c, universal_c, fault_drift_c, DK):
+            """
+            Potential field of one chunk
+            Args:
+                n_chunk (scalar): number of the chunk
+                grid_val_c, universal_c, fault_drift_c: padded points, drift terms and faults block
+                DK: dual kriging parameters
 
+            Returns:
+                theano.tensor.vector: Potential field at the points of the chunk
+            """
+            c_0 = n_chunk * self.grid_chunk_size_T
+            c_1 = c_0 + self.grid_chunk_size_T
+            if self.neighbour_evaluation:
+                return self.potential_field_at_chunk_neighbours(grid_val_c[c_0: c_1], DK,
+                                                                universal_c[:, c_0: c_1], fault_drift_c[:, c_0: c_1])
+            return self.potential_field_at_chunk(grid_val_c[c_0: c_1], DK,
+                                                 universal_c[:, c_0: c_1], fault_drift_c[:, c_0: c_1])
+
+        Z_x_chunks, updates_c = theano.scan(
+            fn=chunk_potential,
+            outputs_info=None,
+            sequences=T.arange(n_chunks),
+            non_sequences=[grid_val_pad, universal_pad, fault_drift_pad, DK_parameters])
+
+        Z_x = Z_x_chunks.flatten()[:len_points]
+
+        # Back to the order of x_to_interpolate
+        if self.neighbour_evaluation:
+            Z_x = T.set_subtensor(T.zeros_like(Z_x)[spatial_order], Z_x)
+
+        return Z_x
+
+    def potential_field_at_regular_grid(self, DK_parameters):
         """
-        sigma_0_grad = self.gradient_contribution()
-        sigma_0_interf = self.interface_contribution()
-        f_0 = self.universal_drift_contribution()
-        f_1 = self.faults_contribution()
-        # -DEP-
-        # length_of_CGI = self.matrices_shapes()[1]
+        Compute the potential field at all the interpolation points of a regular grid with separable distances (see
+        potential_field_at_grid_nodes). When all the grid is yet to simulate, e.g. the first series, it is evaluated
+        line by line along z, otherwise only at the points yet to simulate. With chunk_evaluation the points of the
+        grid are generated chunk by chunk (see grid_points), so neither the coordinates nor the drift terms of the
+        whole grid are in memory. The rest and reference points are evaluated at once after the grid
+        Args:
+            DK_parameters (theano.tensor.vector): dual kriging parameters
 
-        Z_x = (sigma_0_grad + sigma_0_interf + f_0 + f_1)#[:-2*self.rest_layer_points_all.shape[0]]
+        Returns:
+            theano.tensor.vector: Potential fields at all points, in the order of x_to_interpolate
+        """
+        simulated = T.nonzero(T.cast(self.yet_simulated, "int8"))[0]
+        len_grid = self.n_grid()
+
+        # Rest and reference points
+        interfaces = T.vertical_stack(self.rest_layer_points_all, self.ref_layer_points_all)
+        Z_x_interfaces = self.potential_field_at_chunk(interfaces, DK_parameters, self.universal_terms(interfaces).T,
+                                                       self.fault_matrix[:, len_grid:])
+
+        # Only the branch taken is computed
+        Z_x_grid = ifelse(T.eq(simulated.shape[0], len_grid),
+                          self.potential_field_at_whole_grid(DK_parameters),
+                          self.potential_field_at_grid_points(simulated, DK_parameters))
+
+        return T.concatenate((Z_x_grid, Z_x_interfaces))
+
+    def potential_field_at_whole_grid(self, DK_parameters):
+        """
+        Compute the potential field at all the nodes of the regular grid line by line along z (see
+        potential_field_at_grid_nodes). With chunk_evaluation every chunk is as many lines along z as fit in
+        grid_chunk_size_T points, at least one
+        Args:
+            DK_parameters (theano.tensor.vector): dual kriging parameters
+
+        Returns:
+            theano.tensor.vector: Potential field at the grid
+        """
+        nz = self.grid_z_T.shape[0]
+        n_lines = self.grid_x_T.shape[0] * self.grid_y_T.shape[0]
+
+        if not self.chunk_evaluation:
+            return self.potential_field_at_grid_nodes(T.arange(n_lines), DK_parameters, self.fault_matrix, lines=True)
+
+        # The last chunk is padded repeating the last line
+        lines_per_chunk = T.maximum(self.grid_chunk_size_T // nz, 1)
+        n_chunks = (n_lines - 1) // lines_per_chunk + 1
+
+        def chunk_potential(n_chunk, fault_matrix, DK):
+            """
+            Potential field of one chunk of lines
+            Args:
+                n_chunk (scalar): number of the chunk
+                fault_matrix: faults block
+                DK: dual kriging parameters
+
+            Returns:
+                theano.tensor.vector: Potential field at the nodes of the lines of the chunk
+            """
+            lines = T.minimum(T.arange(n_chunk * lines_per_chunk, (n_chunk + 1) * lines_per_chunk), n_lines - 1)
+            return self.potential_field_at_grid_nodes(lines, DK, fault_matrix, lines=True)
 
+        Z_x_chunks, updates_c = theano.scan(
+            fn=chunk_potential,
+            outputs_info=None,
+            sequences=T.arange(n_chunks),
+            non_sequences=[self.fault_matrix, DK_parameters])
+
+        return Z_x_chunks.flatten()[:n_lines * nz]
+
+    def potential_field_at_grid_points(self, simulated, DK_parameters):
+        """
+        Compute the potential field at some points of the regular grid (see potential_field_at_grid_nodes), in chunks
+        of grid_chunk_size_T points with chunk_evaluation
+        Args:
+            simulated (theano.tensor.vector): flat indices of the points in the grid
+            DK_parameters (theano.tensor.vector): dual kriging parameters
+
+        Returns:
+            theano.tensor.vector: Potential field at the points
+        """
+        if not self.chunk_evaluation:
+            return self.potential_field_at_grid_nodes(simulated, DK_parameters, self.fault_matrix)
+
+        # Padding to a multiple of the chunk size with the first point of the grid. scan needs at least one chunk
+        # even if all the grid is already simulated
+        len_points = simulated.shape[0]
+        n_chunks = T.maximum((len_points - 1) // self.grid_chunk_size_T + 1, 1)
+        len_pad = n_chunks * self.grid_chunk_size_T - len_points
+        simulated_pad = T.concatenate((simulated, T.zeros((len_pad,), dtype=simulated.dtype)))
+
+        def chunk_potential(n_chunk, simulated_c, fault_matrix, DK):
+            """
+            Potential field of one chunk of the grid
+            Args:
+                n_chunk (scalar): number of the chunk
+                simulated_c: padded indices of the points of the grid to interpolate
+                fault_matrix: faults block
+                DK: dual kriging parameters
+
+            Returns:
+                theano.tensor.vector: Potential field at the points of the chunk
+            """
+            c_0 = n_chunk * self.grid_chunk_size_T
+            return self.potential_field_at_grid_nodes(simulated_c[c_0: c_0 + self.grid_chunk_size_T], DK,
+                                                      fault_matrix)
+
+        Z_x_chunks, updates_c = theano.scan(
+            fn=chunk_potential,
+            outputs_info=None,
+            sequences=T.arange(n_chunks),
+            non_sequences=[simulated_pad, self.fault_matrix, DK_parameters])
+
+        return Z_x_chunks.flatten()[:len_points]
+
+    def potential_field_at_all(self, DK_parameters=None):
+        """
+        Compute the potential field at all the interpolation points, i.e. grid plus rest plus ref. The kriging system
+        is solved only once and every kernel is built once, so call this method once per series and pass Z_x to the
+        methods that need it (potential_field_at_interfaces, block_series)
+        Args:
+            DK_parameters (theano.tensor.vector): dual kriging parameters. Default solve_kriging
+
+        Returns:
+            theano.tensor.vector: Potential fields at all points
+
+        """
+        if DK_parameters is None:
+            DK_parameters = self.solve_kriging()
+
+        if self.regular_grid and not self.neighbour_evaluation:
+            Z_x = self.potential_field_at_regular_grid(DK_parameters)
+        elif self.chunk_evaluation:
+            Z_x = self.potential_field_at_chunks(DK_parameters)
+        else:
+            # -DEP-
+            # length_of_CGI = self.matrices_shapes()[1]
+            grid_val = self.x_to_interpolate()
+            Z_x = self.potential_field_at_chunk(grid_val, DK_parameters,
+                                                self.universal_terms_to_interpolate(),
+                                                self.fault_drift_to_interpolate())
+
+        # float64 weights (mixed solver) upcast the sums of the contributions
+        Z_x = T.cast(Z_x, self.dtype)
         Z_x.name = 'Value of the potential field at every point'
 
         if str(sys._getframe().f_code.co_name) in self.verbose:
             Z_x = theano.printing.Print('Potential field at all points')(Z_x)
+
+        self.stage_outputs['potential_field'] = Z_x
         return Z_x
 
-    def potential_field_at_interfaces(self):
+    def potential_field_at_interfaces(self, Z_x=None):
         """
         Potential field at interfaces. To avoid errors I take all the points of rest that belong to one interface
         and make the average
+        Args:
+            Z_x (theano.tensor.vector): Potential field at all the interpolation points. Default
+                potential_field_at_all
+
         Returns:
             theano.tensor.vector: Potential field values at the interfaces of a given series
         """
-        sigma_0_grad = self.gradient_contribution()
-        sigma_0_interf = self.interface_contribution()
-        f_0 = self.universal_drift_contribution()
-        f_1 = self.faults_contribution()
         # -DEP-
         #length_of_CGI = self.matrices_shapes()[1]
+        if Z_x is None:
+            Z_x = self.potential_field_at_all()
 
-        potential_field_interfaces = (sigma_0_grad + sigma_0_interf + f_0 + f_1)[-2*self.len_points:
-                                                                                 -self.len_points]
+        potential_field_interfaces = Z_x[-2*self.len_points: -self.len_points]
 
         npf = T.cumsum(T.concatenate((T.stack(0), self.number_of_points_per_formation_T)))
 
@@ -956,23 +1608,33 @@ class TheanoGraph_pro(object):
                                                                       (potential_field_interfaces_unique)
         return potential_field_interfaces_unique
 
-    def block_series(self):
+    def block_series(self, Z_x=None):
         """
         Compute the part of the block model of a given series (dictated by the bool array yet to be computed)
+        Args:
+            Z_x (theano.tensor.vector): Potential field at all the interpolation points. Default
+                potential_field_at_all
+
         Returns:
             theano.tensor.vector: Value of lithology at every interpolated point
         """
 
         # Graph to compute the potential field
-        Z_x = self.potential_field_at_all()
+        if Z_x is None:
+            Z_x = self.potential_field_at_all()
 
         # Max and min values of the potential field.
         # TODO this may be expensive because I guess that is a sort algorithm. We just need a +inf and -inf... I guess
-        max_pot = T.max(Z_x)  #T.max(potential_field_unique) + 1
-        min_pot = T.min(Z_x)   #T.min(potential_field_unique) - 1
+        if self.segmentation == 'sigmoid':
+            # With the sigmoids the extremes would be only half of the formation
+            max_pot = T.constant(np.inf, dtype=Z_x.dtype)
+            min_pot = T.constant(-np.inf, dtype=Z_x.dtype)
+        else:
+            max_pot = T.max(Z_x)  #T.max(potential_field_unique) + 1
+            min_pot = T.min(Z_x)   #T.min(potential_field_unique) - 1
 
         # Value of the potential field at the interfaces of the computed series
-        potential_field_at_interfaces = self.potential_field_at_interfaces()[self.n_formation_op-1]
+        potential_field_at_interfaces = self.potential_field_at_interfaces(Z_x)[self.n_formation_op-1]
 
         # A tensor with the values to segment
         potential_field_iter = T.concatenate((T.stack([max_pot]),
@@ -982,17 +1644,16 @@ class TheanoGraph_pro(object):
         if "potential_field_iter" in self.verbose:
             potential_field_iter = theano.printing.Print("potential_field_iter")(potential_field_iter)
 
-        if "potential_field_at_interfaces":
+        if "potential_field_at_interfaces" in self.verbose:
             potential_field_at_interfaces = theano.printing.Print('Potential field')(
-                self.potential_field_at_interfaces())
+                self.potential_field_at_interfaces(Z_x))
             potential_field_at_interfaces = theano.printing.Print('Selected pt')(
                 potential_field_at_interfaces[self.n_formation_op - 1])
 
         # Loop to segment the distinct lithologies
         def compare(a, b, n_formation, Zx):
             """
-            Treshold of the points to interpolate given 2 potential field values. TODO: This function is the one we
-            need to change for a sigmoid function
+            Treshold of the points to interpolate given 2 potential field values
             Args:
                 a (scalar): Upper limit of the potential field
                 b (scalar): Lower limit of the potential field
@@ -1005,8 +1666,24 @@ class TheanoGraph_pro(object):
 
             return T.le(Zx, a) * T.ge(Zx, b) * n_formation
 
+        def compare_sigmoid(a, b, n_formation, Zx):
+            """
+            Smooth treshold of the points to interpolate given 2 potential field values. The difference of two
+            sigmoids is n_formation between b and a and goes to 0 outside with slope sig_slope
+            Args:
+                a (scalar): Upper limit of the potential field
+                b (scalar): Lower limit of the potential field
+                n_formation (scalar): Value given to the segmentation, i.e. lithology number
+                Zx (vector): Potential field values at all the interpolated points
+
+            Returns:
+                theano.tensor.vector: segmented values
+            """
+            return (T.nnet.sigmoid(self.sig_slope * (Zx - b)) - T.nnet.sigmoid(self.sig_slope * (Zx - a))) * \
+                T.cast(n_formation, Zx.dtype)
+
         partial_block, updates2 = theano.scan(
-            fn=compare,
+            fn=compare_sigmoid if self.segmentation == 'sigmoid' else compare,
             outputs_info=None,
             sequences=[dict(input=potential_field_iter, taps=[0, 1]), self.n_formation_op],
             non_sequences=Z_x)
@@ -1021,12 +1698,27 @@ class TheanoGraph_pro(object):
 
         return partial_block
 
+    def not_simulated(self, block):
+        """
+        Points of the block that no series has filled yet. With the sigmoid segmentation the block is never exactly 0
+        so the points under half of the first formation number (1) count as empty
+        Args:
+            block (theano.tensor.vector): Block computed so far
+
+        Returns:
+            theano.tensor.vector: Boolean vector with the points to compute
+        """
+        if self.segmentation == 'sigmoid':
+            return T.lt(block, 0.5)
+        return T.eq(block, 0)
+
     def compute_a_fault(self,
                         len_i_0, len_i_1,
                         len_f_0, len_f_1,
                         n_form_per_serie_0, n_form_per_serie_1,
                         u_grade_iter,
-                        final_block
+                        len_w_0, len_w_1,
+                        final_block, weights
                         ):
         """
         Function that loops each fault, generating a potential field for each on them with the respective block model
@@ -1037,10 +1729,15 @@ class TheanoGraph_pro(object):
             len_f_1: Length of dips of the computed series
             n_form_per_serie_0: Number of formations of previous series
             n_form_per_serie_1: Number of formations of the computed series
+            len_w_0: Lenght of the kriging weights of previous series
+            len_w_1: Lenght of the kriging weights of the computed series
+            weights: Dual kriging parameters of all the series
 
         Returns:
             theano.tensor.matrix: block model derived from the faults that afterwards is used as a drift for the "real"
             data
+
+            theano.tensor.vector: Dual kriging parameters with the ones of the computed fault
         """
 
         # THIS IS THE FAULTS BLOCK.
@@ -1053,7 +1750,7 @@ class TheanoGraph_pro(object):
 
         # -DEP- Until I add network faults
       #  self.yet_simulated = T.eq(final_block[0, :], 0)
-        self.yet_simulated = T.eq(final_block[0, :-2*self.len_points], 0)
+        self.yet_simulated = self.not_simulated(final_block[0, :-2*self.len_points])
         self.yet_simulated.name = 'Yet simulated FAULTS node'
         #self.yet_simulated.name = 'Yet simulated node'
 
@@ -1075,6 +1772,13 @@ class TheanoGraph_pro(object):
         self.ref_layer_points = self.ref_layer_points_all[len_i_0: len_i_1, :]
         self.rest_layer_points = self.rest_layer_points_all[len_i_0: len_i_1, :]
 
+        # For the contribution of the faults
+        self.len_i_0 = len_i_0
+        self.len_i_1 = len_i_1
+
+        self.len_w_0 = len_w_0
+        self.len_w_1 = len_w_1
+
        # self.fault_matrix_at_rest = self.fault_matrix[]
        # self.fault_matrix_at_ref =
 
@@ -1087,7 +1791,8 @@ class TheanoGraph_pro(object):
         # ====================
        # faults_matrix = self.block_series()
 
-        faults_matrix = self.block_series()
+        DK_parameters = self.solve_kriging()
+        faults_matrix = self.block_series(self.potential_field_at_all(DK_parameters))
         aux_ones = T.ones([2*self.len_points])
         faults_select = T.concatenate((self.yet_simulated, aux_ones))
 
@@ -1101,14 +1806,17 @@ class TheanoGraph_pro(object):
         #    final_block[T.nonzero(T.cast(self.yet_simulated, "int8"))[0]],
         #    potential_field_contribution)
 
-        return block_matrix
+        weights = T.set_subtensor(weights[len_w_0: len_w_1], DK_parameters)
+
+        return block_matrix, weights
 
     def compute_a_series(self,
                          len_i_0, len_i_1,
                          len_f_0, len_f_1,
                          n_form_per_serie_0, n_form_per_serie_1,
                          u_grade_iter,
-                         final_block):
+                         len_w_0, len_w_1,
+                         final_block, weights):
 
         """
         Function that loops each series, generating a potential field for each on them with the respective block model
@@ -1119,9 +1827,14 @@ class TheanoGraph_pro(object):
              len_f_1: Length of dips of the computed series
              n_form_per_serie_0: Number of formations of previous series
              n_form_per_serie_1: Number of formations of the computed series
+             len_w_0: Lenght of the kriging weights of previous series
+             len_w_1: Lenght of the kriging weights of the computed series
+             weights: Dual kriging parameters of all the series
 
         Returns:
              theano.tensor.matrix: final block model
+
+             theano.tensor.vector: Dual kriging parameters with the ones of the computed series
         """
 
         # THIS IS THE FINAL BLOCK. (DO I NEED TO LOOP THE FAULTS FIRST? Yes you do)
@@ -1129,7 +1842,7 @@ class TheanoGraph_pro(object):
         # Preparing the data
         # ==================
         # Vector that controls the points that have been simulated in previous iterations
-        self.yet_simulated = T.eq(final_block[0, :], 0)
+        self.yet_simulated = self.not_simulated(final_block[0, :])
         self.yet_simulated.name = 'Yet simulated LITHOLOGY node'
 
         # Theano shared
@@ -1152,6 +1865,9 @@ class TheanoGraph_pro(object):
         self.len_i_0 = len_i_0
         self.len_i_1 = len_i_1
 
+        self.len_w_0 = len_w_0
+        self.len_w_1 = len_w_1
+
         # Printing
         if 'yet_simulated' in self.verbose:
             self.yet_simulated = theano.printing.Print(self.yet_simulated.name)(self.yet_simulated)
@@ -1161,14 +1877,17 @@ class TheanoGraph_pro(object):
         # ====================
         # Computing the series
         # ====================
-        potential_field_contribution = self.block_series()[:-2*self.len_points]
+        # The potential field is computed once and used for the segmentation and as output
+        DK_parameters = self.solve_kriging()
+        Z_x = self.potential_field_at_all(DK_parameters)
+        potential_field_contribution = self.block_series(Z_x)[:-2*self.len_points]
 
         final_block = T.set_subtensor(
             final_block[0, T.nonzero(T.cast(self.yet_simulated, "int8"))[0]],
             potential_field_contribution)
 
         if self.compute_all:
-            potential_field_values = self.potential_field_at_all()[:-2*self.len_points]
+            potential_field_values = Z_x[:-2*self.len_points]
 
             final_block = T.set_subtensor(
             final_block[1, T.nonzero(T.cast(self.yet_simulated, "int8"))[0]],
@@ -1180,7 +1899,9 @@ class TheanoGraph_pro(object):
 
             #final_block_out = T.vertical_stack(final_block, pf)
 
-        return final_block
+        weights = T.set_subtensor(weights[len_w_0: len_w_1], DK_parameters)
+
+        return final_block, weights
 
     # def compute_a_series_pf(self,
     #                      len_i_0, len_i_1,
@@ -1243,13 +1964,19 @@ class TheanoGraph_pro(object):
     #
     #     return potential_field_contribution
 
-    def whole_block_model(self, n_faults=0, compute_all=True):
+    def whole_block_model(self, n_faults=0, compute_all=True, only_last=False, weights=None):
 
         """
         Final function that loops first all the faults, then uses that result in the final block and loops again the
         series
         Args:
             n_faults (int): Number of faults to extract the correct values from the big input matrices
+            compute_all (bool): If True the potential field and the faults block are stacked to the lithology block
+            only_last (bool): If True only the final state of the loop of the series is returned instead of the block
+                after every series. Compiled with the scan memory optimization (see compile_mode) only the last
+                state of the loops is kept in memory
+            weights (theano.tensor.vector): Dual kriging parameters of all the series (see kriging_weights). If
+                given the kriging systems are not solved
 
         Returns:
             theano.tensor.vector: Final block model with the segmented lithologies
@@ -1260,22 +1987,32 @@ class TheanoGraph_pro(object):
         if n_faults != 0:
             self.is_fault=True
 
+        # The graph can be built several times with the same object so we reset the faults block
+        self.fault_matrix = T.zeros((0, self.n_grid() + 2*self.len_points))
+
+        self.weights_given = weights
+        if weights is None:
+            weights_init = T.zeros((self.len_series_w[-1],), dtype=self.weights_dtype)
+        else:
+            weights_init = weights
+        weights_init.name = 'Dual kriging parameters init'
 
         # Check if there are faults and loop them to create the Faults block
         if n_faults != 0:
             # we initialize the final block
-            fault_block_init = T.zeros((1, self.grid_val_T.shape[0]+2*self.len_points))  # self.final_block
+            fault_block_init = T.zeros((1, self.n_grid() + 2*self.len_points))  # self.final_block
             fault_block_init.name = 'final block of faults init'
             self.yet_simulated = T.eq(fault_block_init[0, :-2*self.len_points], 0)
 
 
-            fault_matrix, updates3 = theano.scan(
+            (fault_matrix, weights_faults), updates3 = theano.scan(
                  fn=self.compute_a_fault,
-                 outputs_info=fault_block_init,  #  This line may be used for the faults network
+                 outputs_info=[fault_block_init, weights_init],  #  This line may be used for the faults network
                  sequences=[dict(input=self.len_series_i[:n_faults+1], taps=[0, 1]),
                             dict(input=self.len_series_f[:n_faults+1], taps=[0, 1]),
                             dict(input=self.n_formations_per_serie[:n_faults+1], taps=[0, 1]),
-                            dict(input=self.u_grade_T[:n_faults + 1], taps=[0])]
+                            dict(input=self.u_grade_T[:n_faults + 1], taps=[0]),
+                            dict(input=self.len_series_w[:n_faults+1], taps=[0, 1])]
                  )
             # fault_matrix, updates3 = theano.scan(
             #     fn=self.compute_a_series,
@@ -1287,6 +2024,7 @@ class TheanoGraph_pro(object):
             #     )
 
             self.fault_matrix = fault_matrix[-1]
+            weights_init = weights_faults[-1]
 
             if 'faults block' in self.verbose:
                 self.fault_matrix = theano.printing.Print('I am outside the faults')(fault_matrix[-1])
@@ -1302,13 +2040,14 @@ class TheanoGraph_pro(object):
             if self.compute_all:
                 final_block_init = T.vertical_stack(self.final_block, self.final_block, self.final_block)
                 # Loop the series to create the Final block
-                all_series, updates2 = theano.scan(
+                (all_series, weights_series), updates2 = theano.scan(
                     fn=self.compute_a_series,
-                    outputs_info=final_block_init,
+                    outputs_info=[final_block_init, weights_init],
                     sequences=[dict(input=self.len_series_i[n_faults:], taps=[0, 1]),
                                dict(input=self.len_series_f[n_faults:], taps=[0, 1]),
                                dict(input=self.n_formations_per_serie[n_faults:], taps=[0, 1]),
-                               dict(input=self.u_grade_T[n_faults:], taps=[0])]
+                               dict(input=self.u_grade_T[n_faults:], taps=[0]),
+                               dict(input=self.len_series_w[n_faults:], taps=[0, 1])]
                 # all_series_pf, updates3 = theano.scan(
                 #      fn=self.compute_a_series,
                 #      outputs_info=final_block_init,
@@ -1320,20 +2059,169 @@ class TheanoGraph_pro(object):
 
             else:
                 # Loop the series to create the Final block
-                all_series, updates2 = theano.scan(
+                (all_series, weights_series), updates2 = theano.scan(
                     fn=self.compute_a_series,
-                    outputs_info=final_block_init,
+                    outputs_info=[final_block_init, weights_init],
                     sequences=[dict(input=self.len_series_i[n_faults:], taps=[0, 1]),
                                dict(input=self.len_series_f[n_faults:], taps=[0, 1]),
                                dict(input=self.n_formations_per_serie[n_faults:], taps=[0, 1]),
-                               dict(input=self.u_grade_T[n_faults:], taps=[0])]
+                               dict(input=self.u_grade_T[n_faults:], taps=[0]),
+                               dict(input=self.len_series_w[n_faults:], taps=[0, 1])]
                 )
+            self.series_weights = weights_series[-1]
+            if only_last:
+                all_series = all_series[-1]
         else:
             # We just pass the faults block
             all_series = self.fault_matrix
+            self.series_weights = weights_init
 
         return all_series
 
+    def kriging_weights(self, n_faults=0):
+        """
+        Dual kriging parameters of all the series concatenated in the order of the series (see len_series_w). They
+        only depend on the input data and the kriging parameters so they can be computed without grid (see
+        InterpolatorInput.get_kriging_weights) and passed to whole_block_model to evaluate the model anywhere
+        Args:
+            n_faults (int): Number of faults to extract the correct values from the big input matrices
+
+        Returns:
+            theano.tensor.vector: Dual kriging parameters
+        """
+        self.whole_block_model(n_faults, compute_all=False)
+        return self.series_weights
+
+    def single_series_block(self, series, n_faults=0, compute_all=True, fault_matrix=None):
+        """
+        Block of one lithology series at the whole grid, independently of the other series. The result of every
+        series is the same than in whole_block_model in the cells that the younger series did not fill, so the
+        series can be computed in parallel and merged afterwards in stratigraphic order (see
+        InterpolatorInput.compute_series_parallel)
+        Args:
+            series (theano.tensor.scalar): Index of the series counting only the lithology series
+            n_faults (int): Number of faults to extract the correct values from the big input matrices
+            compute_all (bool): If True the potential field and the faults block are stacked to the lithology block
+            fault_matrix (theano.tensor.matrix): Faults block at the grid and the interfaces (self.fault_matrix
+                after whole_block_model). Required if there are faults
+
+        Returns:
+            theano.tensor.matrix: Block of the series
+        """
+        self.compute_all = compute_all
+        self.is_fault = n_faults != 0
+        self.weights_given = None
+
+        if fault_matrix is None:
+            fault_matrix = T.zeros((0, self.n_grid() + 2*self.len_points))
+        self.fault_matrix = fault_matrix
+
+        if compute_all:
+            final_block_init = T.vertical_stack(self.final_block, self.final_block, self.final_block)
+        else:
+            final_block_init = self.final_block
+        weights_init = T.zeros((self.len_series_w[-1],), dtype=self.weights_dtype)
+
+        i = series + n_faults
+        block, weights = self.compute_a_series(self.len_series_i[i], self.len_series_i[i+1],
+                                               self.len_series_f[i], self.len_series_f[i+1],
+                                               self.n_formations_per_serie[i], self.n_formations_per_serie[i+1],
+                                               self.u_grade_T[i],
+                                               self.len_series_w[i], self.len_series_w[i+1],
+                                               final_block_init, weights_init)
+        return block
+
+    def series_stages(self, series, n_faults=0, compute_all=True, fault=False, final_block=None, fault_matrix=None):
+        """
+        Graph of one series as in whole_block_model, together with the output of its stages: covariance matrix and b
+        vector, dual kriging parameters, potential field and block. The stages can be compiled and timed separately
+        replacing the output of the previous stage by an input (see InterpolatorInput.compute_model_instrumented)
+        Args:
+            series (theano.tensor.scalar): Index of the series counting the faults
+            n_faults (int): Number of faults to extract the correct values from the big input matrices
+            compute_all (bool): If True the potential field and the faults block are stacked to the lithology block
+            fault (bool): If True the series is a fault and it is computed as in the loop of the faults
+            final_block (theano.tensor.matrix): Block before the series. For the faults the faults block at the grid
+                and the interfaces
+            fault_matrix (theano.tensor.matrix): Faults block after all the faults. Required for the lithology series
+                if there are faults
+
+        Returns:
+            theano.tensor.matrix: Block after the series
+
+            dict: Output of the stages: covariance_matrix, b_vector, weights and potential_field
+        """
+        self.is_fault = n_faults != 0
+        self.weights_given = None
+        self.compute_all = compute_all and not fault
+        self.stage_outputs = {}
+
+        if fault or fault_matrix is None:
+            fault_matrix = T.zeros((0, self.n_grid() + 2*self.len_points))
+        self.fault_matrix = fault_matrix
+
+        weights_init = T.zeros((self.len_series_w[-1],), dtype=self.weights_dtype)
+        compute = self.compute_a_fault if fault else self.compute_a_series
+        block, weights = compute(self.len_series_i[series], self.len_series_i[series+1],
+                                 self.len_series_f[series], self.len_series_f[series+1],
+                                 self.n_formations_per_serie[series], self.n_formations_per_serie[series+1],
+                                 self.u_grade_T[series],
+                                 self.len_series_w[series], self.len_series_w[series+1],
+                                 final_block, weights_init)
+
+        # The methods of every stage store their output while the graph of the series is built
+        return block, dict(self.stage_outputs)
+
+    def ensemble_block_model(self, n_faults=0):
+        """
+        Lithology block of N realizations of the input data in one graph. The input parameters (see
+        input_parameters_list) get a leading axis of realizations and a scan loops the realizations computing the
+        final lithology block of each. The shape of the data (number of points per series and formation) has to be
+        the same in all the realizations. Every iteration is a clone of the whole graph, so each realization computes
+        its covariances, solves and grid kernels as a single model would. Only the calls are batched, the grid work is
+        not amortized: the kernels between the grid and the data depend on the position of the data of every
+        realization, and from the second series on the points yet to simulate depend on its blocks too. The only
+        inputs common to all the realizations are the shared variables of the grid (coordinates and drift terms)
+        Args:
+            n_faults (int): Number of faults to extract the correct values from the big input matrices
+
+        Returns:
+            list: Symbolic input parameters with the leading axis of realizations
+
+            theano.tensor.matrix: Lithology block of every realization. Shape (N, n_grid)
+        """
+        # Graph of a single realization. Only the last state of the loops is needed
+        block = self.whole_block_model(n_faults, compute_all=False, only_last=True)
+        lithology = block[0, :self.n_grid()]
+
+        input_parameters = self.input_parameters_list()
+        input_parameters_ensemble = [T.TensorType(i.dtype, (False,) + i.broadcastable)(i.name + ' (realizations)')
+                                     for i in input_parameters]
+
+        def realization(*input_parameters_realization):
+            return theano.clone(lithology, replace=dict(zip(input_parameters, input_parameters_realization)))
+
+        lithology_ensemble, updates = theano.scan(fn=realization, sequences=input_parameters_ensemble)
+        lithology_ensemble.name = 'Lithology block of every realization'
+
+        return input_parameters_ensemble, lithology_ensemble
+
+    @staticmethod
+    def compile_mode(only_last=False):
+        """
+        Theano mode to compile whole_block_model
+        Args:
+            only_last (bool): If True the scan optimization that stores only the taps of the loops that are used is
+                added to the default optimizer. fast_compile does not include it
+
+        Returns:
+            theano.compile.Mode: Compilation mode
+        """
+        mode = theano.compile.get_default_mode()
+        if only_last:
+            mode = mode.including('scanOp_save_mem')
+        return mode
+
     # ==================================
     # Geophysics
     # ==================================
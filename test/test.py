@@ -3,10 +3,38 @@ import pytest
 import theano
 import numpy as np
 import sys
+import tracemalloc
 sys.path.append("../")
 import gempy
 
 
+def fab_model(resolution, split_series=False):
+    """
+    Fab model with one fault used to test the options of the interpolator
+    Args:
+        resolution (list): resolution of the regular grid
+        split_series (bool): split the lithologies in two series
+
+    Returns:
+        gempy.DataManagement.InputData: geo_data with the series and the fault set
+    """
+    geo_data = gempy.create_data([0, 2000, 0, 2000, -2000, 0], resolution,
+                                 path_f="../input_data/Fab_Foliations.csv",
+                                 path_i="../input_data/Fab_Points.csv")
+
+    if split_series:
+        gempy.set_data_series(geo_data, {'series1': ('Reservoir', 'Seal'),
+                                         'series2': ('SecondaryReservoir', 'NonReservoirDeep'),
+                                         'fault1': 'MainFault'},
+                              order_series=['fault1', 'series1', 'series2'])
+    else:
+        gempy.set_data_series(geo_data, {'series': ('Reservoir', 'Seal', 'SecondaryReservoir', 'NonReservoirDeep'),
+                                         'fault1': 'MainFault'},
+                              order_series=['fault1', 'series'])
+    geo_data.n_faults = 1
+    return geo_data
+
+
 class TestNoFaults:
     """
     I am testing all block and potential field values so sol is (n_block+n_pot)
@@ -336,3 +364,599 @@ class TestFaults:
 
         print('The mismatch geomodeller-gempy is ', similarity*100, '%')
         assert similarity < 0.05, 'The mismatch with geomodeller is too high'
+
+
+class TestChunkEvaluation:
+    """
+    Evaluating the grid in chunks has to give exactly the same result than evaluating it at once
+    """
+    @pytest.fixture(scope='class')
+    def geo_data(self):
+        return fab_model([20, 20, 20])
+
+    def test_chunk_size(self, geo_data):
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0]))
+        sol_chunks = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0], chunk_size=137))
+
+        np.testing.assert_array_equal(sol_chunks, sol)
+
+    def test_two_series(self):
+        # From the second lithology series on only the points yet to simulate are interpolated, so every path has to
+        # take the faults block at those points
+        geo_data = fab_model([20, 20, 20], split_series=True)
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0]))
+        sol_chunks = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0], chunk_size=137))
+
+        np.testing.assert_array_equal(sol_chunks, sol)
+
+    def test_memory_budget(self, geo_data):
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], memory_budget=2e6)
+        chunk_size = data_interp.interpolator.tg.grid_chunk_size_T.get_value()
+        sol = gempy.compute_model(data_interp)
+
+        assert 0 < chunk_size < geo_data.grid.n_points
+        np.testing.assert_array_equal(sol, gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0])))
+
+    def test_neighbour_evaluation(self, geo_data):
+        # Short range so most of the data is out of the range of every chunk
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0], range_var=0.2))
+        sol_neighbours = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0], range_var=0.2,
+                                                                     neighbour_evaluation=True, chunk_size=200))
+
+        np.testing.assert_array_equal(sol_neighbours, sol)
+
+
+class TestOnlyLast:
+    """
+    Keeping only the last state of the loops has to give the block of the last series
+    """
+    def test_only_last(self):
+        geo_data = fab_model([20, 20, 20], split_series=True)
+
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0]))
+        sol_last = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0], only_last=True))
+
+        assert sol_last.shape == sol.shape[1:]
+        np.testing.assert_array_equal(sol_last, sol[-1])
+
+
+class TestKrigingWeights:
+    """
+    Evaluating the model with the cached kriging weights has to give the same result than computing the model
+    """
+    def test_evaluate(self):
+        geo_data = fab_model([20, 20, 20])
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0])
+        sol = gempy.compute_model(data_interp)
+
+        weights = data_interp.get_kriging_weights()
+        assert len(weights) == 2
+
+        # The weights are not computed again
+        assert data_interp.get_kriging_weights()[0].base is weights[0].base
+
+        np.testing.assert_array_equal(gempy.compute_model_at(data_interp, geo_data.grid.grid), sol)
+        np.testing.assert_array_equal(gempy.compute_model_at(data_interp, geo_data.grid.grid[::7]), sol[:, ::7])
+
+
+class TestKrigingSolve:
+    """
+    The sparse solver has to give the same dual kriging parameters than the dense one
+    """
+    def test_sparse_solver(self):
+        from gempy.kriging_solvers import KrigingSolve, last_solve
+
+        # Banded matrix plus the constant offset of the interfaces in the rows 10:150
+        n = 200
+        C = np.eye(n) * 4 + np.eye(n, k=1) + np.eye(n, k=-1) + np.eye(n, k=7) + np.eye(n, k=-7)
+        C[10:150, 10:150] += 1e-6
+        b = np.random.RandomState(1234).rand(n)
+
+        C_T = theano.tensor.dmatrix()
+        b_T = theano.tensor.dvector()
+        sparse_solver = KrigingSolve(sparse_threshold=1, sparse_min_size=0)
+        dense_solver = KrigingSolve(sparse_threshold=0)
+        x_sparse = theano.function([C_T, b_T], sparse_solver(C_T, b_T, 10, 150))(C, b)
+        assert last_solve()['solver'] == 'sparse'
+        x_dense = theano.function([C_T, b_T], dense_solver(C_T, b_T, 10, 150))(C, b)
+        assert last_solve()['solver'] == 'dense'
+
+        np.testing.assert_allclose(x_sparse, x_dense, rtol=1e-10)
+        np.testing.assert_allclose(C.dot(x_sparse), b, rtol=1e-10)
+
+    def test_iterative_solver(self):
+        from gempy.kriging_solvers import KrigingSolve, IterativeKrigingSolve, last_solve
+
+        # Same kind of matrix with a zero drift block as the kriging matrix
+        n = 200
+        C = np.eye(n + 4) * 4 + np.eye(n + 4, k=1) + np.eye(n + 4, k=-1)
+        C[n:, n:] = 0
+        C[:n, n:] = np.random.RandomState(1234).rand(n, 4)
+        C[n:, :n] = C[:n, n:].T
+        C[10:150, 10:150] += 1e-6
+        b = np.random.RandomState(1234).rand(n + 4)
+
+        C_T = theano.tensor.dmatrix()
+        b_T = theano.tensor.dvector()
+        x_dense = theano.function([C_T, b_T], KrigingSolve(sparse_threshold=0)(C_T, b_T, 10, 150))(C, b)
+
+        for method, preconditioner in [('gmres', 'block_jacobi'), ('gmres', 'ilu'), ('minres', 'jacobi')]:
+            solver = IterativeKrigingSolve(method=method, preconditioner=preconditioner, tol=1e-10, block_size=50)
+            x = theano.function([C_T, b_T], solver(C_T, b_T, 10, 150))(C, b)
+
+            record = last_solve()
+            assert record['op'] == 'IterativeKrigingSolve'
+            assert record['info'] == 0 and record['iterations'] > 0
+            assert record['residual'] <= 1e-10
+            np.testing.assert_allclose(x, x_dense, rtol=1e-6, atol=1e-8)
+
+    def test_incremental_solver(self):
+        from gempy.kriging_solvers import KrigingSolve, IncrementalKrigingSolve, last_solve
+
+        n = 200
+        C = np.eye(n) * 4 + np.eye(n, k=1) + np.eye(n, k=-1) + np.eye(n, k=7) + np.eye(n, k=-7)
+        b = np.random.RandomState(1234).rand(n)
+
+        C_T = theano.tensor.dmatrix()
+        b_T = theano.tensor.dvector()
+        solver = IncrementalKrigingSolve()
+        incremental_f = theano.function([C_T, b_T], solver(C_T, b_T, 0, 0))
+        dense_f = theano.function([C_T, b_T], KrigingSolve(sparse_threshold=0)(C_T, b_T, 0, 0))
+
+        incremental_f(C, b)
+        assert last_solve()['solver'] == 'factorization'
+
+        # Moving a point changes its row and its column
+        C[20, :] = C[:, 20] = np.random.RandomState(1).rand(n) * 0.1
+        C[20, 20] = 4
+        x = incremental_f(C, b)
+
+        assert last_solve()['solver'] == 'update' and last_solve()['rank'] == 2
+        np.testing.assert_allclose(x, dense_f(C, b), rtol=1e-10)
+
+    def test_incremental_series(self):
+        geo_data = fab_model([10, 10, 10], split_series=True)
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0], solver='incremental')
+        gempy.compute_model(data_interp)
+        assert data_interp.series_recomputed == [True, True, True]
+
+        sol = gempy.compute_model(data_interp)
+        assert data_interp.series_recomputed == [False, False, False]
+
+        # Moving a point of the second lithology series inside the extent of the data (the rescaling is the same)
+        interfaces = geo_data.interfaces
+        z_min = min(interfaces['Z'].min(), geo_data.foliations['Z'].min())
+        z_max = max(interfaces['Z'].max(), geo_data.foliations['Z'].max())
+        moved = interfaces.index[(interfaces['formation'] == 'NonReservoirDeep') &
+                                 (interfaces['Z'] > z_min + 10) & (interfaces['Z'] < z_max - 10)][0]
+        interfaces.loc[moved, 'Z'] += 10
+        data_interp.update_interpolator(geo_data)
+        sol_moved = gempy.compute_model(data_interp)
+        assert data_interp.series_recomputed == [False, False, True]
+
+        # The first series keeps its block and the whole model is the same than computing it from scratch
+        np.testing.assert_array_equal(sol_moved[0], sol[0])
+        sol_direct = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0]))
+        np.testing.assert_array_equal(sol_moved[:, [0, 2]], sol_direct[:, [0, 2]])
+        np.testing.assert_allclose(sol_moved[:, 1], sol_direct[:, 1], rtol=1e-4)
+
+    def test_mixed_precision_solver(self):
+        from gempy.kriging_solvers import MixedPrecisionKrigingSolve, last_solve
+
+        # float32 matrix with condition number 1e5
+        rng = np.random.RandomState(1234)
+        Q = np.linalg.qr(rng.rand(100, 100))[0]
+        C = Q.dot(np.diag(np.logspace(0, 5, 100))).dot(Q.T).astype('float32')
+        b = rng.rand(100).astype('float32')
+
+        C_T = theano.tensor.fmatrix()
+        b_T = theano.tensor.fvector()
+        solver = MixedPrecisionKrigingSolve()
+        x = theano.function([C_T, b_T], solver(C_T, b_T, 0, 0))(C, b)
+
+        record = last_solve()
+        assert record['solver'] == 'mixed' and record['refinements'] > 0
+        assert record['residual'] <= solver.tol
+        x_64 = np.linalg.solve(C.astype('float64'), b.astype('float64'))
+        np.testing.assert_allclose(x, x_64, rtol=1e-5)
+
+        # The refined solution is returned in float64, so its residual is the recorded one
+        assert x.dtype == 'float64'
+        residual = np.linalg.norm(C.astype('float64').dot(x) - b) / np.linalg.norm(b.astype('float64'))
+        assert residual <= solver.tol
+
+
+class TestParallelSeries:
+    """
+    Computing the lithology series in parallel and merging them has to give the same result than the sequential loop
+    """
+    def test_parallel_series(self):
+        geo_data = fab_model([20, 20, 20], split_series=True)
+
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0]))
+        interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0], parallel_series=2)
+
+        # The threads reuse their compiled functions in every call
+        for i in range(10):
+            np.testing.assert_array_equal(gempy.compute_model(interp_data), sol)
+
+
+class TestEnsemble:
+    """
+    Computing several realizations in one call has to give the same blocks than calling th_fn for every realization
+    """
+    def test_ensemble(self):
+        geo_data = fab_model([20, 20, 20], split_series=True)
+
+        interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0], only_last=True, compute_all=False)
+        input_data = interp_data.get_input_data()
+
+        # Realizations of the interfaces. The foliations are the same for all of them
+        rng = np.random.RandomState(1234)
+        ref = np.array([input_data[4] + rng.normal(0, 0.005, input_data[4].shape) for i in range(3)])
+        rest = np.array([input_data[5] + rng.normal(0, 0.005, input_data[5].shape) for i in range(3)])
+
+        sol = gempy.compute_model_ensemble(interp_data, input_data[:4] + [ref, rest])
+
+        assert sol.shape == (3, geo_data.grid.n_points)
+        for i in range(3):
+            realization = input_data[:4] + [ref[i].astype(input_data[4].dtype), rest[i].astype(input_data[5].dtype)]
+            np.testing.assert_array_equal(sol[i], np.squeeze(interp_data.th_fn(*realization)))
+
+
+class TestSigmoidSegmentation:
+    """
+    The sigmoid segmentation has to converge to the hard one for steep slopes and give gradients respect the data
+    """
+    def test_sigmoid(self):
+        from gempy.UncertaintyAnalysis import create_model_op
+
+        geo_data = fab_model([10, 10, 10])
+
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0]))
+        interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], segmentation='sigmoid', sigmoid_slope=1e5)
+        sol_sigmoid = gempy.compute_model(interp_data)
+
+        np.testing.assert_array_equal(np.round(sol_sigmoid[0]), sol[0])
+
+        # Gradient of the block respect the interfaces through the theano Op
+        input_data_T = [theano.tensor.matrix(), theano.tensor.vector(), theano.tensor.vector(),
+                        theano.tensor.vector(), theano.tensor.matrix(), theano.tensor.matrix()]
+        block = create_model_op(interp_data)(*input_data_T)
+        grad_f = theano.function(input_data_T, theano.tensor.grad(block[0].sum(), input_data_T[5]),
+                                 on_unused_input='ignore')
+        grad = grad_f(*interp_data.get_input_data())
+
+        assert np.all(np.isfinite(grad)) and np.any(grad != 0)
+
+    def test_coincident_points(self):
+        from gempy.theanograf import TheanoGraph_pro
+
+        # The distance between coincident points is exactly 0 (so C_G finds coincident dips) and differentiable
+        x = np.array([[0, 0, 0], [1, 2, 3], [1, 2, 3]], dtype='float64')
+        x_T = theano.tensor.dmatrix()
+        distances = TheanoGraph_pro.squared_euclidean_distances(x_T, x_T)
+        distances, grad = theano.function([x_T], [distances, theano.tensor.grad(distances.sum(), x_T)])(x)
+
+        assert distances[1, 2] == 0 and np.all(np.diag(distances) == 0)
+        np.testing.assert_allclose(distances[0, 1], np.sqrt(14))
+        assert np.all(np.isfinite(grad))
+
+
+class TestFunctionCache:
+    """
+    A function loaded from the on disk cache has to compute the same model than the compiled one
+    """
+    def test_function_cache(self, tmpdir):
+        geo_data = fab_model([20, 20, 20])
+
+        paths = gempy.prewarm_cache(geo_data, cache_dir=str(tmpdir), u_grade=[0, 0])
+        assert len(paths) == 1 and tmpdir.join(paths[0].split('/')[-1]).check()
+
+        sol = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0]))
+        sol_cached = gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0], cache_dir=str(tmpdir)))
+
+        np.testing.assert_array_equal(sol_cached, sol)
+
+
+class TestImportTime:
+    """
+    Importing gempy must not load theano or the plotting libraries, so headless workers start fast
+    """
+    def test_import_time(self):
+        import os
+        import subprocess
+
+        script = ("import sys, time\n"
+                  "import numpy, pandas\n"
+                  "t = time.time()\n"
+                  "import gempy\n"
+                  "print(time.time() - t, *[m for m in ('theano', 'matplotlib', 'seaborn', 'vtk', 'IPython',"
+                  " 'pymc3', 'bokeh') if m in sys.modules])\n")
+        out = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', script],
+                                      cwd=os.path.dirname(os.path.dirname(os.path.abspath(gempy.__file__))))
+        import_time = out.decode().split()
+
+        # Only the time is printed if none of the libraries was loaded
+        assert import_time[1:] == []
+        assert float(import_time[0]) < 0.5
+
+
+class TestInstrumentation:
+    """
+    Computing the model stage by stage has to give the same result than th_fn and record every stage
+    """
+    def test_instrumentation(self):
+        geo_data = fab_model([20, 20, 20], split_series=True)
+
+        interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0, 0, 0])
+        sol = gempy.compute_model(interp_data)
+        sol_instrumented, report = gempy.compute_model(interp_data, instrumentation=True)
+
+        np.testing.assert_array_equal(sol_instrumented, sol)
+
+        stages = report.to_dataframe()
+        # The input data was prepared by compute_model already, so nothing is uploaded
+        assert list(stages['stage'][:5]) == ['data_prep', 'covariance', 'solve', 'evaluation', 'segmentation']
+        assert list(stages.groupby('series', sort=False)['fault'].first().items()) == \
+            [('fault1', True), ('series1', False), ('series2', False)]
+        assert (stages['time'] > 0).all() and report.peak_memory > 0
+
+        # Preparing the data again uploads the shared variables, which happens inside data_prep
+        interp_data.interpolator._data_prep_key = None
+        sol_instrumented, report = gempy.compute_model(interp_data, instrumentation=True)
+
+        np.testing.assert_array_equal(sol_instrumented, sol)
+        assert list(report.to_dataframe()['stage'][:3]) == ['data_prep', 'upload', 'covariance']
+
+    def test_caller_tracing(self):
+        geo_data = fab_model([10, 10, 10])
+
+        interp_data = gempy.InterpolatorInput(geo_data, u_grade=[0, 0])
+        tracemalloc.start()
+        try:
+            gempy.compute_model(interp_data, instrumentation=True)
+            # The tracing of the caller keeps running
+            assert tracemalloc.is_tracing()
+        finally:
+            tracemalloc.stop()
+
+
+class TestMemoryPlanner:
+    """
+    The memory budget chooses the evaluation of the grid or fails before compiling
+    """
+    @pytest.fixture(scope='class')
+    def geo_data(self):
+        return fab_model([20, 20, 20])
+
+    def test_strategy(self, geo_data):
+        whole = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], memory_budget=1e9, compile_theano=False)
+        chunks = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], memory_budget=2e6, compile_theano=False)
+
+        assert whole.interpolator.memory_plan.strategy == 'whole'
+        assert not whole.interpolator.tg.chunk_evaluation
+        assert chunks.interpolator.memory_plan.strategy == 'chunks'
+        assert chunks.interpolator.memory_plan.peak_memory <= 2e6
+        assert chunks.interpolator.memory_plan.peak_memory < whole.interpolator.memory_plan.peak_memory
+
+    def test_no_budget(self, geo_data):
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], compile_theano=False)
+
+        assert data_interp.interpolator.memory_plan.memory_budget is None
+        assert data_interp.interpolator.memory_plan.strategy == 'whole'
+
+    def test_too_small_budget(self, geo_data):
+        with pytest.raises(MemoryError) as error:
+            gempy.InterpolatorInput(geo_data, u_grade=[0, 0], memory_budget=1e4, compile_theano=False)
+
+        # Even the smallest chunk needs more than the budget
+        assert 'memory budget of %.2f MB' % (1e4 / 2**20) in str(error.value)
+
+
+class TestAdaptiveEvaluation:
+    """
+    Refining the grid only around the interfaces has to give the same blocks than evaluating the whole grid
+    """
+    def test_blocks(self):
+        geo_data = fab_model([41, 41, 41])
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0])
+        sol = gempy.compute_model(data_interp)
+        sol_adaptive = gempy.compute_model_adaptive(data_interp, levels=3)
+        evaluated = data_interp.adaptive_evaluated
+
+        assert evaluated.mean() < 0.6
+        np.testing.assert_array_equal(sol_adaptive[[0, 2]], sol[[0, 2]])
+        np.testing.assert_array_equal(sol_adaptive[1, evaluated], sol[1, evaluated])
+        assert np.isnan(sol_adaptive[1, ~evaluated]).all()
+
+
+class TestSections:
+    """
+    Computing only a section or a map has to give the same values than the section of the whole block
+    """
+    @pytest.fixture(scope='class')
+    def data_interp(self):
+        geo_data = fab_model([20, 22, 24])
+
+        return gempy.InterpolatorInput(geo_data, u_grade=[0, 0])
+
+    def test_sections(self, data_interp):
+        sol = data_interp.th_fn(*data_interp.get_input_data())
+        block = data_interp.lithology_block(sol).reshape(20, 22, 24)
+        potential_field = data_interp.potential_field(sol, 1).reshape(20, 22, 24)
+
+        for cell_number, direction, index in [(3, 'x', np.s_[3, :, :]), (7, 'y', np.s_[:, 7, :]),
+                                              (0, 'z', np.s_[:, :, 0])]:
+            section = data_interp.compute_section(cell_number, direction)
+            np.testing.assert_array_equal(data_interp.lithology_block(section), block[index])
+            np.testing.assert_array_equal(data_interp.potential_field(section, 1), potential_field[index])
+
+        plane = gempy.compute_section(data_interp, plane=([0, 1000, -2000], [2000, 0, 0], [0, 0, 2000]),
+                                      resolution=(30, 40))
+        assert plane.shape == (3, 30, 40)
+
+        # A section of the grid needs its position
+        with pytest.raises(AssertionError):
+            gempy.compute_section(data_interp, direction='y')
+
+    def test_geological_map(self, data_interp):
+        sol = data_interp.th_fn(*data_interp.get_input_data())
+        block = data_interp.lithology_block(sol).reshape(20, 22, 24)
+
+        # A flat topography at the height of a layer of the grid
+        dem = np.full((20, 22), np.linspace(-2000, 0, 24, dtype='float32')[17])
+        geological_map = data_interp.compute_geological_map(dem)
+        np.testing.assert_array_equal(data_interp.lithology_block(geological_map), block[:, :, 17])
+
+        x, y = np.meshgrid(np.linspace(0, 2000, 50), np.linspace(0, 2000, 40), indexing='ij')
+        assert gempy.compute_geological_map(data_interp, -800 + 300 * np.sin(x / 400) * np.cos(y / 600)).shape == \
+            (3, 50, 40)
+
+
+class TestDataPrep:
+    """
+    The input data is only prepared again when the data changes
+    """
+    def test_cache(self):
+        geo_data = fab_model([10, 10, 10])
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], compile_theano=False)
+        interpolator = data_interp.interpolator
+        input_data = data_interp.get_input_data()
+        key = interpolator._data_prep_key
+
+        # Modifying the returned arrays does not change the cache
+        input_data[5][:] = 0
+        assert interpolator.data_prep_key([0, 0]) == key
+        assert data_interp.get_input_data()[5].any()
+
+        interpolator._data_scaled.interfaces.loc[3, 'Z'] += 0.01
+        rest_layer_points = data_interp.get_input_data()[5]
+        assert interpolator._data_prep_key != key
+        assert not np.array_equal(rest_layer_points, input_data[5])
+
+        # Same arrays than preparing the data without cache
+        interpolator._data_prep_key = None
+        for cached, prepared in zip(data_interp.get_input_data(), data_interp.get_input_data()):
+            np.testing.assert_array_equal(cached, prepared)
+
+    def test_rest_layer_points(self):
+        geo_data = fab_model([10, 10, 10])
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], compile_theano=False)
+        interpolator = data_interp.interpolator
+        for i in range(2):
+            # The second time the input data comes from the cache
+            rest_layer_points = data_interp.get_input_data()[5]
+            np.testing.assert_array_equal(
+                interpolator.pandas_rest_layer_points[['X', 'Y', 'Z']].values.astype(rest_layer_points.dtype),
+                rest_layer_points)
+
+
+class TestRescaling:
+    """
+    The rescaled data does not copy the grid nor modify the input data
+    """
+    def test_rescaling(self):
+        geo_data = fab_model([10, 10, 10])
+        interfaces = geo_data.interfaces.copy()
+        grid = geo_data.grid.grid.copy()
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], compile_theano=False)
+        assert geo_data.interfaces.equals(interfaces)
+        assert data_interp.data.grid.real_grid is geo_data.grid
+
+        rescaled = (grid - data_interp.centers.as_matrix()) / data_interp.rescaling_factor + 0.5001
+        np.testing.assert_array_equal(data_interp.data.grid.grid, rescaled)
+
+        # The grid passed to theano is the same in chunks
+        interpolator = data_interp.interpolator
+        for chunked, whole in zip(interpolator.grid_to_theano(data_interp.data.grid, chunk_size=7),
+                                  interpolator.grid_to_theano(rescaled)):
+            np.testing.assert_array_equal(chunked, whole)
+
+
+class TestRegularGrid:
+    """
+    The regular grid is not stored and its points generated in the graph give the same model than the explicit grid.
+    The distances to the regular grid are separable, so the potential field is not bitwise the same
+    """
+    @pytest.fixture(scope='class')
+    def geo_data(self):
+        return fab_model([10, 12, 14])
+
+    @pytest.fixture(scope='class')
+    def explicit(self, geo_data):
+        return gempy.compute_model(gempy.InterpolatorInput(geo_data, u_grade=[0, 0]))
+
+    @pytest.fixture(scope='class', params=[{}, {'chunk_size': 300}], ids=['whole', 'chunks'])
+    def regular(self, geo_data, request):
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], regular_grid=True, **request.param)
+        assert data_interp.interpolator.tg.regular_grid
+        assert data_interp.interpolator.tg.grid_val_T.get_value().size == 0
+        return gempy.compute_model(data_interp)
+
+    def test_points(self, geo_data):
+        assert geo_data.grid.regular and geo_data.grid._grid is None
+        np.testing.assert_array_equal(geo_data.grid.points(np.arange(5, 500, 7)), geo_data.grid.grid[5:500:7])
+        # The points of the regular grid are created once
+        assert geo_data.grid.grid is geo_data.grid.grid and not geo_data.grid.grid.flags.writeable
+
+    def test_blocks(self, regular, explicit):
+        # Lithology and faults blocks
+        np.testing.assert_array_equal(regular[[0, 2]], explicit[[0, 2]])
+
+    def test_potential_field(self, regular, explicit):
+        # In float32 the squared distances of the explicit grid (squared_euclidean_distances) lose around 1e-7 to the
+        # cancellation of |x|**2 + |y|**2 - 2xy with coordinates of order 1, the separable ones do not. Through the
+        # kernels and the dual kriging parameters this stays orders of magnitude below 1e-4 of the range of the field
+        np.testing.assert_allclose(regular[1], explicit[1], rtol=0, atol=1e-4 * np.ptp(explicit[1]))
+
+    def test_set_grid(self):
+        geo_data = fab_model([10, 12, 14])
+        points = geo_data.grid.grid[::3]
+
+        # Nothing generates the regular grid yet, so the interpolator takes the points of the new grid
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], regular_grid=True, compile_theano=False)
+        gempy.set_grid(geo_data, points)
+        data_interp.update_interpolator(geo_data)
+        assert not data_interp.interpolator.tg.regular_grid
+        assert data_interp.interpolator.tg.grid_val_T.get_value().shape == points.shape
+
+        geo_data = fab_model([10, 12, 14])
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], regular_grid=True)
+        gempy.set_grid(geo_data, points)
+        with pytest.raises(ValueError):
+            data_interp.update_interpolator(geo_data)
+
+
+class TestCovarianceAssembly:
+    """
+    The covariance of the interfaces computed on the unique reference points has to be the same than on the
+    reference points repeated once per rest point
+    """
+    def test_unique_reference_points(self):
+        geo_data = fab_model([10, 10, 10])
+
+        data_interp = gempy.InterpolatorInput(geo_data, u_grade=[0, 0], compile_theano=False)
+        tg = data_interp.interpolator.tg
+        input_data = data_interp.get_input_data()
+        ref_unique, ref_index = tg.unique_reference_points()
+        ref_unique, ref_index, C_I = theano.function(tg.input_parameters_list(),
+                                                     [ref_unique, ref_index, tg.cov_interfaces()],
+                                                     on_unused_input='ignore')(*input_data)
+
+        ref, rest = input_data[4], input_data[5]
+        assert len(ref_unique) == len(geo_data.interfaces['formation'].unique())
+        np.testing.assert_array_equal(ref_unique[ref_index], ref)
+
+        def covariance(x_1, x_2):
+            r = np.sqrt(((x_1[:, None, :] - x_2[None, :, :]) ** 2).sum(-1)) / tg.a_T.get_value()
+            return (r < 1) * (1 - 7 * r ** 2 + 35 / 4 * r ** 3 - 7 / 2 * r ** 5 + 3 / 4 * r ** 7)
+
+        C_I_repeated = tg.c_o_T.get_value() * tg.i_reescale.get_value() * (
+            covariance(rest, rest) - covariance(ref, rest) - covariance(rest, ref) + covariance(ref, ref)) + 1e-6
+        np.testing.assert_allclose(C_I, C_I_repeated, atol=1e-5)